@@ -0,0 +1,61 @@
+"""
+Brand cache used while ingesting scraped product info
+"""
+from products.models import Brands
+
+
+class BrandResolver:
+    """
+    Resolves scraped brand names to Brands objects. All brands are loaded once
+    on first use, so looking up a known brand never touches the db. Names are
+    matched on Brands.brand_key (see Brands.normalise), so 'Big Brand' and
+    'big  brand' resolve to the same row.
+
+    Missing brands are created in a single batch per call to resolve_many().
+    The unique brand_key column makes concurrent scrapers safe: conflicting
+    inserts are ignored and the row that won is read back.
+
+    Usage:
+        >>> brands = BrandResolver()
+        >>> brands.resolve_many(['Brand A', 'brand b'])
+        {'Brand A': <Brands>, 'brand b': <Brands>}
+        >>> brands.get('BRAND A')
+        <Brands>
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+        self._brands = None  # brand_key -> Brands
+
+    def preload(self):
+        """ Loads every brand into the cache """
+        brands = Brands.objects.using(self.using).all()
+        self._brands = {b.brand_key: b for b in brands}
+
+    def resolve_many(self, names):
+        """ Returns a dict of name -> Brands, creating missing brands """
+        if self._brands is None:
+            self.preload()
+
+        missing = {}  # brand_key -> name as scraped
+        for name in names:
+            key = Brands.normalise(name)
+            if key and key not in self._brands:
+                missing.setdefault(key, name)
+
+        if missing:
+            objects = Brands.objects.using(self.using)
+            new_brands = [Brands(brand=' '.join(name.split()), brand_key=key)
+                          for key, name in missing.items()]
+            objects.bulk_create(new_brands, ignore_conflicts=True)
+            # Read back rather than trust bulk_create, as another scraper may
+            # have inserted some of these brands first
+            for brand in objects.filter(brand_key__in=list(missing)):
+                self._brands[brand.brand_key] = brand
+
+        return {name: self._brands.get(Brands.normalise(name))
+                for name in names}
+
+    def get(self, name):
+        """ Returns the Brands object for a single name """
+        return self.resolve_many([name])[name]
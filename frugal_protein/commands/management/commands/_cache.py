@@ -0,0 +1,140 @@
+"""
+On-disk record/replay cache in front of frugal_protein_scrapers
+"""
+import gzip
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+import frugal_protein_scrapers as fps
+
+
+class CacheMiss(Exception):
+    """ Raised in replay mode when a response has not been recorded """
+
+
+class ResponseCache:
+    """
+    Wraps fps.scrape_infos and fps.scrape_ids with an opt-in cache so that
+    scraped responses can be re-ingested without hitting the stores again.
+
+    Modes:
+        passthrough - call the scrapers directly; nothing is cached
+        record      - call the scrapers and store every response
+        replay      - serve responses from the cache only; anything missing or
+                      older than the ttl raises CacheMiss
+
+    Info responses are recorded with every field and keyed by store and pid,
+    so a replay serves any `exclusive`/`exclude` combination (the planner
+    asks for different fields as products fill up) by picking the requested
+    fields out of the recorded response. Id pages are keyed by store and
+    page number. Entries are gzipped pickles (info dicts can hold PIL
+    images) stored under `directory/<store>/`.
+
+    Attributes
+        directory (str): root directory of the cache
+        mode (str): one of `modes`
+        ttl (float): max age of an entry in seconds, or None for no expiry
+
+    Usage:
+        >>> cache = ResponseCache('commands/cache', mode='record')
+        >>> info_dict = cache.scrape_infos('123', 'tesco', exclusive='price')
+        >>> for id_dicts in cache.scrape_ids('tesco'):
+        ...     pass
+    """
+    modes = ('passthrough', 'record', 'replay')
+    key_fields = {'img': 'image'}  # info_dict keys not named after a field
+
+    def __init__(self, directory, mode='passthrough', ttl=None):
+        if mode not in self.modes:
+            raise ValueError(f'Unknown cache mode: {mode}')
+        self.directory = directory
+        self.mode = mode
+        self.ttl = ttl
+
+    def scrape_infos(self, pid, store, exclusive='', exclude=''):
+        if self.mode == 'passthrough':
+            return fps.scrape_infos(pid, store, exclusive=exclusive,
+                                    exclude=exclude)
+        path = self._path(store, 'info', pid)
+        if self.mode == 'replay':
+            info_dict = self._read(path)
+        else:
+            # Recorded whole, so a replay can ask for any set of fields
+            info_dict = fps.scrape_infos(pid, store)
+            self._write(path, info_dict)
+        return self.select(info_dict, exclusive, exclude)
+
+    @classmethod
+    def select(cls, info_dict, exclusive='', exclude=''):
+        """
+        Returns the values of info_dict that fps.scrape_infos would have
+        returned for the given exclusive and exclude fields
+        """
+        if not info_dict:
+            return info_dict
+        wanted = set(exclusive.split())
+        unwanted = set(exclude.split())
+        selected = {}
+        for key, value in info_dict.items():
+            field = cls.key_fields.get(key, key)
+            if (wanted and field not in wanted) or field in unwanted:
+                continue
+            selected[key] = value
+        return selected
+
+    def scrape_ids(self, store):
+        if self.mode == 'passthrough':
+            yield from fps.scrape_ids(store)
+        elif self.mode == 'record':
+            pages = 0
+            for id_dicts in fps.scrape_ids(store):
+                self._write(self._path(store, 'ids', pages), id_dicts)
+                pages += 1
+                yield id_dicts
+            # Written last so that a partially recorded store isn't replayed
+            self._write(self._path(store, 'ids'), pages)
+        else:
+            pages = self._read(self._path(store, 'ids'))
+            for page in range(pages):
+                yield self._read(self._path(store, 'ids', page))
+
+    def evict(self):
+        """ Deletes entries older than the ttl and returns how many """
+        if self.ttl is None or not os.path.isdir(self.directory):
+            return 0
+        evicted = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if self._expired(path):
+                    os.remove(path)
+                    evicted += 1
+        return evicted
+
+    def _path(self, store, *parts):
+        key = '\0'.join(str(p) for p in (store,) + parts)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, store, digest[:2],
+                            f'{digest}.pkl.gz')
+
+    def _expired(self, path):
+        return (self.ttl is not None and
+                time.time() - os.path.getmtime(path) > self.ttl)
+
+    def _read(self, path):
+        if not os.path.isfile(path) or self._expired(path):
+            raise CacheMiss(path)
+        with gzip.open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _write(self, path, value):
+        # Write to a temporary file first so readers never see partial entries
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as raw, \
+                gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
@@ -0,0 +1,102 @@
+"""
+Checkpointing of info scrape runs so that an interrupted run can be resumed
+"""
+from collections import deque
+
+from django.utils import timezone
+
+from commands.models import ScrapeCheckpoint, ScrapeRun
+
+
+class Watermark:
+    """
+    Tracks the highest pid below which every product has been processed. With
+    several requests in flight results arrive out of order, so a pid is only
+    passed once all smaller pids are done.
+
+    Usage:
+        >>> mark = Watermark([1, 2, 3])
+        >>> mark.done(2)
+        >>> mark.value
+        0
+        >>> mark.done(1)
+        >>> mark.value
+        2
+    """
+
+    def __init__(self, pids, value=0):
+        self.pending = deque(sorted(pids))
+        self.finished = set()
+        self.value = value
+
+    def done(self, pid):
+        self.finished.add(pid)
+        while self.pending and self.pending[0] in self.finished:
+            self.value = self.pending.popleft()
+            self.finished.remove(self.value)
+
+
+class RunCheckpoint:
+    """
+    Persists the progress of an info scrape run per store (see ScrapeCheckpoint)
+    and, with resume=True, picks up the latest unfinished run for the same db.
+
+    Usage:
+        >>> checkpoint = RunCheckpoint.start(['tesco'], 'default', resume=True)
+        >>> products = products.filter(pid__gt=checkpoint.last_pid('tesco'))
+        >>> checkpoint.plan('tesco', [p.pid for p in products])
+        >>> checkpoint.record('tesco', pid, succeeded=True)
+        >>> checkpoint.save()
+        >>> checkpoint.finish()
+    """
+
+    def __init__(self, run, checkpoints):
+        self.run = run
+        self.checkpoints = checkpoints  # store -> ScrapeCheckpoint
+        self.watermarks = {}            # store -> Watermark
+
+    @classmethod
+    def start(cls, stores, database, resume=False):
+        run = None
+        if resume:
+            run = ScrapeRun.objects.filter(
+                database=database, finished__isnull=True
+            ).order_by('-run_id').first()
+        if run is None:
+            run = ScrapeRun.objects.create(database=database)
+
+        checkpoints = {c.store: c for c in run.checkpoints.all()}
+        for store in stores:
+            if store not in checkpoints:
+                checkpoints[store] = ScrapeCheckpoint.objects.create(
+                    run=run, store=store)
+        return cls(run, checkpoints)
+
+    def last_pid(self, store):
+        return self.checkpoints[store].last_pid
+
+    def plan(self, store, pids):
+        """ Registers the pids that will be processed for a store """
+        checkpoint = self.checkpoints[store]
+        self.watermarks[store] = Watermark(pids, checkpoint.last_pid)
+
+    def record(self, store, pid, succeeded):
+        checkpoint = self.checkpoints[store]
+        if succeeded:
+            checkpoint.succeeded += 1
+        else:
+            checkpoint.failed += 1
+        self.watermarks[store].done(pid)
+
+    def save(self):
+        """ Persists progress; call after the matching rows are written """
+        for store, checkpoint in self.checkpoints.items():
+            if store in self.watermarks:
+                checkpoint.last_pid = self.watermarks[store].value
+            checkpoint.save()
+
+    def finish(self):
+        """ Marks the run as complete so that it is never resumed """
+        self.save()
+        self.run.finished = timezone.now()
+        self.run.save()
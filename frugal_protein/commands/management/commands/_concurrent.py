@@ -0,0 +1,186 @@
+"""
+Concurrent engines used by ScrapeHandler to run info and id scrapes
+"""
+import queue
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Outcome of a single info scrape. Exactly one of info_dict/error is set.
+# latency is the time spent on requests, wait the time spent before them.
+ScrapeResult = namedtuple('ScrapeResult',
+                          ['store', 'product', 'info_dict', 'error', 'latency',
+                           'wait'], defaults=[0.0])
+
+
+class FetchTiming:
+    """
+    Filled in by a fetch to split its time between requests (`latency`) and
+    waiting before them (`wait`), e.g. on a throttle or a circuit breaker.
+    A fetch that leaves latency as None is timed as a whole, less its wait.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.wait = 0.0
+
+
+class InfoScrapeEngine:
+    """
+    Runs info scrapes for several stores in parallel. Each store gets its own
+    pool of worker threads, which caps the number of in-flight requests for
+    that store. Worker threads only talk to the network; every result is handed
+    back to the thread iterating over run(), which is the single db writer.
+
+    Attributes
+        fetch (callable): fetch(product, store, timing) -> info_dict, where
+                          timing is a FetchTiming
+        workers (int): max in-flight requests per store
+
+    Usage:
+        >>> engine = InfoScrapeEngine(fetch, workers=4)
+        >>> for result in engine.run({'tesco': products}):
+        ...     handle(result)
+    """
+    _done = object()  # sentinel put on the results queue when a store finishes
+
+    def __init__(self, fetch, workers=1):
+        self.fetch = fetch
+        self.workers = max(1, workers)
+
+    def run(self, jobs):
+        """
+        Yields a ScrapeResult for every product as soon as it is scraped
+
+        Args:
+            jobs (dict): store name -> list of products to scrape
+        """
+        # Bounded so that a slow writer applies backpressure on the workers
+        results = queue.Queue(maxsize=self.workers * max(1, len(jobs)) * 2)
+        for store, products in jobs.items():
+            thread = threading.Thread(target=self._run_store,
+                                      args=(store, products, results),
+                                      name=f'scrape-{store}', daemon=True)
+            thread.start()
+
+        remaining = len(jobs)
+        while remaining:
+            result = results.get()
+            if result is self._done:
+                remaining -= 1
+            else:
+                yield result
+
+    def _run_store(self, store, products, results):
+        slots = threading.BoundedSemaphore(self.workers)
+
+        def task(product):
+            timing = FetchTiming()
+            start = time.perf_counter()
+            info_dict, error = None, None
+            try:
+                info_dict = self.fetch(product, store, timing)
+            except Exception as e:
+                error = e
+            latency = timing.latency
+            if latency is None:
+                latency = time.perf_counter() - start - timing.wait
+            result = ScrapeResult(store, product, info_dict, error, latency,
+                                  timing.wait)
+            try:
+                results.put(result)
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix=f'scrape-{store}') as pool:
+                for product in products:
+                    slots.acquire()
+                    pool.submit(task, product)
+        finally:
+            results.put(self._done)
+
+
+# A page of id_dicts scraped for a store, or the error that ended its scrape
+IdPage = namedtuple('IdPage', ['store', 'id_dicts', 'error'])
+
+
+class IdScrapePipeline:
+    """
+    Fetches pages of ids for several stores in parallel while the caller
+    writes them, so that fetching the next page overlaps writing the last.
+    Each store has a producer thread iterating over scrape_ids(store); pages
+    are handed to the thread iterating over run(), the single db writer,
+    through a queue of at most `max_pages` pages, which blocks the producers
+    whenever the writer falls behind.
+
+    Repeats of a store pid already seen, on an earlier page or earlier on the
+    same page, are dropped before the page is yielded when they add nothing:
+    no barcode, or the barcode already seen for the pid. A repeat with a new
+    barcode is kept for IdIndex to reconcile. The pids seen are held per
+    store and dropped once the store's scrape finishes.
+
+    Attributes
+        scrape_ids (callable): scrape_ids(store) -> iterable of pages
+        max_pages (int): pages buffered between the producers and the writer
+        duplicates (Counter): store -> number of id_dicts dropped
+
+    Usage:
+        >>> pipeline = IdScrapePipeline(fps.scrape_ids)
+        >>> for page in pipeline.run(['tesco', 'iceland']):
+        ...     indexes[page.store].apply(page.id_dicts)
+    """
+    def __init__(self, scrape_ids, max_pages=4):
+        self.scrape_ids = scrape_ids
+        self.max_pages = max(1, max_pages)
+        self.duplicates = Counter()
+
+    def run(self, stores):
+        """
+        Yields an IdPage for every page as soon as it is scraped. A store
+        whose scrape raises yields one last IdPage holding the error.
+        """
+        pages = queue.Queue(maxsize=self.max_pages)
+        for store in stores:
+            thread = threading.Thread(target=self._produce,
+                                      args=(store, pages),
+                                      name=f'scrape-ids-{store}', daemon=True)
+            thread.start()
+
+        seen = {store: {} for store in stores}  # store -> {pid: barcode}
+        remaining = len(stores)
+        while remaining:
+            page = pages.get()
+            if page.id_dicts is None:  # the store's scrape has finished
+                remaining -= 1
+                seen.pop(page.store, None)
+            elif page.error is not None:
+                yield page
+            else:
+                yield page._replace(
+                    id_dicts=self._dedupe(page, seen[page.store]))
+
+    def _dedupe(self, page, seen):
+        id_dicts = []
+        for id_dict in page.id_dicts:
+            pid, barcode = id_dict['pid'], id_dict.get('barcode')
+            if pid is not None and pid in seen and \
+                    barcode in (None, seen[pid]):
+                self.duplicates[page.store] += 1
+                continue
+            if pid is not None and seen.get(pid) is None:
+                seen[pid] = barcode
+            id_dicts.append(id_dict)
+        return id_dicts
+
+    def _produce(self, store, pages):
+        try:
+            for id_dicts in self.scrape_ids(store):
+                pages.put(IdPage(store, list(id_dicts), None))
+        except Exception as e:
+            pages.put(IdPage(store, [], e))
+        finally:
+            pages.put(IdPage(store, None, None))
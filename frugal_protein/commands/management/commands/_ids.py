@@ -0,0 +1,191 @@
+"""
+In-memory barcode/pid index used by the id scrape to reconcile pages of
+scraped ids without a db round trip per product
+"""
+import logging
+from itertools import count
+
+from django.db import connections, transaction
+from django.db.models import FilteredRelation, Max, Q
+
+from commands.models import IdConflict
+from products.models import ProductInfo, StoreListing
+
+
+class IdIndex:
+    """
+    Maps barcodes and store pids of one store to ProductInfo pids. The index is
+    loaded once per store with a single query, after which each page of
+    id_dicts yielded by fps.scrape_ids is reconciled in memory and written in
+    bulk inside a single transaction.
+
+    Reconciliation follows the rules of the original row-by-row update: a
+    product matched by barcode gets its missing store pid filled in, a product
+    matched by store pid gets its missing barcode filled in, and anything
+    unmatched is inserted. Pairs whose barcode and store pid belong to
+    different rows are recorded as IdConflicts for the reconcile command.
+
+    Indexes of several stores written by the same thread can share their
+    barcode map (`by_barcode`), so that a product inserted for one store is
+    matched by barcode, and listed rather than inserted again, by the others.
+
+    Attributes
+        store (str): store name (see Store)
+        using (str): db alias listed under settings.DATABASES
+        by_barcode (dict): barcode -> key, possibly shared between stores
+
+    Usage:
+        >>> index = IdIndex.load('tesco')
+        >>> for id_dicts in fps.scrape_ids('tesco'):
+        ...     index.apply(id_dicts)
+    """
+
+    def __init__(self, store, using='default', by_barcode=None):
+        self.store = store
+        self.using = using
+        self.by_barcode = {} if by_barcode is None else by_barcode
+        self.by_store_pid = {}  # store pid -> key
+        self.rows = {}          # key -> [barcode, store pid]
+        self.listed = set()     # keys with a StoreListing in the db
+        self.conflicts = []     # (barcode, store pid) matching two rows
+        # Rows not yet in the db are keyed by negative numbers until inserted
+        self._temp_keys = count(-1, -1)
+
+    @classmethod
+    def load(cls, store, using='default', by_barcode=None):
+        """ Returns an index populated with every product in the db """
+        index = cls(store, using, by_barcode)
+        rows = ProductInfo.objects.using(using).annotate(
+            listing=FilteredRelation('listings',
+                                     condition=Q(listings__store=store))
+        ).values_list('pid', 'barcode', 'listing__pid')
+        for pid, barcode, store_pid in rows:
+            index._add(pid, barcode, store_pid)
+            if store_pid is not None:
+                index.listed.add(pid)
+        return index
+
+    def _add(self, key, barcode, store_pid):
+        self.rows[key] = [barcode, store_pid]
+        if barcode is not None:
+            self.by_barcode[barcode] = key
+        if store_pid is not None:
+            self.by_store_pid[store_pid] = key
+
+    def _match(self, barcode, store_pid):
+        """ Returns the set of keys matching either id """
+        keys = set()
+        if barcode is not None and barcode in self.by_barcode:
+            keys.add(self.by_barcode[barcode])
+        if store_pid in self.by_store_pid:
+            keys.add(self.by_store_pid[store_pid])
+        return keys
+
+    def reconcile(self, id_dicts):
+        """
+        Updates the index with a page of id_dicts and returns the keys of new
+        rows and of existing rows that changed. id_dicts without a pid are
+        ignored.
+        """
+        new, changed = set(), set()
+        for id_dict in id_dicts:
+            barcode, store_pid = id_dict['barcode'], id_dict['pid']
+            if store_pid is None:
+                continue
+
+            keys = self._match(barcode, store_pid)
+            if not keys:
+                key = next(self._temp_keys)
+                self._add(key, barcode, store_pid)
+                new.add(key)
+                continue
+            if len(keys) > 1:
+                # The barcode and the store pid belong to different rows, i.e.
+                # the rows are duplicates of one product. Recorded so that the
+                # reconcile command can merge them.
+                logging.info(f'{self.store}({store_pid}) -- barcode {barcode} '
+                             f'matches multiple products: {sorted(keys)}')
+                self.conflicts.append((barcode, store_pid))
+                continue
+
+            key = keys.pop()
+            if key not in self.rows:
+                # Inserted by another store's index sharing by_barcode
+                self.rows[key] = [barcode, None]
+            row_barcode, row_store_pid = self.rows[key]
+            if row_barcode and not row_store_pid:
+                self._add(key, row_barcode, store_pid)
+            elif not row_barcode and row_store_pid and barcode is not None:
+                self._add(key, barcode, row_store_pid)
+            else:
+                continue
+            if key > 0:
+                changed.add(key)
+        return new, changed
+
+    def apply(self, id_dicts):
+        """
+        Reconciles a page of id_dicts and writes the result to the db in one
+        transaction. Returns the number of inserted and updated rows.
+        """
+        self.conflicts = []
+        new, changed = self.reconcile(id_dicts)
+        store = self.store
+        new_keys = sorted(new, reverse=True)
+        new_products = [ProductInfo(barcode=self.rows[k][0]) for k in new_keys]
+        # Listed rows only ever lack a barcode; the others lack a listing
+        barcode_products = [ProductInfo(pid=k, barcode=self.rows[k][0])
+                            for k in sorted(changed & self.listed)]
+        listed_keys = sorted(changed - self.listed)
+
+        objects = ProductInfo.objects.using(self.using)
+        with transaction.atomic(using=self.using):
+            if new_products:
+                self._insert(new_products)
+            listings = [
+                StoreListing(product_id=p.pk, store_id=store, pid=self.rows[k][1])
+                for k, p in zip(new_keys, new_products)
+            ] + [StoreListing(product_id=k, store_id=store, pid=self.rows[k][1])
+                 for k in listed_keys]
+            if listings:
+                StoreListing.objects.using(self.using).bulk_create(listings)
+            if barcode_products:
+                objects.bulk_update(barcode_products, ['barcode'])
+        self.listed.update(listed_keys)
+        if self.conflicts:
+            IdConflict.objects.bulk_create(
+                [IdConflict(store=store, store_pid=store_pid, barcode=barcode,
+                            database=self.using)
+                 for barcode, store_pid in self.conflicts],
+                ignore_conflicts=True)
+
+        if new_products:
+            self._resolve_new_keys(new_keys, new_products)
+        return len(new_products), len(changed)
+
+    def _insert(self, products):
+        """ Inserts products, setting their pks for the listings """
+        objects = ProductInfo.objects.using(self.using)
+        if connections[self.using].features.can_return_ids_from_bulk_insert:
+            objects.bulk_create(products)
+            return
+        # Other backends (SQLite) allow one writer at a time, so the rows
+        # inserted are those after the largest pid, in insertion order
+        last = objects.aggregate(last=Max('pid'))['last'] or 0
+        objects.bulk_create(products)
+        pids = objects.filter(pid__gt=last).order_by('pid').values_list(
+            'pid', flat=True)
+        for product, pid in zip(products, pids):
+            product.pk = pid
+
+    def _resolve_new_keys(self, keys, products):
+        """ Replaces temporary keys of inserted rows with their real pids """
+        store_pids = [self.rows[key][1] for key in keys]
+        for key in keys:
+            barcode, store_pid = self.rows.pop(key)
+            self.by_store_pid.pop(store_pid, None)
+            if barcode is not None:
+                self.by_barcode.pop(barcode, None)
+        for product, store_pid in zip(products, store_pids):
+            self._add(product.pk, product.barcode, store_pid)
+            self.listed.add(product.pk)
@@ -0,0 +1,143 @@
+"""
+Background upload of scraped product images
+"""
+import io
+import logging
+import os
+import queue
+import threading
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+
+class S3ImageStorage:
+    """
+    Uploads images to the S3 bucket used for media files. A single client is
+    shared by all upload threads (boto3 clients are thread-safe) and its
+    connection pool is sized to match.
+    """
+
+    def __init__(self, max_connections=10):
+        self.client = boto3.client(
+            's3',
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            config=Config(max_pool_connections=max_connections),
+        )
+        self.bucket = os.getenv('AWS_STORAGE_BUCKET_NAME')
+        # Images are small; concurrency comes from ImageUploader's threads
+        self.transfer_config = TransferConfig(use_threads=False)
+
+    def save(self, name, fileobj):
+        self.client.upload_fileobj(fileobj, self.bucket, name,
+                                   Config=self.transfer_config)
+
+
+class LocalImageStorage:
+    """ Stand-in for S3ImageStorage that writes images to a local directory """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def save(self, name, fileobj):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(fileobj.getbuffer())
+
+
+class ImageUploader:
+    """
+    Encodes and uploads product images on a pool of background threads so the
+    scrape never waits on a transfer. Images are encoded to JPEG in memory and
+    handed straight to the storage backend; nothing is written to MEDIA_ROOT.
+
+    The queue is bounded, so submit() blocks once `max_queued` images are
+    waiting, which keeps memory flat if uploads fall behind. close() waits
+    for every queued image to be uploaded; take_saved() then returns the
+    names of the images that made it, so products are only pointed at
+    images that exist.
+
+    Attributes
+        storage: backend with a save(name, fileobj) method
+        workers (int): number of concurrent uploads
+        max_queued (int): max images waiting to be uploaded
+        uploaded (int): number of successful uploads
+        failed (list): names of images that could not be uploaded
+
+    Usage:
+        >>> uploader = ImageUploader(S3ImageStorage())
+        >>> uploader.submit(Image, '123.jpg')
+        >>> uploader.close()
+        >>> uploader.take_saved()
+        ['123.jpg']
+    """
+    folder = 'product_images'
+
+    def __init__(self, storage, workers=4, max_queued=100):
+        self.storage = storage
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.uploaded = 0
+        self.failed = []
+        self._saved = []  # names uploaded since the last take_saved()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, image, filename):
+        """ Queues a PIL Image for upload and returns its media path """
+        if not self._threads:
+            self._start()
+        self.queue.put((image, filename))
+        return f'/{self.folder}/{filename}'
+
+    def close(self):
+        """ Waits for queued images to be uploaded and stops the threads """
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def take_saved(self):
+        """ Returns the names of the images uploaded since the last call """
+        with self._lock:
+            saved, self._saved = self._saved, []
+        return saved
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name=f'image-upload-{i}')
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            image, filename = item
+            try:
+                self.storage.save(f'{self.folder}/{filename}',
+                                  self.encode(image))
+            except Exception as e:
+                logging.info(f'image({filename}) -- {e}')
+                with self._lock:
+                    self.failed.append(filename)
+            else:
+                with self._lock:
+                    self.uploaded += 1
+                    self._saved.append(filename)
+
+    @staticmethod
+    def encode(image):
+        """ Returns an in-memory JPEG of a PIL Image """
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=95)
+        buffer.seek(0)
+        return buffer
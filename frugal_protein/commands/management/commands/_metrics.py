@@ -0,0 +1,148 @@
+"""
+Per-run metrics for the scrape command
+"""
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+
+def percentile(values, pct):
+    """ Returns the pct-th percentile (nearest rank) of a sorted list """
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * pct // 100))  # ceil without floats
+    return round(values[int(rank) - 1], 4)
+
+
+class StoreMetrics:
+    """ Counters for a single store """
+
+    def __init__(self):
+        self.products = 0
+        self.latencies = []       # seconds per request
+        self.network_time = 0.0   # sum of request latencies
+        self.wait_time = 0.0      # sum of throttle and breaker waits
+        self.db_time = 0.0        # share of write batch time
+        self.errors = Counter()   # exception class name -> count
+        self.elapsed = 0.0        # seconds from start to last result
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        rate = self.products / self.elapsed if self.elapsed else 0
+        return {
+            'products': self.products,
+            'products_per_second': round(rate, 3),
+            'elapsed': round(self.elapsed, 3),
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': percentile(latencies, 100),
+            },
+            'network_time': round(self.network_time, 3),
+            'wait_time': round(self.wait_time, 3),
+            'db_time': round(self.db_time, 3),
+            'errors': dict(self.errors),
+        }
+
+
+class ScrapeMetrics:
+    """
+    Collects request latency, throughput, db write time and errors per store
+    for one scrape run. Time spent waiting on a store's throttle or circuit
+    breaker is kept apart from request latency, as `wait_time`. All methods
+    are called from the writer thread.
+
+    A JSON summary is produced at the end of the run. If `stream` is given,
+    every scraped product and every write batch is also appended to it as a
+    JSON line while the run is in progress.
+
+    Usage:
+        >>> metrics = ScrapeMetrics(stream='metrics.jsonl')
+        >>> metrics.record_result(result)
+        >>> metrics.record_write({'tesco': 100}, 0.25)
+        >>> metrics.write_summary('summary.json')
+        >>> metrics.close()
+    """
+
+    def __init__(self, stream=None):
+        self.start = time.perf_counter()
+        self.stores = defaultdict(StoreMetrics)
+        self.info = {}  # extra values included in the summary
+        self._stream = open(stream, 'a') if stream else None
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def record_result(self, result):
+        """ Records a ScrapeResult as it comes off the engine """
+        store = self.stores[result.store]
+        store.products += 1
+        store.latencies.append(result.latency)
+        store.network_time += result.latency
+        store.wait_time += result.wait
+        store.elapsed = self.elapsed()
+        if result.error is not None:
+            store.errors[type(result.error).__name__] += 1
+        self._emit({'event': 'scrape',
+                    'store': result.store,
+                    'pid': result.product.pid,
+                    'latency': round(result.latency, 4),
+                    'wait': round(result.wait, 4),
+                    'error': (type(result.error).__name__
+                              if result.error is not None else None)})
+
+    def record_error(self, store, error):
+        """ Records an error raised while applying a result to the db """
+        self.stores[store].errors[type(error).__name__] += 1
+
+    def record_write(self, store_counts, seconds):
+        """
+        Records the time taken to write a batch, shared between stores in
+        proportion to their number of products in the batch
+        """
+        total = sum(store_counts.values())
+        for store, count in store_counts.items():
+            self.stores[store].db_time += seconds * count / total
+        self._emit({'event': 'write',
+                    'products': total,
+                    'seconds': round(seconds, 4)})
+
+    def summary(self):
+        stores = {store: m.summary() for store, m in sorted(self.stores.items())}
+        total = sum(m.products for m in self.stores.values())
+        elapsed = self.elapsed()
+        errors = Counter()
+        for m in self.stores.values():
+            errors.update(m.errors)
+        return dict(self.info, **{
+            'elapsed': round(elapsed, 3),
+            'products': total,
+            'products_per_second': round(total / elapsed, 3) if elapsed else 0,
+            'network_time': round(sum(m.network_time
+                                      for m in self.stores.values()), 3),
+            'wait_time': round(sum(m.wait_time
+                                   for m in self.stores.values()), 3),
+            'db_time': round(sum(m.db_time for m in self.stores.values()), 3),
+            'errors': dict(errors),
+            'stores': stores,
+        })
+
+    def write_summary(self, path):
+        summary = self.summary()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _emit(self, event):
+        if self._stream is not None:
+            event['t'] = round(self.elapsed(), 4)
+            self._stream.write(json.dumps(event) + '\n')
+            self._stream.flush()
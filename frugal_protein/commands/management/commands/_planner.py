@@ -0,0 +1,74 @@
+"""
+Works out which info values need to be scraped for each product
+"""
+from collections import Counter
+
+
+class ScrapePlanner:
+    """
+    Inspects products for empty fields and plans an info scrape that only asks
+    fps.scrape_infos for the values that are missing. The checks mirror the
+    fill-only-if-empty rules of InfoStage.merge, so anything the planner
+    skips would have been discarded anyway.
+
+    Each planned product is given a `scrape_fields` attribute holding the
+    space separated `exclusive` string for its scrape. Products with nothing
+    to fetch are left out of the plan.
+
+    Attributes
+        fields (tuple): info values that fps.scrape_infos can return
+        requested (set): values requested by the operator via -e/-E
+        refresh (bool): also plan prices and nutrition of complete products
+        groups (Counter): number of planned products per set of fields
+
+    Usage:
+        >>> planner = ScrapePlanner(exclusive='', exclude='image')
+        >>> products = planner.plan(ProductInfo.objects.all(), 'tesco')
+        >>> products[0].scrape_fields
+        'nutrition price'
+    """
+    fields = ('description', 'brand', 'qty', 'nutrition', 'price', 'image')
+    refreshed = ('nutrition', 'price')  # always scraped in refresh mode
+
+    def __init__(self, exclusive='', exclude='', refresh=False):
+        self.requested = set(exclusive.split()) or set(self.fields)
+        self.requested -= set(exclude.split())
+        self.refresh = refresh
+        self.groups = Counter()
+
+    def missing(self, product, store):
+        """ Returns the set of requested info values to scrape """
+        gaps = set(self.empty(product, store))
+        if self.refresh:
+            gaps |= set(self.refreshed) & self.requested
+        return frozenset(gaps)
+
+    def empty(self, product, store):
+        """ Returns the set of requested info values the product lacks """
+        gaps = set()
+        if not product.description:
+            gaps.add('description')
+        if not product.brand_id:
+            gaps.add('brand')
+        if not product.qty:
+            gaps.add('qty')
+        if not product.protein:
+            gaps.add('nutrition')
+        listing = product.listing(store)
+        if listing is None or not listing.base:
+            gaps.add('price')
+        if not product.img or product.img.name.endswith('default.png'):
+            gaps.add('image')
+        return frozenset(gaps & self.requested)
+
+    def plan(self, products, store):
+        """ Returns the products that need scraping, with scrape_fields set """
+        planned = []
+        for product in products:
+            gaps = self.missing(product, store)
+            if not gaps:
+                continue
+            product.scrape_fields = ' '.join(sorted(gaps))
+            self.groups[product.scrape_fields] += 1
+            planned.append(product)
+        return planned
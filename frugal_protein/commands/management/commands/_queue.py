@@ -0,0 +1,155 @@
+"""
+DB-backed work queue that lets several `scrape info --worker` processes share
+an info scrape
+"""
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from commands.models import ScrapeTask
+
+
+class WorkQueue:
+    """
+    Queue of (store, pid) tasks in the ScrapeTask table. Workers lease batches
+    of tasks with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers
+    never lease the same rows, and hold them for `ttl` seconds unless the
+    lease is renewed. Tasks of a worker that dies are leased again by another
+    worker once the lease has expired.
+
+    Every lease counts as an attempt. A task that has been leased
+    max_attempts times, and failed or was never completed, is given up:
+    it is deleted and logged, and counted in `given_up`.
+
+    Attributes
+        database (str): db alias whose products are queued
+        owner (str): identifies this worker (host:pid)
+        ttl (int): lease length in seconds
+        given_up (int): tasks this worker dropped after max_attempts
+
+    Usage:
+        >>> queue = WorkQueue('default')
+        >>> queue.enqueue('tesco', pids)
+        >>> tasks = queue.lease(50)
+        >>> queue.renew(tasks)
+        >>> queue.complete(tasks)
+    """
+    max_attempts = 3
+
+    def __init__(self, database, ttl=300, owner=None):
+        self.database = database
+        self.ttl = ttl
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.given_up = 0
+
+    def enqueue(self, store, pids):
+        """
+        Queues pids for a store and returns how many were added; already
+        queued pids are ignored
+        """
+        tasks = [ScrapeTask(pid=pid, store=store, database=self.database)
+                 for pid in pids]
+        queued = ScrapeTask.objects.filter(database=self.database, store=store)
+        with transaction.atomic():
+            before = queued.count()
+            ScrapeTask.objects.bulk_create(tasks, ignore_conflicts=True)
+            return queued.count() - before
+
+    def lease(self, size):
+        """
+        Leases up to `size` free or expired tasks, in pid order. Expired
+        tasks on their last attempt are given up instead.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            expired = Q(lease_expires__lt=now)
+            self._give_up(ScrapeTask.objects.filter(
+                expired, database=self.database,
+                attempts__gte=self.max_attempts))
+            tasks = list(
+                ScrapeTask.objects.select_for_update(skip_locked=True)
+                .filter(database=self.database,
+                        attempts__lt=self.max_attempts)
+                .filter(Q(lease_expires__isnull=True) | expired)
+                .order_by('pid')[:size]
+            )
+            ScrapeTask.objects.filter(pk__in=[t.pk for t in tasks]).update(
+                lease_owner=self.owner,
+                lease_expires=now + timedelta(seconds=self.ttl),
+                attempts=F('attempts') + 1,
+            )
+        for task in tasks:
+            task.lease_owner = self.owner
+            task.attempts += 1
+        return tasks
+
+    def _owned(self, tasks):
+        return ScrapeTask.objects.filter(pk__in=[t.pk for t in tasks],
+                                         lease_owner=self.owner,
+                                         lease_expires__gte=timezone.now())
+
+    def renew(self, tasks):
+        """ Extends the lease on tasks still held; returns how many are held """
+        expires = timezone.now() + timedelta(seconds=self.ttl)
+        return self._owned(tasks).update(lease_expires=expires)
+
+    def held(self, tasks):
+        """ Returns the pks of tasks whose lease is still held """
+        return set(self._owned(tasks).values_list('pk', flat=True))
+
+    def complete(self, tasks):
+        """ Removes finished tasks that are still leased by this worker """
+        return self._owned(tasks).delete()[0]
+
+    def release(self, tasks):
+        """
+        Frees failed tasks for another attempt, or drops them once they have
+        used up max_attempts
+        """
+        owned = self._owned(tasks)
+        self._give_up(owned.filter(attempts__gte=self.max_attempts))
+        return owned.update(lease_owner=None, lease_expires=None)
+
+    def _give_up(self, tasks):
+        """ Logs and deletes tasks that used up their attempts """
+        for store, pid in tasks.values_list('store', 'pid'):
+            logging.info(f'{store}({pid}) -- given up after '
+                         f'{self.max_attempts} attempts')
+        self.given_up += tasks.delete()[0]
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Renews the lease on a batch of tasks every third of the ttl until stopped.
+
+    Usage:
+        >>> with LeaseKeeper(queue, tasks):
+        ...     scrape(tasks)
+    """
+
+    def __init__(self, queue, tasks):
+        super().__init__(name='lease-keeper', daemon=True)
+        self.queue = queue
+        self.tasks = tasks
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.wait(self.queue.ttl / 3):
+                self.queue.renew(self.tasks)
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,212 @@
+"""
+Merges duplicate products recorded as IdConflicts by the id scrape
+"""
+from django.db import connections, transaction
+
+from commands.models import IdConflict, ScrapeTask
+from products.models import ProductInfo, StoreListing
+from ._scrape import ScrapeHandler
+
+
+class UnionFind:
+    """
+    Disjoint sets with union by size and path halving.
+
+    Usage:
+        >>> sets = UnionFind()
+        >>> sets.union(1, 2)
+        >>> sets.union(3, 2)
+        >>> sets.groups()
+        [[1, 2, 3]]
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, item):
+        parent = self.parent
+        if item not in parent:
+            parent[item] = item
+            self.size[item] = 1
+            return item
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+    def groups(self):
+        """ Returns each set as a sorted list """
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return [sorted(group) for group in groups.values()]
+
+
+class ProductReconciler:
+    """
+    Finds the products that IdConflicts show to be duplicates and merges each
+    set of duplicates into one ProductInfo row.
+
+    Every barcode and store pid is loaded in one query and each conflict
+    becomes an edge between the row holding its barcode and the row holding
+    its store pid. Connected components of those edges (found with union-find)
+    are the duplicates. Each component is kept as its lowest pid, which takes
+    the first non-empty value of every field from the rows in pid order.
+    Quantity and nutrition fields are taken as whole groups, from the first
+    row with a qty or protein, like the scrape fills them, so values from
+    different rows are never mixed. The other rows are deleted, after their
+    StoreListings move to the kept row (or are dropped where it already
+    lists the store). All writes are done in one transaction, with the
+    merged rows written by a single executemany of one UPDATE statement
+    (QuerySet.bulk_update builds a CASE per field and row, which is far too
+    slow for thousands of rows).
+
+    Attributes
+        using (str): db alias listed under settings.DATABASES
+
+    Usage:
+        >>> reconciler = ProductReconciler('default')
+        >>> components = reconciler.components()
+        >>> reconciler.merge(components)
+    """
+    batch_size = 500  # pids per IN clause; SQLite allows 999 parameters
+    # Fields merged together, from the first row whose key field is set
+    groups = ((ScrapeHandler.qty_fields, 'qty'),
+              (ScrapeHandler.nutrition_fields, 'protein'))
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.conflicts = IdConflict.objects.filter(database=using)
+
+    def components(self):
+        """ Returns lists of duplicate pids, each sorted """
+        by_barcode = dict(ProductInfo.objects.using(self.using).filter(
+            barcode__isnull=False).values_list('barcode', 'pid'))
+        by_store_pid = {
+            (store, store_pid): pid for store, store_pid, pid in
+            StoreListing.objects.using(self.using).values_list(
+                'store_id', 'pid', 'product_id')
+        }
+
+        sets = UnionFind()
+        edges = self.conflicts.values_list('barcode', 'store', 'store_pid')
+        for barcode, store, store_pid in edges:
+            a = by_barcode.get(barcode)
+            b = by_store_pid.get((store, store_pid))
+            if a is not None and b is not None and a != b:
+                sets.union(a, b)
+        return [group for group in sets.groups() if len(group) > 1]
+
+    def merge(self, components):
+        """
+        Merges each component into its lowest pid and clears the conflicts.
+        Returns the number of rows deleted.
+        """
+        fields = [f for f in ProductInfo._meta.concrete_fields
+                  if not f.primary_key]
+        grouped = {name for names, _ in self.groups for name in names}
+        pids = [pid for group in components for pid in group]
+        rows = {}
+        for chunk in self._chunks(pids):
+            for row in self._objects().filter(pid__in=chunk).values():
+                rows[row['pid']] = row
+
+        survivors, removed = [], []
+        keep = {}  # removed pid -> surviving pid
+        for group in components:
+            group = [pid for pid in group if pid in rows]
+            if len(group) < 2:
+                continue
+            merged = dict(rows[group[0]])
+            for pid in group[1:]:
+                row = rows[pid]
+                for names, key in self.groups:
+                    if not merged[key] and row[key]:
+                        merged.update((name, row[name]) for name in names)
+                for field in fields:
+                    name = field.attname
+                    if name not in grouped and self._empty(merged[name]):
+                        merged[name] = row[name]
+            survivors.append(merged)
+            removed.extend(group[1:])
+            keep.update((pid, group[0]) for pid in group[1:])
+        moved, dropped = self._move_listings(keep)
+
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+            qn(ProductInfo._meta.db_table),
+            ', '.join(f'{qn(f.column)} = %s' for f in fields),
+            qn(ProductInfo._meta.pk.column))
+        params = [[f.get_db_prep_save(row[f.attname], connection)
+                   for f in fields] + [row['pid']]
+                  for row in survivors]
+        listing_table = qn(StoreListing._meta.db_table)
+        with transaction.atomic(using=self.using):
+            # Duplicates go first so that their unique ids can move over
+            for chunk in self._chunks(dropped):
+                self._listings().filter(pk__in=chunk).delete()
+            if moved:
+                with connection.cursor() as cursor:
+                    cursor.executemany(
+                        f'UPDATE {listing_table} SET product_id = %s '
+                        f'WHERE id = %s', moved)
+            for chunk in self._chunks(removed):
+                self._objects().filter(pid__in=chunk).delete()
+            if params:
+                with connection.cursor() as cursor:
+                    cursor.executemany(sql, params)
+        for chunk in self._chunks(removed):
+            ScrapeTask.objects.filter(database=self.using,
+                                      pid__in=chunk).delete()
+        self.conflicts.delete()
+        return len(removed)
+
+    def _move_listings(self, keep):
+        """
+        Returns [surviving pid, listing id] pairs for the listings of removed
+        rows that move to the kept row, and the ids of those dropped because
+        a row of the group already lists the store (the lowest pid wins)
+        """
+        listings = []
+        pids = list(keep) + sorted(set(keep.values()))
+        for chunk in self._chunks(pids):
+            listings.extend(self._listings().filter(
+                product_id__in=chunk).values_list('id', 'product_id',
+                                                  'store_id'))
+        moved, dropped, listed = [], [], set()
+        for id_, pid, store in sorted(listings, key=lambda l: l[1]):
+            survivor = keep.get(pid, pid)
+            if (survivor, store) in listed:
+                dropped.append(id_)
+                continue
+            listed.add((survivor, store))
+            if survivor != pid:
+                moved.append([survivor, id_])
+        return moved, dropped
+
+    def _listings(self):
+        return StoreListing.objects.using(self.using)
+
+    def _objects(self):
+        return ProductInfo.objects.using(self.using)
+
+    def _chunks(self, items):
+        for i in range(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
+
+    @staticmethod
+    def _empty(value):
+        return (value is None or value == '' or
+                (isinstance(value, str) and value.endswith('default.png')))
@@ -0,0 +1,133 @@
+"""
+Staleness-based scheduling of info scrapes for `scrape daemon`
+"""
+import heapq
+from collections import defaultdict
+from datetime import timedelta
+
+from django.utils import timezone
+
+from commands.models import StoreScrape
+from products.models import StoreListing
+
+
+class ScrapeHistory:
+    """
+    Records when each product and each store's ids were last scraped (see
+    StoreListing.scraped_at and StoreScrape). Only successful scrapes are
+    recorded, so that ScrapeScheduler picks failed ones up again.
+
+    Usage:
+        >>> history = ScrapeHistory('default')
+        >>> history.record_products('tesco', [1, 2])
+        >>> history.record_store('tesco')
+        >>> history.store_due('tesco', timedelta(hours=24))
+        False
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def record_products(self, store, pids):
+        """ Stamps the store's listings of pids as scraped now """
+        StoreListing.objects.using(self.database).filter(
+            store=store, product_id__in=pids
+        ).update(scraped_at=timezone.now())
+
+    def store_due(self, store, interval):
+        """ Returns True if the store's ids were not scraped within interval """
+        scraped = StoreScrape.objects.filter(
+            database=self.database, store=store
+        ).values_list('scraped', flat=True).first()
+        return scraped is None or timezone.now() - scraped >= interval
+
+    def record_store(self, store):
+        StoreScrape.objects.update_or_create(
+            database=self.database, store=store,
+            defaults={'scraped': timezone.now()})
+
+
+class ScrapeScheduler:
+    """
+    Priority queue of product info scrapes. Each (store, product) is scored
+    by:
+
+        staleness - time since its last scrape as a multiple of stale_after
+                    (`never_scraped` if it has no scrape on record)
+        missing   - missing_weight per info value it lacks (see ScrapePlanner)
+        value     - up to value_weight for products with a low £/10g protein,
+                    full weight at or below `good_value`
+
+    Products are due once they are older than stale_after, or older than
+    retry_after if they still lack values, so that products a store never
+    has a value for are not scraped over and over. The highest scores are
+    scraped first.
+
+    Attributes
+        planner (ScrapePlanner): decides which values each scrape fetches
+        stale_after (timedelta): age at which every product is due
+        retry_after (timedelta): age at which incomplete products are due
+
+    Usage:
+        >>> scheduler = ScrapeScheduler(planner)
+        >>> scheduler.push('tesco', products)
+        >>> jobs = scheduler.pop(50)  # store -> products, best first
+    """
+    never_scraped = 2.0
+    missing_weight = 0.25
+    value_weight = 1.0
+    good_value = 0.25  # £ per 10g protein
+
+    def __init__(self, planner, stale_after=timedelta(hours=24),
+                 retry_after=None):
+        self.planner = planner
+        self.stale_after = stale_after
+        self.retry_after = retry_after or stale_after / 4
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def score(self, product, store, scraped, now):
+        """ Returns the priority of a scrape, or None if it isn't due """
+        empty = self.planner.empty(product, store)
+        if scraped is None:
+            staleness = self.never_scraped
+        else:
+            age = now - scraped
+            if age < (self.retry_after if empty else self.stale_after):
+                return None
+            staleness = age / self.stale_after
+        score = staleness + self.missing_weight * len(empty)
+        price = product.cheapest_price(store)
+        if price:
+            score += self.value_weight * min(1, self.good_value / float(price))
+        return score
+
+    def push(self, store, products):
+        """
+        Scores a store's products and queues those that are due. Products
+        should have their listings prefetched (see ProductInfo.listing).
+        """
+        now = timezone.now()
+        for product in products:
+            scraped = product.listing(store).scraped_at
+            score = self.score(product, store, scraped, now)
+            if score is None or not self.planner.missing(product, store):
+                continue
+            # pid and store break ties, so products are never compared
+            heapq.heappush(self.heap, (-score, product.pid, store, product))
+
+    def pop(self, n):
+        """
+        Returns up to n of the highest priority scrapes as store -> products,
+        with scrape_fields set by the planner
+        """
+        jobs = defaultdict(list)
+        for _ in range(min(n, len(self.heap))):
+            _, _, store, product = heapq.heappop(self.heap)
+            jobs[store].extend(self.planner.plan([product], store))
+        return dict(jobs)
+
+    def clear(self):
+        self.heap = []
@@ -1,29 +1,47 @@
 """
 Collection of functions to implement the scrape command
 """
-import io
 import logging
 import os
-from datetime import date
+import time
+from collections import Counter
+from datetime import date, timedelta
 
-import boto3
-
-from django.core.files import File
 from django.core.management.base import CommandError
-from django.db.models import Q
+from django.db import DatabaseError
+from django.db.models import Prefetch
 
-import frugal_protein_scrapers as fps
 from frugal_protein import settings
-from products.models import ProductInfo, Brands
+from products.models import (Brands, CatalogVersion, ProductInfo, Store,
+                             StoreListing)
+from ._brands import BrandResolver
+from ._cache import ResponseCache
+from ._checkpoint import RunCheckpoint
+from ._concurrent import FetchTiming, IdScrapePipeline, InfoScrapeEngine
+from ._ids import IdIndex
+from ._images import ImageUploader, LocalImageStorage, S3ImageStorage
+from ._metrics import ScrapeMetrics
+from ._planner import ScrapePlanner
+from ._queue import LeaseKeeper, WorkQueue
+from ._scheduler import ScrapeHistory, ScrapeScheduler
+from ._staging import InfoStage
+from ._throttle import StoreThrottle
+
+
+# Directory for scrape logs
+LOG_DIR = os.path.join(settings.BASE_DIR, 'commands', 'logs')
 
+# Default directory for recorded scraper responses (see ResponseCache)
+CACHE_DIR = os.path.join(settings.BASE_DIR, 'commands', 'cache')
 
-# Setup logging
-filename = f'{date.today()}_infoscrape.log'
-filepath = os.path.join(settings.BASE_DIR, 'commands', 'logs', filename)
-logging.basicConfig(filename=filepath,level=logging.INFO)
 
-# Lists all stores that is currently supported (i.e. stores that can be scraped)
-STORES = frozenset(['tesco', 'iceland'])
+def setup_logging():
+    """ Log scrape failures to a dated file in LOG_DIR """
+    filename = f'{date.today()}_infoscrape.log'
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(LOG_DIR, filename),
+                        level=logging.INFO)
+
 
 class Util:
     """ 
@@ -33,6 +51,11 @@ class Util:
     def stringify(lst):
         return ' '.join(lst).lower() if lst is not None else ''
 
+    @staticmethod
+    def hours(value):
+        """ Converts hours to seconds, passing None through """
+        return value * 3600 if value is not None else None
+
     @staticmethod
     def valid_id_dict(id_dict):
         """ id_dict containing empty values should return False """
@@ -47,44 +70,10 @@ class Util:
 
     @staticmethod
     def get_brand_obj(brand):
-        """ Returns a Brands object """
-        existing_brand = Brands.objects.filter(brand=brand)
-        if existing_brand:
-            return existing_brand[0]
-        else:
-            return Brands.objects.create(brand=brand)
-
-    @staticmethod
-    def prepend_dict_keys(price_dict, store):
-        """ Prepend dict keys with store name """
-        new_price_dict = {}
-        for k in price_dict:
-            new_price_dict[f'{store}_{k}'] = price_dict[k]
-        return new_price_dict
-
-    @staticmethod
-    def save_local_img(Image, filename):
-        """ Save an Image file to local media directory and return path """
-        path = os.path.join(settings.MEDIA_ROOT, 'product_images', filename)
-        Image.save(path, formate='JPEG', quality=95)
-        return 
-    
-    @staticmethod
-    def upload_to_s3(filename):
-        """ Upload media file to S3 bucket """
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        )
-        path = os.path.join(settings.BASE_DIR, 'media', 'product_images', 
-                            filename)
-        bucket = os.getenv('AWS_STORAGE_BUCKET_NAME')
-        destination = f'product_images/{filename}'
-        try:
-            s3.upload_file(path, bucket, destination)
-        except Exception as e:
-            raise Exception(e)
+        """ Returns a Brands object (see BrandResolver for bulk lookups) """
+        brand_obj, _ = Brands.objects.get_or_create(
+            brand_key=Brands.normalise(brand), defaults={'brand': brand})
+        return brand_obj
 
 
 class ScrapeHandler:
@@ -95,129 +84,459 @@ class ScrapeHandler:
         >>> handler = ScrapeHandler(*args, **options)
         >>> handler.execute_id_scrape()
         >>> handler.execute_info_scrape()
+
+        Or, to share an info scrape between processes/hosts:
+        >>> handler.execute_enqueue()  # once
+        >>> handler.execute_worker()   # in each worker
+
+        Or, to keep scraping the most useful products within a budget:
+        >>> handler.execute_daemon()
+
+    Scraper calls go through ResponseCache, which can record responses to
+    disk and replay them later without hitting the stores.
+
+    Id scrapes fetch pages of ids for all stores in parallel through
+    IdScrapePipeline, while each page is reconciled against an in-memory
+    IdIndex and written back in bulk.
+
+    Info scrapes only fetch the values each product is missing (see
+    ScrapePlanner), plus prices and nutrition when `refresh` is set, and run
+    through InfoScrapeEngine: stores are scraped in parallel,
+    each with up to `workers` requests in flight, while all db writes happen
+    on the calling thread. Each store has its own adaptive StoreThrottle, so
+    a store that slows down or fails is paused without holding up the
+    others. Progress is checkpointed after every write batch
+    so that an interrupted run can be resumed, and the throughput is printed
+    at the end; with `metrics` the ScrapeMetrics summary is also written to
+    that JSON file. Product images are uploaded in the background by
+    ImageUploader, to S3 or, with `image_dir`, to a local directory. Every
+    run (and daemon cycle) ends by bumping the CatalogVersion, which drops
+    cached search results.
     """
     util = Util
+    write_batch_size = 500  # scrape results applied to the db at a time
+    max_attempts = 3  # per product, when a store's circuit breaker trips
+    qty_fields = ('qty', 'num_of_units', 'total_qty', 'unit_of_measurement')
+    nutrition_fields = ('header', 'kcal', 'fat', 'carb', 'protein')
 
     def __init__(self, *args, **options):
         # self.type = options['type'][0] # str
-        self.stores = options['stores'] or STORES # list
         self.live = options['live'] # bool
+        self.db = 'live' if self.live else 'default' # str
+        # Stores come from the Store registry; see Store
+        stores = Store.names(self.db)
+        self.stores = options['stores'] or sorted(stores) # list
+        unknown = set(self.stores) - stores
+        if unknown:
+            raise CommandError(f'unknown stores: {", ".join(sorted(unknown))}')
         self.exclusive = self.util.stringify(options['exclusive']) # str
         self.exclude = self.util.stringify(options['exclude']) # str
+        self.workers = options.get('workers') or 1 # int
+        self.refresh = options.get('refresh', False) # bool
+        self.planner = ScrapePlanner(self.exclusive, self.exclude,
+                                     refresh=self.refresh)
+        self.write_counts = Counter()
+        self.resume = options.get('resume', False) # bool
+        self.checkpoint = None # RunCheckpoint, set per info scrape
+        self.history = None # ScrapeHistory, set per info scrape
+        self.metrics = None # ScrapeMetrics, set per info scrape
+        self.metrics_path = options.get('metrics') # str
+        self.metrics_stream = options.get('metrics_stream') # str
+        self.lease_size = options.get('lease_size') or 50 # int
+        self.lease_ttl = options.get('lease_ttl') or 300 # int, seconds
+        self.budget = options.get('budget') or 600 # int, requests/hour
+        self.interval = options.get('interval', 300) # float, seconds
+        self.cycles = options.get('cycles') # int, None = run forever
+        self.stale_after = options.get('stale_after') or 24 # float, hours
+        self.id_interval = options.get('id_interval') or 24 # float, hours
+        self.cache = ResponseCache(options.get('cache_dir') or CACHE_DIR,
+                                   mode=options.get('cache') or 'passthrough',
+                                   ttl=self.util.hours(options.get('cache_ttl')))
+        evicted = self.cache.evict()
+        if evicted:
+            print(f'{evicted} expired responses evicted from cache')
+        # Replayed responses don't touch the stores, so need no throttling
+        rate = options.get('rate') # float, requests/s per store
+        self.throttles = {} # store -> StoreThrottle
+        if rate and self.cache.mode != 'replay':
+            self.throttles = {store: StoreThrottle(rate=rate)
+                              for store in self.stores}
+        self.brands = BrandResolver(using=self.db)
+        image_dir = options.get('image_dir')
+        storage = LocalImageStorage(image_dir) if image_dir else S3ImageStorage()
+        self.images = ImageUploader(storage)
+        self.image_pids = {} # image filename -> pid, of queued uploads
 
     def execute_id_scrape(self):
-        for store in self.stores:
-            for id_dicts in fps.scrape_ids(store):
-                for id_dict in id_dicts:
-                    if self.util.valid_id_dict(id_dict):
-                        self._update_ids(id_dict, store)
-                
+        self._scrape_ids(self.stores)
+        CatalogVersion.bump(self.db)
+
+    def _scrape_ids(self, stores):
+        """
+        Scrapes the ids of stores and returns the number of pages requested.
+        A store whose scrape fails is logged and the others carry on.
+        """
+        # Ids are reconciled in memory, a page at a time, while the next
+        # pages are fetched. The stores share one barcode map so that a
+        # product new to several stores is only inserted once.
+        barcodes = {}
+        indexes = {store: IdIndex.load(store, using=self.db,
+                                       by_barcode=barcodes)
+                   for store in stores}
+        counts = {store: Counter() for store in stores}
+        failed = set()
+        pipeline = IdScrapePipeline(self.cache.scrape_ids)
+        for page in pipeline.run(stores):
+            store = page.store
+            if page.error is not None:
+                logging.info(f'{store} -- {page.error}')
+                failed.add(store)
+                continue
+            id_dicts = [d for d in page.id_dicts if self.util.valid_id_dict(d)]
+            inserted, updated = indexes[store].apply(id_dicts)
+            counts[store].update(pages=1, inserted=inserted, updated=updated)
+
+        history = ScrapeHistory(self.db)
+        for store in stores:
+            c = counts[store]
+            print(f'{store}: {c["inserted"]} products inserted,',
+                  f'{c["updated"]} updated,',
+                  f'{pipeline.duplicates[store]} duplicates skipped',
+                  '(failed, see log)' if store in failed else '')
+            if store not in failed:
+                history.record_store(store)
+        return sum(c['pages'] for c in counts.values())
 
     def execute_info_scrape(self):
+        self.history = ScrapeHistory(self.db)
+        self.checkpoint = RunCheckpoint.start(self.stores, self.db,
+                                              resume=self.resume)
+
+        # Products are read and planned up front so that worker threads never
+        # touch the db. Products with nothing missing are skipped, as are
+        # products already processed by the run being resumed.
+        jobs = {}
         for store in self.stores:
-            store_filter = {f'{store}__isnull': False}
-            if self.live:
-                products = ProductInfo.objects.using('live').filter(**store_filter)
-            else:
-                products = ProductInfo.objects.filter(**store_filter)
-            for product in products[:1]:
-                pid = getattr(product, store)
-                try:
-                    info_dict = fps.scrape_infos(pid, store, 
-                                                exclusive=self.exclusive, 
-                                                exclude=self.exclude)
-                    self._update_infos(info_dict, product, store)
-                except Exception as e:
-                    logging.info(f'{store}({pid}) -- {e}')
+            last_pid = self.checkpoint.last_pid(store)
+            products = list(self._get_products(store, after_pid=last_pid))
+            jobs[store] = self.planner.plan(products, store)
+            self.checkpoint.plan(store, [p.pid for p in jobs[store]])
+            print(f'{store}: {len(jobs[store])} products to scrape,',
+                  f'{len(products) - len(jobs[store])} already complete',
+                  f'(resuming after pid {last_pid})' if last_pid else '')
+
+        self._start_metrics(run_id=self.checkpoint.run.run_id)
+        try:
+            self._run_jobs(jobs)
+        finally:
+            self._close()
+        self.checkpoint.finish()
+        self._report()
 
+    def execute_enqueue(self):
+        """ Queues products that need scraping for `scrape info --worker` """
+        queue = WorkQueue(self.db)
+        for store in self.stores:
+            products = self.planner.plan(list(self._get_products(store)), store)
+            queued = queue.enqueue(store, [p.pid for p in products])
+            print(f'{store}: {queued} products queued')
 
-    def _update_ids(self, id_dict, store):
-        if not self.util.valid_id_dict(id_dict):
-            return
-        # pid key is renamed to store name to match model field
-        id_dict[store] = id_dict.pop('pid')
-        barcode = id_dict['barcode']
-        store_pid = id_dict[store]
+    def execute_worker(self):
+        """ Leases batches of queued products and scrapes them until done """
+        queue = WorkQueue(self.db, ttl=self.lease_ttl)
+        self.history = ScrapeHistory(self.db)
+        self._start_metrics(worker=queue.owner)
+        try:
+            while True:
+                tasks = queue.lease(self.lease_size)
+                if not tasks:
+                    break
+                with LeaseKeeper(queue, tasks):
+                    self._run_tasks(queue, tasks)
+        finally:
+            self._close()
+        if queue.given_up:
+            print(f'{queue.given_up} products given up after',
+                  f'{queue.max_attempts} attempts (see log)')
+        self._report()
 
+    def execute_daemon(self):
+        """
+        Scrapes continuously, spending at most `budget` requests an hour.
+        Every `interval` seconds a store's ids are scraped if they are older
+        than id_interval, and the rest of the cycle's requests go to the
+        products ScrapeScheduler ranks highest. Prices and nutrition are
+        refreshed on every product scraped.
+        """
+        self.refresh = self.planner.refresh = True
+        self.history = ScrapeHistory(self.db)
+        scheduler = ScrapeScheduler(
+            self.planner, stale_after=timedelta(hours=self.stale_after))
+        per_cycle = self.budget * self.interval / 3600
+        allowance = 0  # requests left this cycle; negative when overspent
+        cycle = 0
+        self._start_metrics(daemon=True, budget=self.budget)
         try:
-            if self.live:
-                product = ProductInfo.objects.using('live').get(
-                    Q(barcode=barcode) | Q(**{store:store_pid})
-                )
-            else:
-                product = ProductInfo.objects.get(
-                    Q(barcode=barcode) | Q(**{store:store_pid})
-                )
-        except ProductInfo.DoesNotExist:
-            ProductInfo.objects.create(**id_dict)
-        except ProductInfo.MultipleObjectsReturned:
-            # If multiple objects returned, it means that there exists multiple
-            # products that share either the same barcode but not store pid or 
-            # vice versa. 
-            # This should not happen, but if it does, log it for further
-            # investigation as it may indicate poor db integrity.
-            # TODO
-            pass
-        else:
-            store_field = getattr(product, store)
-            if product.barcode and not store_field:
-                setattr(product, store, store_pid)
-                if self.live:
-                    product.save(using='live')
-                else:
-                    product.save()
-            elif not product.barcode and store_field:
-                product.barcode = barcode
-                if self.live:
-                    product.save(using='live')
-                else:
-                    product.save()
-
-    
-    def _update_infos(self, info_dict, product, store):
+            while self.cycles is None or cycle < self.cycles:
+                start = time.monotonic()
+                # Unspent requests are not saved up beyond one cycle
+                allowance = min(per_cycle, allowance + per_cycle)
+                for store in self.stores:
+                    due = timedelta(hours=self.id_interval)
+                    if self.history.store_due(store, due):
+                        allowance -= self._scrape_ids([store])
+
+                scheduler.clear()
+                for store in self.stores:
+                    scheduler.push(store, self._get_products(store))
+                jobs = scheduler.pop(max(0, int(allowance)))
+                scraped = sum(map(len, jobs.values()))
+                allowance -= scraped
+                if jobs:
+                    self._run_jobs(jobs)
+                    # Flush images so that uploads keep up between cycles
+                    self._save_images()
+                print(f'cycle {cycle}: {scraped} products scraped,',
+                      f'{len(scheduler)} more due')
+                # Cached searches of the catalog are dropped every cycle
+                CatalogVersion.bump(self.db)
+
+                cycle += 1
+                if self.cycles is None or cycle < self.cycles:
+                    time.sleep(max(0, self.interval -
+                                   (time.monotonic() - start)))
+        finally:
+            self._close()
+        self._report()
+
+    def _run_tasks(self, queue, tasks):
+        """ Scrapes a leased batch of ScrapeTasks """
+        by_key = {(t.store, t.pid): t for t in tasks}
+        jobs = {}
+        for store in {t.store for t in tasks}:
+            pids = [t.pid for t in tasks if t.store == store]
+            products = self._get_products(store).filter(pid__in=pids)
+            jobs[store] = self.planner.plan(list(products), store)
+
+        def keep(results):
+            # Drop results of tasks whose lease expired and may have been
+            # taken over by another worker
+            held = queue.held(tasks)
+            return [r for r in results
+                    if by_key[(r.store, r.product.pid)].pk in held]
+
+        failed = self._run_jobs(jobs, keep=keep)
+        queue.release([by_key[key] for key in failed])
+        queue.complete([t for key, t in by_key.items() if key not in failed])
+
+    def _run_jobs(self, jobs, keep=None):
         """ 
-        Updates row by replacing empty field values with scraped values 
-        See ProductInfo model for attribute names.
+        Scrapes jobs (store -> products) and writes the results in batches.
+        Returns the (store, pid) of products that failed.
+
+        Args:
+            keep (callable): optional filter applied to a batch of results
+                             before it is written
+        """
+        engine = InfoScrapeEngine(self._fetch_infos, workers=self.workers)
+        failed = set()
+        batch = []
+        for result in engine.run(jobs):
+            batch.append(result)
+            self.metrics.record_result(result)
+            if len(batch) >= self.write_batch_size:
+                failed |= self._write_results(keep(batch) if keep else batch)
+                batch = []
+        failed |= self._write_results(keep(batch) if keep else batch)
+        return failed
+
+    def _start_metrics(self, **info):
+        self.metrics = ScrapeMetrics(stream=self.metrics_stream)
+        self.metrics.info.update(info, database=self.db, workers=self.workers,
+                                 refresh=self.refresh)
+
+    def _close(self):
+        # Flush image uploads still in the queue
+        self._save_images()
+        self.metrics.close()
+
+    def _report(self):
+        # The run is over; cached searches of the catalog are now stale
+        CatalogVersion.bump(self.db)
+        self.metrics.info['throttle'] = {
+            store: {'rate': round(t.rate, 3), 'trips': t.breaker.trips}
+            for store, t in self.throttles.items()
+        }
+        if self.metrics_path:
+            summary = self.metrics.write_summary(self.metrics_path)
+        else:
+            summary = self.metrics.summary()
+        self.report_throughput(summary)
+        print(f'rows: {self.write_counts["updated"]} updated,',
+              f'{self.write_counts["unchanged"]} unchanged,',
+              f'{self.write_counts["failed"]} failed')
+        if self.images.uploaded or self.images.failed:
+            print(f'images: {self.images.uploaded} uploaded,',
+                  f'{len(self.images.failed)} failed')
+
+    def _write_results(self, results):
+        """
+        Applies a batch of ScrapeResults to the db. Scraped values are staged
+        and merged in a few set-based statements (see InfoStage); unchanged
+        rows are not written. The run's checkpoint is saved once the rows are
+        written. Returns the (store, pid) of products that failed.
+        """
+        start = time.perf_counter()
+        # Resolve (and create) every brand in the batch in one go
+        names = [r.info_dict['brand'] for r in results
+                 if r.info_dict and r.info_dict.get('brand')]
+        if names:
+            self.brands.resolve_many(names)
+
+        failed = set()  # pids of products that failed
+        stage = InfoStage(using=self.db, refresh=self.refresh)
+        for result in results:
+            store, product = result.store, result.product
+            error = result.error
+            if error is None:
+                try:
+                    self._stage_infos(stage, result.info_dict, product, store)
+                except Exception as e:
+                    error = e
+                    if self.metrics is not None:
+                        self.metrics.record_error(store, e)
+            if error is not None:
+                pid = product.listing(store).pid
+                logging.info(f'{store}({pid}) -- {error}')
+                failed.add(product.pid)
+
+        try:
+            updated, errors = stage.merge()
+        except DatabaseError as e:
+            logging.info(f'batch -- {e}')
+            updated, errors = 0, dict.fromkeys(stage.pids(), e)
+        for pid, e in errors.items():
+            logging.info(f'product({pid}) -- {e}')
+        failed |= set(errors)
+        self.write_counts['updated'] += updated
+        self.write_counts['unchanged'] += len(stage) - updated - len(errors)
+        self.write_counts['failed'] += len(failed)
+
+        if self.checkpoint is not None:
+            for result in results:
+                pid = result.product.pid
+                self.checkpoint.record(result.store, pid, pid not in failed)
+            self.checkpoint.save()
+
+        if self.history is not None:
+            # Failed products keep their last stamp, so they stay due
+            for store in {r.store for r in results}:
+                self.history.record_products(
+                    store, [r.product.pid for r in results
+                            if r.store == store and r.product.pid not in failed])
+
+        if self.metrics is not None and results:
+            stores = Counter(r.store for r in results)
+            self.metrics.record_write(stores, time.perf_counter() - start)
+        return {(r.store, r.product.pid) for r in results
+                if r.product.pid in failed}
+
+    def _stage_infos(self, stage, info_dict, product, store):
+        """
+        Adds scraped values to an InfoStage. Brands are looked up in the
+        BrandResolver and images are queued for upload (see _queue_image);
+        the fill rules themselves are applied by the merge.
         """
-        p = product
         i = info_dict
+        brand = self.brands.get(i['brand']) if i.get('brand') else None
+        self._queue_image(i, product)
+        stage.add(store, product.pid, i, brand_id=brand and brand.pk)
+
+    def _queue_image(self, info_dict, product):
+        """
+        Queues a scraped image for upload if the product has none yet. The
+        product's img is only set by _save_images, once the upload succeeded.
+        """
+        filename = f'{product.pid}.jpg'
+        if (product.img.name.endswith('default.png') or not product.img) \
+                and info_dict.get('img') and filename not in self.image_pids:
+            self.images.submit(info_dict['img'], filename)
+            self.image_pids[filename] = product.pid
+
+    def _save_images(self):
+        """
+        Waits for queued uploads, then points products at the images that
+        were uploaded. Products whose upload failed keep the default image,
+        so a later scrape retries them.
+        """
+        self.images.close()
+        products = [ProductInfo(pid=self.image_pids[name],
+                                img=f'/{self.images.folder}/{name}')
+                    for name in self.images.take_saved()]
+        ProductInfo.objects.using(self.db).bulk_update(
+            products, ['img'], batch_size=self.write_batch_size)
+        self.image_pids.clear()
+
+    def report_throughput(self, summary):
+        """ Prints products scraped per second for each store and overall """
+        for store, m in summary['stores'].items():
+            print(f'{store}: {m["products"]} products in {m["elapsed"]:.1f}s',
+                  f'({m["products_per_second"]:.2f} products/s,',
+                  f'p50 {m["latency"]["p50"]}s, p99 {m["latency"]["p99"]}s,',
+                  f'{sum(m["errors"].values())} errors)')
+        print(f'total: {summary["products"]} products in',
+              f'{summary["elapsed"]:.1f}s',
+              f'({summary["products_per_second"]:.2f} products/s,',
+              f'{self.workers} worker(s) per store)')
 
-        if not p.description and i.get('description'):
-            p.description = i['description']
-        
-        if not p.brand and i.get('brand'):
-            p.brand = self.util.get_brand_obj(i['brand'])
-
-        if not p.qty and i.get('qty'):
-            q = i['qty']
-            p.qty = q['qty']
-            p.num_of_units = q['num_of_units']
-            p.total_qty = q['total_qty']
-            p.unit_of_measurement = q['unit_of_measurement']
-        
-        if not p.protein and i.get('nutrition'):
-            n = i['nutrition']
-            p.header = n['header']
-            p.kcal = n['kcal']
-            p.fat = n['fat']
-            p.carb = n['carb']
-            p.protein = n['protein']
-
-        # store-specific prices
-        store_price = f'{store}_base_price'
-        if not getattr(p, store_price) and i.get('price'):
-            price_dict = self.util.prepend_dict_keys(i['price'], store)
-            
-            for k, v in price_dict.items():
-                setattr(p, k, v)
-        
-        # image: save (if local) and upload to s3
-        if (p.img.name.endswith('default.png') or not p.img) and i.get('img'):
-            filename = f'{p.pid}.jpg'
-            self.util.save_local_img(i['img'], filename)
-            self.util.upload_to_s3(filename)
-
-            media_path = f'/product_images/{filename}'
-            p.img = media_path
-
-        p.save()
+    def _get_products(self, store, after_pid=0):
+        """ 
+        Returns products listed in the given store, ordered by pid so that a
+        resumed run continues where the previous one stopped. Each product's
+        listing for the store is prefetched (see ProductInfo.listing).
+        """
+        listings = StoreListing.objects.using(self.db).filter(store=store)
+        return ProductInfo.objects.using(self.db).filter(
+            listings__store=store, pid__gt=after_pid
+        ).prefetch_related(
+            Prefetch('listings', queryset=listings)
+        ).order_by('pid')
+
+    def _fetch_infos(self, product, store, timing=None):
+        """ 
+        Scrapes info for a single product; runs on a worker thread. Requests
+        are paced by the store's throttle, and a request that trips the
+        store's circuit breaker is retried once the store is resumed. The
+        time spent on requests and on throttle and breaker waits is added to
+        timing (see FetchTiming).
+        """
+        timing = timing or FetchTiming()
+        timing.latency = 0.0
+        pid = product.listing(store).pid
+        # scrape_fields is set by ScrapePlanner to the values that are missing
+        exclusive = getattr(product, 'scrape_fields', self.exclusive)
+        throttle = self.throttles.get(store)
+        attempt = 1
+        while True:
+            if throttle is not None:
+                timing.wait += throttle.acquire()
+            start = time.perf_counter()
+            try:
+                info_dict = self.cache.scrape_infos(pid, store,
+                                                    exclusive=exclusive,
+                                                    exclude=self.exclude)
+            except Exception:
+                latency = time.perf_counter() - start
+                timing.latency += latency
+                if throttle is None:
+                    raise
+                throttle.record(latency, succeeded=False)
+                if not throttle.paused or attempt >= self.max_attempts:
+                    raise
+                attempt += 1
+            else:
+                latency = time.perf_counter() - start
+                timing.latency += latency
+                if throttle is not None:
+                    throttle.record(latency, succeeded=True)
+                return info_dict
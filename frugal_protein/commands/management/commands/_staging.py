@@ -0,0 +1,228 @@
+"""
+Set-based ingestion of scraped info through a staging table
+"""
+import io
+
+from django.db import DatabaseError, connections, transaction
+
+from products.models import ProductInfo, StoreListing
+
+
+class InfoStage:
+    """
+    Collects a batch of scraped info values, loads them into a staging table
+    and merges them into ProductInfo and StoreListing with two UPDATE ... FROM
+    per store, so that a batch costs a handful of statements whatever its
+    size.
+
+    The staging table is a temporary table, which PostgreSQL doesn't write to
+    its WAL (like an unlogged table) and which is private to the connection,
+    so concurrent scrapes never see each other's rows. It is loaded with COPY
+    on PostgreSQL and a bulk INSERT elsewhere.
+
+    The merge applies the scrape's fill-only-if-empty rules: description,
+    brand and qty are only written to empty fields, while nutrition and
+    prices are also overwritten when `refresh` is set. Rows whose values
+    would not change are not written.
+
+    Attributes
+        using (str): db alias listed under settings.DATABASES
+        refresh (bool): overwrite nutrition and prices
+        rows (list): staged rows, in `columns` order
+
+    Usage:
+        >>> stage = InfoStage('default', refresh=False)
+        >>> stage.add('tesco', product.pid, info_dict, brand_id=1)
+        >>> updated, errors = stage.merge()
+    """
+    table = 'scrape_info_stage'
+    qty_fields = ('qty', 'num_of_units', 'total_qty', 'unit_of_measurement')
+    nutrition_fields = ('header', 'kcal', 'fat', 'carb', 'protein')
+    price_fields = ('base_price', 'sale_price', 'offer_price', 'offer_text')
+    listing_fields = ('base', 'sale', 'offer', 'offer_text')  # StoreListing
+
+    columns = (('store', 'varchar(20)'), ('pid', 'integer'),
+               ('description', 'description'), ('brand_id', 'brand'),
+               ('has_qty', 'boolean'), ('has_nutrition', 'boolean'),
+               ('has_price', 'boolean'))
+    columns += tuple((f, f) for f in qty_fields + nutrition_fields)
+    columns += tuple(zip(price_fields, listing_fields))
+
+    def __init__(self, using='default', refresh=False):
+        self.using = using
+        self.refresh = refresh
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, store, pid, info_dict, brand_id=None):
+        """
+        Stages the values of an info_dict. Values are converted and validated
+        against the ProductInfo and StoreListing fields first, so a bad value raises here
+        (ValidationError) rather than failing the whole batch later.
+        """
+        i = info_dict
+        values = {'store': store, 'pid': pid, 'brand_id': brand_id,
+                  'description': self._clean('description',
+                                             i.get('description') or None),
+                  'has_qty': bool(i.get('qty')),
+                  'has_nutrition': bool(i.get('nutrition')),
+                  'has_price': bool(i.get('price'))}
+        for flag, key, fields, model_fields in (
+                ('has_qty', 'qty', self.qty_fields, self.qty_fields),
+                ('has_nutrition', 'nutrition', self.nutrition_fields,
+                 self.nutrition_fields),
+                ('has_price', 'price', self.price_fields,
+                 self.listing_fields)):
+            group = i[key] if values[flag] else {}
+            for name, model_name in zip(fields, model_fields):
+                values[name] = self._clean(model_name, group.get(name))
+        self.rows.append(tuple(values[name] for name, _ in self.columns))
+
+    def pids(self):
+        return {row[1] for row in self.rows}
+
+    def merge(self):
+        """
+        Writes the staged rows to ProductInfo and StoreListing. Returns the
+        number of (store, product) rows updated and a dict of
+        pid -> DatabaseError for rows that could not be written; those are
+        retried one at a time if the set-based merge fails.
+        """
+        if not self.rows:
+            return 0, {}
+        connection = connections[self.using]
+        stores = sorted({row[0] for row in self.rows})
+        errors = {}
+        with transaction.atomic(using=self.using), connection.cursor() as cursor:
+            self._create(cursor, connection)
+            self._load(cursor, connection)
+            try:
+                with transaction.atomic(using=self.using):
+                    updated = set()
+                    for store in stores:
+                        updated |= self._merge_store(cursor, store)
+            except DatabaseError:
+                # Retry row by row so that one bad row doesn't lose the batch
+                updated = set()
+                for store, pid in sorted({row[:2] for row in self.rows}):
+                    try:
+                        with transaction.atomic(using=self.using):
+                            updated |= self._merge_store(cursor, store, pid)
+                    except DatabaseError as e:
+                        errors[pid] = e
+            cursor.execute(f'DROP TABLE {self.table}')
+        return len(updated), errors
+
+    def _merge_store(self, cursor, store, pid=None):
+        """ Merges a store's staged rows, or one of them; returns the keys """
+        updated = set()
+        for sql in (self._merge_sql(store, pid is not None),
+                    self._listing_sql(store, pid is not None)):
+            cursor.execute(sql, [store] if pid is None else [store, pid])
+            updated.update((store, row[0]) for row in cursor.fetchall())
+        return updated
+
+    def _field(self, name):
+        model = StoreListing if name in self.listing_fields else ProductInfo
+        return model._meta.get_field(name)
+
+    def _clean(self, name, value):
+        field = self._field(name)
+        value = field.to_python(value)
+        if value is not None:
+            field.run_validators(value)
+        return value
+
+    def _column_type(self, name, connection):
+        if name in ('varchar(20)', 'integer', 'boolean'):
+            return name
+        return self._field(name).db_type(connection)
+
+    def _create(self, cursor, connection):
+        columns = ', '.join(f'{name} {self._column_type(source, connection)}'
+                            for name, source in self.columns)
+        cursor.execute(f'CREATE TEMPORARY TABLE {self.table} ({columns})')
+
+    def _load(self, cursor, connection):
+        names = ', '.join(name for name, _ in self.columns)
+        if connection.vendor == 'postgresql':
+            data = io.StringIO()
+            for row in self.rows:
+                data.write('\t'.join(map(self._copy_value, row)) + '\n')
+            data.seek(0)
+            cursor.copy_expert(f'COPY {self.table} ({names}) FROM STDIN', data)
+        else:
+            params = ', '.join(['%s'] * len(self.columns))
+            cursor.executemany(
+                f'INSERT INTO {self.table} ({names}) VALUES ({params})',
+                self.rows)
+
+    @staticmethod
+    def _copy_value(value):
+        """ Formats a value for COPY's text format """
+        if value is None:
+            return r'\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        value = str(value)
+        for char, escaped in (('\\', '\\\\'), ('\t', r'\t'), ('\n', r'\n'),
+                              ('\r', r'\r')):
+            value = value.replace(char, escaped)
+        return value
+
+    def _merge_sql(self, store, one=False):
+        """
+        Returns UPDATE ... FROM merging one store's staged rows into
+        ProductInfo (or only the row with the pid given as a second parameter
+        if `one`). Each group of fields is only assigned where its fill (or
+        refresh) condition holds, and a row is only updated if one of those
+        assignments changes it.
+        """
+        refresh = 'TRUE' if self.refresh else 'FALSE'
+        # Not aliased, as SQLite's RETURNING doesn't accept an alias
+        p = ProductInfo._meta.db_table
+        groups = [
+            (f"COALESCE({p}.description, '') = '' "
+             'AND s.description IS NOT NULL',
+             [('description', 'description')]),
+            (f'{p}.brand_id IS NULL AND s.brand_id IS NOT NULL',
+             [('brand_id', 'brand_id')]),
+            (f'({p}.qty IS NULL OR {p}.qty = 0) AND s.has_qty',
+             [(f, f) for f in self.qty_fields]),
+            (f'({refresh} OR {p}.protein IS NULL OR {p}.protein = 0) '
+             'AND s.has_nutrition',
+             [(f, f) for f in self.nutrition_fields]),
+        ]
+        return self._update_sql(p, groups, f's.pid = {p}.pid', 'pid', one)
+
+    def _listing_sql(self, store, one=False):
+        """ Returns UPDATE ... FROM merging one store's staged prices """
+        refresh = 'TRUE' if self.refresh else 'FALSE'
+        l = StoreListing._meta.db_table
+        groups = [
+            (f'({refresh} OR {l}.base IS NULL OR {l}.base = 0) AND s.has_price',
+             list(zip(self.listing_fields, self.price_fields))),
+        ]
+        return self._update_sql(
+            l, groups, f's.pid = {l}.product_id AND s.store = {l}.store_id',
+            'product_id', one)
+
+    def _update_sql(self, table, groups, join, key, one):
+        assignments, changes = [], []
+        for condition, fields in groups:
+            for column, staged in fields:
+                assignments.append(f'{column} = CASE WHEN {condition} '
+                                   f'THEN s.{staged} ELSE {table}.{column} END')
+            differs = ' OR '.join(
+                f's.{staged} IS DISTINCT FROM {table}.{column}'
+                for column, staged in fields)
+            changes.append(f'({condition} AND ({differs}))')
+        only = ' AND s.pid = %s' if one else ''
+        return (f'UPDATE {table} '
+                f'SET {", ".join(assignments)} '
+                f'FROM {self.table} AS s '
+                f'WHERE {join} AND s.store = %s{only} '
+                f'AND ({" OR ".join(changes)}) '
+                f'RETURNING {table}.{key}')
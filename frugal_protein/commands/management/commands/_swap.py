@@ -0,0 +1,132 @@
+"""
+Blue/green swap of the live catalog tables through PostgreSQL schemas
+"""
+from django.core.management.base import CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+
+
+class ShadowCatalog:
+    """
+    Builds a copy of the catalog tables in a shadow schema, which is loaded
+    and verified while readers keep using the tables in `public`, then swaps
+    it in by moving both sets of tables between schemas in one transaction.
+    The replaced tables are kept in the `catalog_old` schema until the next
+    swap or discard_old(), so rollback() is another instant swap.
+
+    The shadow tables are created by Django's schema editor with the shadow
+    schema first on the search_path, so they get the same names, indexes,
+    constraints and sequences as the tables migrations create, and foreign
+    keys between them point at each other. The schema editor doesn't know
+    about triggers added by RunSQL migrations, so their SQL is given as
+    `triggers` and run on the shadow tables before rows are copied in. The
+    catalog must have no foreign keys from tables outside it. PostgreSQL
+    only.
+
+    Attributes
+        models (list): catalog models, parents first
+        using (str): db alias listed under settings.DATABASES
+        triggers (list): CREATE TRIGGER statements on unqualified tables
+
+    Usage:
+        >>> shadow = ShadowCatalog([Brands, ProductInfo], 'live',
+        ...                        triggers=[SEARCH_VECTOR_TRIGGER])
+        >>> with transaction.atomic(using='live'):
+        ...     shadow.build()  # the ORM now reads and writes the shadow
+        ...     load(...)
+        ...     shadow.verify({ProductInfo: 9000, Brands: 500})
+        ...     shadow.swap()
+    """
+    shadow = 'catalog_shadow'
+    old = 'catalog_old'
+    public = 'public'
+
+    def __init__(self, models, using='live', triggers=()):
+        self.models = models
+        self.using = using
+        self.triggers = list(triggers)
+        self.connection = connections[using]
+        if self.connection.vendor != 'postgresql':
+            raise CommandError('catalog swaps need a PostgreSQL db')
+
+    def build(self):
+        """
+        Creates the shadow tables holding the current catalog and puts the
+        shadow schema first on the search_path for the rest of the
+        transaction
+        """
+        qn = self.connection.ops.quote_name
+        self._execute(f'DROP SCHEMA IF EXISTS {self.shadow} CASCADE',
+                      f'CREATE SCHEMA {self.shadow}',
+                      f'SET LOCAL search_path TO {self.shadow}, {self.public}')
+        with self.connection.schema_editor() as editor:
+            for model in self.models:
+                editor.create_model(model)
+        # Resolved to the shadow tables through the search_path
+        self._execute(*self.triggers)
+        for model in self.models:
+            table = qn(model._meta.db_table)
+            columns = ', '.join(qn(f.column)
+                                for f in model._meta.concrete_fields)
+            self._execute(f'INSERT INTO {self.shadow}.{table} ({columns}) '
+                          f'SELECT {columns} FROM {self.public}.{table}')
+        self._execute(*self.connection.ops.sequence_reset_sql(no_style(),
+                                                              self.models))
+
+    def verify(self, counts):
+        """
+        Checks the shadow's foreign keys and that it holds counts rows of
+        each model (model -> count), raising CommandError if it doesn't
+        """
+        self._execute('SET CONSTRAINTS ALL IMMEDIATE')
+        qn = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            for model, expected in counts.items():
+                cursor.execute(f'SELECT COUNT(*) FROM {self.shadow}.'
+                               f'{qn(model._meta.db_table)}')
+                (count,) = cursor.fetchone()
+                if count != expected:
+                    raise CommandError(
+                        f'shadow {model.__name__} has {count} rows, '
+                        f'expected {expected}')
+
+    def swap(self):
+        """ Moves the shadow tables into public, and public's to catalog_old """
+        self._execute(f'DROP SCHEMA IF EXISTS {self.old} CASCADE',
+                      f'CREATE SCHEMA {self.old}')
+        self._move(self.public, self.old)
+        self._move(self.shadow, self.public)
+        self._execute(f'DROP SCHEMA {self.shadow}')
+
+    def rollback(self):
+        """ Swaps the tables in catalog_old back in; running it again undoes """
+        with transaction.atomic(using=self.using):
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1 FROM information_schema.schemata '
+                               'WHERE schema_name = %s', [self.old])
+                if cursor.fetchone() is None:
+                    raise CommandError('no previous catalog to roll back to')
+            self._execute(f'DROP SCHEMA IF EXISTS {self.shadow} CASCADE',
+                          f'CREATE SCHEMA {self.shadow}')
+            self._move(self.public, self.shadow)
+            self._move(self.old, self.public)
+            self._execute(f'DROP SCHEMA {self.old}',
+                          f'ALTER SCHEMA {self.shadow} RENAME TO {self.old}')
+
+    def discard_old(self):
+        """
+        Drops the catalog kept for rollback, e.g. before the db is pushed
+        somewhere it would count against a row budget
+        """
+        self._execute(f'DROP SCHEMA IF EXISTS {self.old} CASCADE')
+
+    def _move(self, source, target):
+        qn = self.connection.ops.quote_name
+        for model in self.models:
+            self._execute(f'ALTER TABLE {source}.{qn(model._meta.db_table)} '
+                          f'SET SCHEMA {target}')
+
+    def _execute(self, *statements):
+        with self.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
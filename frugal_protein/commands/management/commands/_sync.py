@@ -0,0 +1,205 @@
+"""
+Incremental, hash-based sync of rows from the development db to the live db
+"""
+import hashlib
+from collections import namedtuple
+
+from django.db import connections, models, transaction
+
+
+# pks of one table's rows to insert into, update on and delete from the target
+TableDiff = namedtuple('TableDiff', ['model', 'inserts', 'updates', 'deletes'])
+
+
+class LiveSync:
+    """
+    Makes tables on the target db match querysets on the source db while only
+    writing the rows that differ.
+
+    Every row gets a content hash over all of its columns. Rows are grouped
+    into chunks of `chunk_size` consecutive pks and each chunk gets a digest
+    of its row hashes, so identical chunks are skipped after comparing one
+    digest per side and only the rows of differing chunks are compared. On
+    PostgreSQL (on both sides) the hashes and digests are computed in SQL,
+    so unchanged rows never leave the db; elsewhere they are computed in
+    Python.
+
+    Writes are made in one transaction on the target: deletes first (child
+    tables first, as foreign keys are only checked at commit), then inserts
+    and updates in the order the tables are given, parents first.
+
+    Attributes
+        target (str): db alias of the db written to
+        chunk_size (int): pks per compared chunk, and rows per write
+
+    Usage:
+        >>> sync = LiveSync('live')
+        >>> diffs = sync.run([(Brands, brands), (ProductInfo, products)])
+        >>> sum(sync.delta(diff) for diff in diffs)
+        12
+    """
+
+    def __init__(self, target='live', chunk_size=500):
+        self.target = target
+        self.chunk_size = chunk_size
+        self._rows = {}  # (db, model) -> {pk: hash}, when hashed in Python
+
+    def run(self, tables):
+        """
+        Syncs each (model, source queryset) pair, given parents first, and
+        returns a TableDiff per table
+        """
+        self._rows = {}
+        diffs = [self.diff(model, source) for model, source in tables]
+        with transaction.atomic(using=self.target):
+            for diff in reversed(diffs):
+                self._delete(diff.model, diff.deletes)
+            for (model, source), diff in zip(tables, diffs):
+                self._insert(source, diff.inserts)
+                self._update(source, diff.updates)
+        return diffs
+
+    @staticmethod
+    def delta(diff):
+        return len(diff.inserts) + len(diff.updates) + len(diff.deletes)
+
+    def diff(self, model, source):
+        """ Returns the TableDiff that makes the target table match source """
+        target = model.objects.using(self.target).all()
+        source_chunks = self.chunk_digests(source)
+        target_chunks = self.chunk_digests(target)
+        changed = sorted(chunk for chunk in source_chunks.keys() |
+                         target_chunks.keys()
+                         if source_chunks.get(chunk) !=
+                         target_chunks.get(chunk))
+        if not changed:
+            return TableDiff(model, [], [], [])
+
+        source_rows = self.row_hashes(source, changed)
+        target_rows = self.row_hashes(target, changed)
+        updates = [pk for pk in source_rows.keys() & target_rows.keys()
+                   if source_rows[pk] != target_rows[pk]]
+        return TableDiff(model,
+                         sorted(source_rows.keys() - target_rows.keys()),
+                         sorted(updates),
+                         sorted(target_rows.keys() - source_rows.keys()))
+
+    def chunk_digests(self, queryset):
+        """ Returns chunk -> digest of the hashes of the chunk's rows """
+        if not self._in_sql(queryset):
+            digests = {}
+            for pk, row_hash in sorted(self._python_rows(queryset).items()):
+                digests.setdefault(self._chunk(pk), hashlib.md5()).update(
+                    row_hash.encode())
+            return {chunk: d.hexdigest() for chunk, d in digests.items()}
+
+        sql, params, pk, chunk, chunk_params = self._row_sql(queryset)
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                f"SELECT {chunk}, md5(string_agg(md5(t::text), '' "
+                f"ORDER BY t.{pk})) FROM ({sql}) AS t GROUP BY 1",
+                chunk_params + params)
+            return dict(cursor.fetchall())
+
+    def row_hashes(self, queryset, chunks):
+        """ Returns pk -> content hash of the rows in the given chunks """
+        if not self._in_sql(queryset):
+            chunks = set(chunks)
+            return {pk: row_hash
+                    for pk, row_hash in self._python_rows(queryset).items()
+                    if self._chunk(pk) in chunks}
+
+        sql, params, pk, chunk, chunk_params = self._row_sql(queryset)
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                f'SELECT t.{pk}, md5(t::text) FROM ({sql}) AS t '
+                f'WHERE {chunk} = ANY(%s)',
+                params + chunk_params + [list(chunks)])
+            return dict(cursor.fetchall())
+
+    def _in_sql(self, queryset):
+        return all(connections[db].vendor == 'postgresql'
+                   for db in (queryset.db, self.target))
+
+    def _chunk(self, pk):
+        return pk // self.chunk_size if isinstance(pk, int) else 0
+
+    def _row_sql(self, queryset):
+        """
+        Returns the queryset's SQL selecting every column, with the pk and
+        chunk expressions on it (a single chunk if the pk isn't an integer)
+        """
+        model = queryset.model
+        columns = [f.attname for f in model._meta.concrete_fields]
+        compiler = queryset.values_list(*columns).query.get_compiler(
+            queryset.db)
+        sql, params = compiler.as_sql()
+        connection = connections[queryset.db]
+        pk = connection.ops.quote_name(model._meta.pk.column)
+        if isinstance(model._meta.pk, models.AutoField):
+            return sql, list(params), pk, f't.{pk} / %s', [self.chunk_size]
+        return sql, list(params), pk, '0', []
+
+    def _python_rows(self, queryset):
+        key = (queryset.db, queryset.model)
+        if key not in self._rows:
+            meta = queryset.model._meta
+            columns = [f.attname for f in meta.concrete_fields]
+            pk = columns.index(meta.pk.attname)
+            rows = queryset.values_list(*columns).iterator(
+                chunk_size=self.chunk_size)
+            self._rows[key] = {row[pk]: hashlib.md5(repr(row).encode())
+                               .hexdigest() for row in rows}
+        return self._rows[key]
+
+    def _chunks(self, items):
+        for i in range(0, len(items), self.chunk_size):
+            yield items[i:i + self.chunk_size]
+
+    def _delete(self, model, pks):
+        # Raw DELETEs; QuerySet.delete() would cascade to rows still synced
+        connection = connections[self.target]
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            for chunk in self._chunks(pks):
+                cursor.execute(
+                    f'DELETE FROM {qn(model._meta.db_table)} '
+                    f'WHERE {qn(model._meta.pk.column)} IN '
+                    f'({", ".join(["%s"] * len(chunk))})', chunk)
+
+    def _rows_by_pk(self, source, pks):
+        """
+        Yields the source rows with the given pks a chunk at a time. The pks
+        were read from source, so its filters needn't be evaluated again.
+        """
+        objects = source.model.objects.using(source.db)
+        for chunk in self._chunks(pks):
+            yield objects.filter(pk__in=chunk)
+
+    def _insert(self, source, pks):
+        objects = source.model.objects.using(self.target)
+        for rows in self._rows_by_pk(source, pks):
+            objects.bulk_create(rows)
+
+    def _update(self, source, pks):
+        """
+        Writes every column of the rows with one executemany of an UPDATE
+        (QuerySet.bulk_update builds a CASE per field and row)
+        """
+        if not pks:
+            return
+        meta = source.model._meta
+        fields = [f for f in meta.concrete_fields if not f.primary_key]
+        connection = connections[self.target]
+        qn = connection.ops.quote_name
+        sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+            qn(meta.db_table),
+            ', '.join(f'{qn(f.column)} = %s' for f in fields),
+            qn(meta.pk.column))
+        with connection.cursor() as cursor:
+            for rows in self._rows_by_pk(source, pks):
+                params = [[f.get_db_prep_save(getattr(row, f.attname),
+                                              connection)
+                           for f in fields] + [row.pk]
+                          for row in rows]
+                cursor.executemany(sql, params)
@@ -0,0 +1,146 @@
+"""
+Per-store request throttling for the scrape command
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a request may be made at
+    `rate` requests per second, allowing bursts of up to `capacity`, and
+    returns the seconds it waited.
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative: callers reserve their slot and wait
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a store after `threshold` consecutive failures. Once
+    `cooldown` seconds have passed a single trial request is let through
+    (half-open); success closes the breaker, failure opens it again.
+    """
+    closed, open, half_open = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, cooldown=60, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = self.closed
+        self.failures = 0
+        self.opened = None
+        self.trips = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """ Returns seconds to wait before a request may be made (0 = go) """
+        with self._lock:
+            if self.state == self.open:
+                remaining = self.opened + self.cooldown - self.clock()
+                if remaining > 0:
+                    return remaining
+                self.state = self.half_open
+                self._trial = False
+            if self.state == self.half_open:
+                if self._trial:
+                    # Another worker is making the trial request
+                    return min(1, self.cooldown)
+                self._trial = True
+            return 0
+
+    def record(self, succeeded):
+        with self._lock:
+            self._trial = False
+            if succeeded:
+                self.failures = 0
+                self.state = self.closed
+                return
+            self.failures += 1
+            if self.state == self.half_open or self.failures >= self.threshold:
+                if self.state != self.open:
+                    self.trips += 1
+                self.state = self.open
+                self.opened = self.clock()
+
+
+class StoreThrottle:
+    """
+    Adaptive rate limiter with a circuit breaker for a single store.
+
+    The request rate follows additive increase / multiplicative decrease: each
+    fast, successful request nudges the rate up by `step` (up to max_rate),
+    while an error or a request slower than `target_latency` halves it (down
+    to min_rate). Repeated errors trip the circuit breaker, which pauses the
+    store for `cooldown` seconds; other stores have their own throttle and
+    carry on.
+
+    Usage:
+        >>> throttle = StoreThrottle(rate=5)
+        >>> throttle.acquire()  # blocks while paused or over the rate
+        0.2
+        >>> throttle.record(latency=0.4, succeeded=True)
+    """
+
+    def __init__(self, rate=5, min_rate=0.2, max_rate=None, step=0.1,
+                 target_latency=2, threshold=5, cooldown=60,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 10
+        self.step = step
+        self.target_latency = target_latency
+        # Allow a burst of up to one second's worth of requests
+        self.bucket = TokenBucket(rate, capacity=max(1, rate), clock=clock,
+                                  sleep=sleep)
+        self.breaker = CircuitBreaker(threshold, cooldown, clock=clock)
+        self.sleep = sleep
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def acquire(self):
+        """ Waits for the breaker and the rate, returning the seconds waited """
+        waited = 0
+        wait = self.breaker.wait_time()
+        while wait > 0:
+            self.sleep(wait)
+            waited += wait
+            wait = self.breaker.wait_time()
+        return waited + self.bucket.acquire()
+
+    def record(self, latency, succeeded):
+        self.breaker.record(succeeded)
+        with self._lock:
+            if succeeded and latency <= self.target_latency:
+                rate = self.bucket.rate + self.step
+            else:
+                rate = self.bucket.rate / 2
+            self.bucket.rate = max(self.min_rate, min(self.max_rate, rate))
+
+    @property
+    def paused(self):
+        return self.breaker.state == CircuitBreaker.open
@@ -1,70 +1,169 @@
 import os
 import re
 import subprocess
+import sys
+import time
 from datetime import date
 
-from django.core.management import call_command, CommandError
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from django.core.management import CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.db.models import Count, F
 
 from frugal_protein import settings
-from products.models import Brands, ProductInfo
+from products.helper.triggers import SEARCH_VECTOR_TRIGGER
+from products.models import (Brands, CatalogVersion, ProductInfo, Store,
+                             StoreListing)
+from ._swap import ShadowCatalog
+from ._sync import LiveSync
 
 
 class UpdateLiveDB:
     """
-    This class inserts filtered products from local development database to the
+    This class syncs filtered products from local development database to the
     local live development database. Products are filtered by their protein 
-    content (per 100g). This is to keep the number of database rows below the 
-    10,000 limit for Heroku's psql free tier (500 rows reserved for django 
-    backend)
+    content (per 100g) and ranked by value, their cheapest £/10g protein at
+    any store (computed in the db, see ProductInfoQuerySet). The best-value
+    products, with the brands and store listings they need, are packed into
+    max_rows, so the live db stays below the 10,000 limit for Heroku's psql
+    free tier (500 rows reserved for django backend) and always holds the
+    most useful rows. Products without a known value come last.
+
+    The live db is synced incrementally (see LiveSync): only rows whose content hash
+    differs are inserted, updated or deleted, in a single transaction, so a
+    failed sync leaves nothing half written. On PostgreSQL the sync is made
+    on a shadow copy of the catalog tables, which is checked against the
+    selected row counts and swapped in atomically (see ShadowCatalog), so
+    readers never wait on or see a half-loaded catalog and rollback() swaps
+    the previous catalog straight back. The live db's CatalogVersion is
+    bumped with every sync, dropping cached searches. The size of the delta,
+    the time of the sync and the peak memory (resident set size) of the
+    process are reported.
 
     Attributes
         max_rows (str): maximum rows that can be inserted into db 
         protein_threshold (int/float): protein threshold for filtering
         live_db (str): db name listed under settings.DATABASES
+        chunk_size (int): pks per compared chunk, and rows written at a time
     """
 
     max_rows = 9500
     protein_threshold = 10  # per 100g/ml
     live_db = 'live'
+    chunk_size = 500
     
     def execute(self):
-        self.reset_tables()
+        stores = Store.objects.all()
+        pids, brand_ids, candidates = self.select(self.max_rows - len(stores))
+        products = ProductInfo.objects.filter(pid__in=pids)
+        brands = Brands.objects.filter(brand_id__in=brand_ids)
+        listings = StoreListing.objects.filter(product_id__in=pids)
+        tables = [(Store, stores), (Brands, brands), (ProductInfo, products),
+                  (StoreListing, listings)]
+
+        counts = {model: queryset.count() for model, queryset in tables}
+        total_rows = sum(counts.values())
+        print(f'{len(pids)} of {candidates} products selected',
+              f'({total_rows}/{self.max_rows} rows)')
+
+        sync = LiveSync(self.live_db, chunk_size=self.chunk_size)
+        start = time.perf_counter()
+        with transaction.atomic(using=self.live_db):
+            shadow = self.shadow_catalog()
+            if shadow is not None:
+                shadow.build()
+            diffs = sync.run(tables)
+            self.reset_sequences([model for model, _ in tables])
+            if shadow is not None:
+                shadow.verify(counts)
+                shadow.swap()
+            CatalogVersion.bump(self.live_db)
+        elapsed = time.perf_counter() - start
 
-        # Get products greater than or equal to protein threshold
-        candidate_products = ProductInfo.objects.filter(
-            protein__gte=self.protein_threshold)
-        products = candidate_products.filter(
+        print(f'{counts[ProductInfo]} products, {counts[StoreListing]} listings',
+              f'and {counts[Brands]} brands in local heroku db')
+        for diff in diffs:
+            print(f'{diff.model.__name__}: {len(diff.inserts)} inserted,',
+                  f'{len(diff.updates)} updated, {len(diff.deletes)} deleted')
+        delta = sum(sync.delta(diff) for diff in diffs)
+        peak = self.peak_memory()
+        peak = 'unknown' if peak is None else f'{peak:.1f} MiB'
+        print(f'sync wrote {delta} rows in {elapsed:.2f}s, peak memory {peak}')
+
+    def rollback(self):
+        """ Swaps the catalog replaced by the last update back into the live db """
+        shadow = self.shadow_catalog()
+        if shadow is None:
+            raise CommandError('rollback needs a PostgreSQL live db')
+        shadow.rollback()
+        CatalogVersion.bump(self.live_db)
+        print('previous catalog swapped back into local heroku db')
+
+    def shadow_catalog(self):
+        """ Returns the live db's ShadowCatalog, or None if it can't swap """
+        if connections[self.live_db].vendor != 'postgresql':
+            return None
+        return ShadowCatalog([Store, Brands, ProductInfo, StoreListing],
+                             self.live_db, triggers=[SEARCH_VECTOR_TRIGGER])
+
+    def select(self, budget):
+        """
+        Returns the pids and brand ids of the best-value products whose rows
+        (product, store listings and brand, if not already taken) fit in
+        budget rows, and the number of products considered. Products are
+        taken in order of value, skipping those that don't fit in the rows
+        left, until the budget is filled exactly or products run out.
+        """
+        # Products greater than or equal to protein threshold
+        products = ProductInfo.objects.filter(
+            protein__gte=self.protein_threshold,
             description__isnull=False,
             qty__isnull=False,
-            protein__isnull=False
-        )
-
-        # Get brands found in filtered products
-        brands = [p.brand for p in products]
-        brands = set(brands)
-        if None in brands:
-            brands.remove(None)
-
-        # Insert rows into live db
-        total_rows = len(products) + len(brands)
-        if total_rows <= self.max_rows:
-            for brand in brands:
-                brand.save(using=self.live_db)
-            for product in products:
-                product.save(using=self.live_db)
-            print(f'{total_rows} rows inserted into local heroku db.',
-                  f'{len(products)} products and {len(brands)} brands')
-        else:
-            msg = f'Too many rows! {total_rows}/{self.max_rows}'
-            print(msg)
-    
-    def reset_tables(self):
-        """ Reset (truncate) productinfo and brands table """
-        call_command('flush', '--database=live', '--noinput')
-        while len(ProductInfo.objects.using('live').all()) == 0 and \
-              len(Brands.objects.using('live').all()) == 0:
-              return
+        ).with_protein_price().annotate(
+            listing_count=Count('listings')
+        ).order_by(F('protein_price').asc(nulls_last=True), 'pid')
+
+        pids, brand_ids = [], set()
+        candidates = 0
+        for pid, brand_id, listing_count in products.values_list(
+                'pid', 'brand_id', 'listing_count').iterator(
+                    chunk_size=self.chunk_size):
+            candidates += 1
+            new_brand = brand_id is not None and brand_id not in brand_ids
+            rows = 1 + listing_count + new_brand
+            if rows > budget:
+                continue
+            budget -= rows
+            pids.append(pid)
+            if new_brand:
+                brand_ids.add(brand_id)
+        return pids, brand_ids, candidates
 
+    @staticmethod
+    def peak_memory():
+        """ Returns the peak RSS of the process in MiB, or None if unknown """
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+    def reset_sequences(self, models):
+        """
+        Moves the live db's pk sequences past the copied pks, as rows are
+        inserted with the pks they have in the development db
+        """
+        connection = connections[self.live_db]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+    
     def run_win_cmd(self, cmd):
         process =  subprocess.Popen(cmd,
                                     shell=True,
@@ -81,6 +180,10 @@ class UpdateHeroku:
            db. Note that on Windows OS, this requires changing the PGUSER env
            variable from ROOT to a psql user.
         2. Manual push via pg_dump and pg_restore.
+
+    The previous catalog UpdateLiveDB keeps for rollback (see ShadowCatalog)
+    would double the rows pushed, so pg:push drops it first and pg_dump
+    leaves it out.
     """
 
     def execute(self):
@@ -103,6 +206,7 @@ class UpdateHeroku:
         # Note: On Windows OS, pg:push requires changing PGUSER=ROOT to 
         # PGUSER={pguser} in the environment variables.
         # TODO validate successful push
+        self.discard_rollback()
         self.reset_heroku_db()
         local_db = settings.DATABASES['live']['NAME']
         heroku_db = os.getenv('HEROKU_DB_NAME')
@@ -138,6 +242,14 @@ class UpdateHeroku:
         self.restore_heroku(db_config, path)
     
 
+    def discard_rollback(self):
+        """ Drops the live db's rollback catalog, as pg:push copies every schema """
+        shadow = UpdateLiveDB().shadow_catalog()
+        if shadow is not None:
+            shadow.discard_old()
+            print('previous catalog discarded, rollback no longer available')
+
+
     def reset_heroku_db(self):
         cmd = 'heroku pg:reset DATABASE --confirm frugal-protein'
         p = subprocess.run(cmd, capture_output=True, text=True, shell=True)
@@ -146,7 +258,7 @@ class UpdateHeroku:
 
     def dump_local(self, db_name, filename):
         pguser = os.getenv('PGUSER')
-        cmd = f'pg_dump --no-password --verbose -F c -Z 0 -U {pguser} -h localhost -p 5432 {db_name} > {filename}'
+        cmd = f'pg_dump --no-password --verbose -F c -Z 0 -U {pguser} -h localhost -p 5432 --exclude-schema={ShadowCatalog.old} {db_name} > {filename}'
         env = os.environ
         p = self.run_win_cmd(cmd, env=env)
         p.communicate()
@@ -0,0 +1,54 @@
+"""
+Command for merging duplicate products found by the id scrape.
+
+When a scraped barcode and store pid belong to two different rows, the id
+scrape records an IdConflict. This command merges every set of rows linked by
+conflicts into a single product and clears the conflicts.
+
+Named Args (Optional):
+    • -l, --live      - Reconcile the local backup of live db instead of the
+                        local development db
+    • --dry-run       - Report the duplicates without merging them
+
+Example Usage:
+    • merge duplicate products
+        py manage.py reconcile
+
+    • list duplicate products on backup of live db
+        py manage.py reconcile -l --dry-run
+"""
+from django.core.management.base import BaseCommand
+
+from products.models import CatalogVersion
+from ._reconcile import ProductReconciler
+
+
+class Command(BaseCommand):
+    help = 'merge duplicate products recorded by the id scrape'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-l', '--live',
+            action='store_true',
+            help='Reconcile local version of live_db'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report duplicate products without merging them'
+        )
+
+    def handle(self, *args, **options):
+        db = 'live' if options['live'] else 'default'
+        reconciler = ProductReconciler(db)
+        components = reconciler.components()
+        duplicates = sum(len(group) - 1 for group in components)
+        print(f'{len(components)} products with {duplicates} duplicates')
+        if options['dry_run']:
+            for group in components:
+                print(f'pids {group}')
+            return
+        removed = reconciler.merge(components)
+        if removed:
+            CatalogVersion.bump(db)
+        print(f'{removed} duplicate products merged')
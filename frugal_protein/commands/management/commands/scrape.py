@@ -5,14 +5,21 @@ Scraping types:
     (1) IDs    - scrapes all product barcodes and product ids (pids) of 
                  selected store(s)
     (2) infos  - scrapes all product of selected store(s) for its info 
-                 (e.g. description, brand, qty, nutrition)
+                 (e.g. description, brand, qty, nutrition). Only the values 
+                 that a product is missing are requested; complete products
+                 are skipped.
+    (3) daemon - runs until stopped, scraping ids once they are older than
+                 --id-interval and spending the rest of the --budget on the
+                 info of the products that are most stale, most incomplete
+                 and best value (lowest £/10g protein) first. When each 
+                 product and store was last scraped is kept in the db.
 
 Positional Args (Required):
-    (1) type - [id/info]
+    (1) type - [id/info/daemon]
 
 Named Args (Optional):
-    • -s, --stores    - Overrides default behaviour (scrape all stores), to 
-                        instead, scrape selected store(s)
+    • -s, --stores    - Overrides default behaviour (scrape all stores in the
+                        Store registry), to instead, scrape selected store(s)
     • -l, --live      - Overrides default setting of using local development db 
                         as source of products for info scraping, to instead use 
                         local backup of live db. 
@@ -21,6 +28,52 @@ Named Args (Optional):
                         (Only valid for info scraping)
     • -E, --exclude   - Specify which info values to exclude from scrape
                         (Only valid for info scraping)
+    • -w, --workers   - Number of requests kept in flight per store. Stores are
+                        always scraped in parallel. (Default: 1)
+                        (Only valid for info scraping)
+    • -r, --refresh   - Re-scrape prices, offers and nutrition of every product
+                        and overwrite them where they have changed
+                        (Only valid for info scraping)
+    • --rate          - Starting requests per second per store. The rate adapts
+                        to each store's latency and errors, and a store that
+                        keeps failing is paused for a while. 0 disables 
+                        throttling. (Default: 5)
+                        (Only valid for info scraping)
+    • --resume        - Continue the last info scrape that did not finish,
+                        skipping products it already processed
+                        (Only valid for info scraping)
+    • --metrics       - Path of the JSON metrics summary written at the end of 
+                        an info scrape (Default: not written, only printed)
+    • --metrics-stream
+                      - Append a JSON line per scraped product and per db write
+                        to this file while the info scrape runs
+    • --cache         - Cache scraper responses on disk: 'record' stores every
+                        response, 'replay' serves responses from the cache 
+                        only (Default: passthrough, i.e. no cache)
+    • --cache-dir     - Directory of the response cache 
+                        (Default: commands/cache)
+    • --cache-ttl     - Hours after which cached responses expire and are
+                        evicted
+    • --enqueue       - Queue the products that need info scraping in the db
+                        for --worker processes, instead of scraping them
+    • --worker        - Scrape products queued by --enqueue. Any number of 
+                        workers, on any host sharing the db, can run at once;
+                        each leases its own batches of products.
+    • --lease-size    - Products leased per batch by a worker (Default: 50)
+    • --lease-ttl     - Seconds before an unrenewed lease expires and the batch
+                        can be taken over by another worker (Default: 300)
+    • --image-dir     - Save product images to a local directory instead of
+                        uploading them to S3 (e.g. for offline testing)
+                        (Only valid for info scraping)
+    • --budget        - Requests per hour the daemon may make across all 
+                        stores (Default: 600)
+    • --interval      - Seconds between daemon cycles (Default: 300)
+    • --cycles        - Stop the daemon after this many cycles 
+                        (Default: run until stopped)
+    • --stale-after   - Hours after which the daemon re-scrapes a product 
+                        (Default: 24)
+    • --id-interval   - Hours between id scrapes of a store by the daemon
+                        (Default: 24)
 
 Example Usage:
     • scrape ids from all available stores
@@ -40,6 +93,26 @@ Example Usage:
 
     • scrape price info for all tesco products on backup of live db
         py manage.py scrape info -s tesco -e price -l
+
+    • scrape info with 8 concurrent requests per store
+        py manage.py scrape info -w 8
+
+    • resume an interrupted info scrape
+        py manage.py scrape info --resume
+
+    • re-ingest tesco info from responses recorded by an earlier run
+        py manage.py scrape info -s tesco --cache record
+        py manage.py scrape info -s tesco --cache replay
+
+    • share a full info scrape between several workers
+        py manage.py scrape info --enqueue
+        py manage.py scrape info --worker -w 4   (on each host)
+
+    • refresh prices of all tesco products
+        py manage.py scrape info -s tesco -r -e price
+
+    • keep tesco prices fresh with at most 1000 requests an hour
+        py manage.py scrape daemon -s tesco -e price --budget 1000
 """
 
 from django.core.management.base import BaseCommand
@@ -47,27 +120,26 @@ from django.db.models import Q
 
 import frugal_protein_scrapers as fps
 from products.models import Brands, ProductInfo
-from ._scrape import ScrapeHandler, STORES
+from ._scrape import ScrapeHandler, setup_logging
 
 
 
 class Command(BaseCommand):
     help = 'scrape product infos'
-    valid_stores = STORES
 
     def add_arguments(self, parser):
         # Positional arguments
         parser.add_argument(
             'type', 
-            nargs=1, type=str, choices=['id', 'info'],
+            nargs=1, type=str, choices=['id', 'info', 'daemon'],
             help='Specify to scrape ids or product info'
         )
         
         # Named arguments
         parser.add_argument(
             '-s', '--stores', 
-            nargs='+', type=str, choices=self.valid_stores,
-            help='The stores to scrape from'
+            nargs='+', type=str,
+            help='The stores to scrape from, as named in the Store registry'
         )
         parser.add_argument(
             '-l', '--live',
@@ -84,11 +156,113 @@ class Command(BaseCommand):
             nargs='+', type=str,
             help='Specify which info values to exclude from info scrape'
         )
+        parser.add_argument(
+            '-w', '--workers',
+            type=int, default=1,
+            help='Number of in-flight requests per store for info scrape'
+        )
+        parser.add_argument(
+            '-r', '--refresh',
+            action='store_true',
+            help='Overwrite prices, offers and nutrition that have changed'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float, default=5,
+            help='Starting requests per second per store for info scrape'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Resume the last unfinished info scrape from its checkpoint'
+        )
+        parser.add_argument(
+            '--metrics',
+            type=str,
+            help='Path of the JSON metrics summary for info scrape'
+        )
+        parser.add_argument(
+            '--metrics-stream',
+            type=str,
+            help='Stream per-product metrics as JSON lines to this path'
+        )
+        parser.add_argument(
+            '--cache',
+            type=str, choices=['passthrough', 'record', 'replay'],
+            help='Record scraper responses to, or replay them from, disk'
+        )
+        parser.add_argument(
+            '--cache-dir',
+            type=str,
+            help='Directory of the scraper response cache'
+        )
+        parser.add_argument(
+            '--cache-ttl',
+            type=float,
+            help='Hours after which cached responses expire'
+        )
+        parser.add_argument(
+            '--enqueue',
+            action='store_true',
+            help='Queue products needing info for scrape workers'
+        )
+        parser.add_argument(
+            '--worker',
+            action='store_true',
+            help='Scrape info of queued products, leasing them in batches'
+        )
+        parser.add_argument(
+            '--lease-size',
+            type=int, default=50,
+            help='Number of products a worker leases at a time'
+        )
+        parser.add_argument(
+            '--lease-ttl',
+            type=int, default=300,
+            help='Seconds before an unrenewed lease expires'
+        )
+        parser.add_argument(
+            '--image-dir',
+            type=str,
+            help='Save product images to this directory instead of S3'
+        )
+        parser.add_argument(
+            '--budget',
+            type=int, default=600,
+            help='Requests per hour for scrape daemon'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float, default=300,
+            help='Seconds between scrape daemon cycles'
+        )
+        parser.add_argument(
+            '--cycles',
+            type=int,
+            help='Number of scrape daemon cycles to run'
+        )
+        parser.add_argument(
+            '--stale-after',
+            type=float, default=24,
+            help='Hours after which scrape daemon re-scrapes a product'
+        )
+        parser.add_argument(
+            '--id-interval',
+            type=float, default=24,
+            help='Hours between id scrapes of a store by scrape daemon'
+        )
 
     def handle(self, *args, **options):
+        setup_logging()
         handler = ScrapeHandler(*args, **options)
         scrape_type = options['type'][0]
         if scrape_type == 'id':
             handler.execute_id_scrape()
+        elif scrape_type == 'info' and options['enqueue']:
+            handler.execute_enqueue()
+        elif scrape_type == 'info' and options['worker']:
+            handler.execute_worker()
         elif scrape_type == 'info':
-            handler.execute_info_scrape()
\ No newline at end of file
+            handler.execute_info_scrape()
+        elif scrape_type == 'daemon':
+            handler.execute_daemon()
\ No newline at end of file
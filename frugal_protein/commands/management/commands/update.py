@@ -10,8 +10,8 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             'process',
-            nargs=1, type=str, choices=['local-heroku', 'heroku'],
-            help='Specify whether to transfer filtered products to local live db (local-heroku) or to update heroku db from local live db'
+            nargs=1, type=str, choices=['local-heroku', 'heroku', 'rollback-local-heroku'],
+            help='Specify whether to transfer filtered products to local live db (local-heroku), swap the previous products back into it (rollback-local-heroku) or to update heroku db from local live db'
         )
 
     def handle(self, *args, **options):
@@ -20,6 +20,8 @@ class Command(BaseCommand):
             self.update_heroku.execute()
         elif process == 'local-heroku':
             self.update_local_heroku.execute()
+        elif process == 'rollback-local-heroku':
+            self.update_local_heroku.rollback()
 
     
     
\ No newline at end of file
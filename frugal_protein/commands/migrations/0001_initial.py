@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapeRun',
+            fields=[
+                ('run_id', models.AutoField(primary_key=True, serialize=False)),
+                ('database', models.CharField(max_length=20)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScrapeCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('store', models.CharField(max_length=20)),
+                ('last_pid', models.IntegerField(default=0)),
+                ('succeeded', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='commands.ScrapeRun')),
+            ],
+            options={
+                'unique_together': {('run', 'store')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commands', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapeTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pid', models.IntegerField()),
+                ('store', models.CharField(max_length=20)),
+                ('database', models.CharField(max_length=20)),
+                ('lease_owner', models.CharField(max_length=100, null=True)),
+                ('lease_expires', models.DateTimeField(db_index=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('database', 'store', 'pid')},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commands', '0002_scrapetask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreScrape',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('store', models.CharField(max_length=20)),
+                ('database', models.CharField(max_length=20)),
+                ('scraped', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('database', 'store')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductScrape',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pid', models.IntegerField()),
+                ('store', models.CharField(max_length=20)),
+                ('database', models.CharField(max_length=20)),
+                ('scraped', models.DateTimeField()),
+                ('failed', models.BooleanField(default=False)),
+            ],
+            options={
+                'unique_together': {('database', 'store', 'pid')},
+            },
+        ),
+    ]
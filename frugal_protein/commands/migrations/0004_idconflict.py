@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commands', '0003_scrape_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdConflict',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('store', models.CharField(max_length=20)),
+                ('store_pid', models.CharField(max_length=20)),
+                ('barcode', models.CharField(max_length=20)),
+                ('database', models.CharField(max_length=20)),
+                ('seen', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('database', 'store', 'store_pid', 'barcode')},
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:06
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commands', '0004_idconflict'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ProductScrape',
+        ),
+    ]
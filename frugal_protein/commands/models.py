@@ -1,3 +1,67 @@
 from django.db import models
 
-# Create your models here.
+
+class ScrapeRun(models.Model):
+    """ A single info scrape run; unfinished runs can be resumed """
+    run_id = models.AutoField(primary_key=True)
+    database = models.CharField(max_length=20)  # db alias that was scraped
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+
+class ScrapeCheckpoint(models.Model):
+    """
+    Progress of a run for one store. Products are processed in pid order and
+    every product with a pid up to last_pid has been processed.
+    """
+    run = models.ForeignKey(ScrapeRun, on_delete=models.CASCADE,
+                            related_name='checkpoints')
+    store = models.CharField(max_length=20)
+    last_pid = models.IntegerField(default=0)
+    succeeded = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('run', 'store')
+
+
+class ScrapeTask(models.Model):
+    """
+    A product queued for `scrape info --worker`. Workers lease tasks in
+    batches; a lease that isn't renewed before lease_expires is up for grabs.
+    """
+    pid = models.IntegerField()  # ProductInfo.pid on `database`
+    store = models.CharField(max_length=20)
+    database = models.CharField(max_length=20)
+    lease_owner = models.CharField(max_length=100, null=True)
+    lease_expires = models.DateTimeField(null=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('database', 'store', 'pid')
+
+
+class StoreScrape(models.Model):
+    """ When a store's ids were last scraped """
+    store = models.CharField(max_length=20)
+    database = models.CharField(max_length=20)
+    scraped = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('database', 'store')
+
+
+class IdConflict(models.Model):
+    """
+    A scraped (barcode, store pid) pair whose barcode and store pid belong to
+    different products. Conflicts are merged by the reconcile command.
+    """
+    store = models.CharField(max_length=20)
+    store_pid = models.CharField(max_length=20)
+    barcode = models.CharField(max_length=20)
+    database = models.CharField(max_length=20)
+    seen = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('database', 'store', 'store_pid', 'barcode')
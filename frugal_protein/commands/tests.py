@@ -1,12 +1,75 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import skipIf, skipUnless
 from unittest.mock import patch
 
+from PIL import Image
+
 from django.core.management import call_command
+from django.core.exceptions import ValidationError
 from django.core.management.base import CommandError
+from django.db import connection, connections
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from products.models import ProductInfo, Brands
+from commands.models import (IdConflict, ScrapeCheckpoint, ScrapeRun,
+                             ScrapeTask, StoreScrape)
+from products.models import (CatalogVersion, ProductInfo, Brands, Store,
+                             StoreListing)
 from commands.management.commands.scrape import Command
-from commands.management.commands._scrape import ScrapeHandler, STORES, Util
+from commands.management.commands._scrape import ScrapeHandler, Util
+from commands.management.commands._brands import BrandResolver
+from commands.management.commands._cache import CacheMiss, ResponseCache
+from commands.management.commands._checkpoint import RunCheckpoint, Watermark
+from commands.management.commands._concurrent import (FetchTiming,
+                                                       IdScrapePipeline,
+                                                       InfoScrapeEngine,
+                                                       ScrapeResult)
+from commands.management.commands._ids import IdIndex
+from commands.management.commands._metrics import ScrapeMetrics, percentile
+from commands.management.commands._planner import ScrapePlanner
+from commands.management.commands._queue import WorkQueue
+from commands.management.commands._reconcile import (ProductReconciler,
+                                                      UnionFind)
+from commands.management.commands._scheduler import (ScrapeHistory,
+                                                      ScrapeScheduler)
+from commands.management.commands._staging import InfoStage
+from commands.management.commands._sync import LiveSync, TableDiff
+from commands.management.commands._update import UpdateHeroku, UpdateLiveDB
+from commands.management.commands._throttle import (CircuitBreaker,
+                                                     StoreThrottle,
+                                                     TokenBucket)
+from commands.management.commands._images import (ImageUploader,
+                                                   LocalImageStorage)
+
+
+def create_product(stores=None, using='default', **fields):
+    """
+    Creates a ProductInfo with a StoreListing per store. stores maps a store
+    to its store pid, or to a dict of StoreListing values.
+    """
+    product = ProductInfo.objects.using(using).create(**fields)
+    for store, listing in (stores or {}).items():
+        if not isinstance(listing, dict):
+            listing = {'pid': listing}
+        StoreListing.objects.using(using).create(product=product,
+                                                 store_id=store, **listing)
+    return product
+
+
+def get_product(store, pid, using='default'):
+    """ Returns the ProductInfo listed by a store under its store pid """
+    return ProductInfo.objects.using(using).get(listings__store=store,
+                                                listings__pid=pid)
+
+
+def get_listing(store, pid, using='default'):
+    return StoreListing.objects.using(using).get(store=store, pid=pid)
 
 
 class TestScrapeUtil(TestCase):
@@ -39,24 +102,41 @@ class TestScrapeUtil(TestCase):
         self.assertEqual(len(row), 1) # Assert no new db insertion
         self.assertEqual(row[0], brand)
 
-    def test_prepend_dict_keys(self):
-        """ 
-        Should prepend store name to price dict keys to match model field 
-        """
-        price_dict = {
-            'base_price': None,
-            'sale_price': None,
-            'offer_price': None,
-            'offer_text': None
-        }
-        e_res = {
-            'tesco_base_price': None,
-            'tesco_sale_price': None,
-            'tesco_offer_price': None,
-            'tesco_offer_text': None
-        }
-        res = Util.prepend_dict_keys(price_dict, 'tesco')
-        self.assertEqual(res, e_res)
+    def test_get_brand_obj_matches_normalised_name(self):
+        brand = Brands.objects.create(brand='Brand  A')
+        res = Util.get_brand_obj(' brand a')
+        self.assertEqual(res, brand)
+        self.assertEqual(Brands.objects.count(), 1)
+
+
+class TestBrandResolver(TestCase):
+    def test_known_brands_resolved_without_queries(self):
+        brand = Brands.objects.create(brand='brandA')
+        resolver = BrandResolver()
+        resolver.preload()
+
+        with self.assertNumQueries(0):
+            res = resolver.get('BRANDA ')
+
+        self.assertEqual(res, brand)
+
+    def test_missing_brands_created_once(self):
+        resolver = BrandResolver()
+        res = resolver.resolve_many(['Brand X', 'brand  x', 'Brand Y'])
+
+        self.assertEqual(Brands.objects.count(), 2)
+        self.assertEqual(res['Brand X'], res['brand  x'])
+        self.assertEqual(res['Brand Y'].brand, 'Brand Y')
+
+    def test_brand_created_by_another_scraper_is_reused(self):
+        resolver = BrandResolver()
+        resolver.preload()
+        other = Brands.objects.create(brand='brandA')
+
+        res = resolver.get('BrandA')
+
+        self.assertEqual(res, other)
+        self.assertEqual(Brands.objects.count(), 1)
 
 
 class TestScrapeIds(TestCase):
@@ -86,52 +166,99 @@ class TestScrapeIds(TestCase):
         # Assert
         res = ProductInfo.objects.all()
         self.assertEqual(len(res), 6)
+        self.assertEqual(StoreListing.objects.filter(store='tesco').count(), 6)
+
+    @patch('commands.management.commands.scrape.fps.scrape_ids')
+    def test_product_new_to_two_stores_inserted_once(self, mock_scrape_ids):
+        pages = {'tesco': [[{'barcode': 'X', 'pid': 't1'}]],
+                 'iceland': [[{'barcode': 'X', 'pid': 'i1'}]]}
+        mock_scrape_ids.side_effect = lambda store: pages[store]
 
+        call_command('scrape', 'id', '-s', 'tesco', 'iceland')
 
-    def test_update_id_case_1(self):
+        res = get_product('tesco', 't1')
+        self.assertEqual(ProductInfo.objects.count(), 1)
+        self.assertEqual(res.barcode, 'X')
+        self.assertEqual(res.listing('iceland').pid, 'i1')
+
+    @patch('commands.management.commands.scrape.fps.scrape_ids')
+    def test_id_dicts_without_pid_skipped(self, mock_scrape_ids):
+        """ If id_dict has no pid value, no db actions should be taken """
+        mock_scrape_ids.return_value = [[{'barcode': '1', 'pid': None}]]
+
+        call_command('scrape', 'id', '-s=tesco')
+
+        self.assertEqual(ProductInfo.objects.count(), 0)
+
+    def test_unknown_store_rejected(self):
+        with self.assertRaises(CommandError):
+            ScrapeHandler(**dict(self.mock_options, type=['id'],
+                                 stores=['aldi']))
+
+    def test_stores_read_from_registry(self):
+        Store.objects.create(name='aldi', title='Aldi')
+        handler = ScrapeHandler(**dict(self.mock_options, type=['id']))
+        self.assertEqual(handler.stores, ['aldi', 'iceland', 'tesco'])
+
+
+class TestIdIndex(TestCase):
+    def test_new_product_inserted(self):
         """ New products should result in new db rows """
-        # Arrange
-        options = self.mock_options
-        options.update({'type': ['id']}) # manage.py scrape id
-        handler = ScrapeHandler(**options) 
-        new_product = {'barcode': '1', 'pid': '11'}
+        index = IdIndex.load('tesco')
 
-        # Act
-        handler._update_ids(new_product, 'tesco')
+        res = index.apply([{'barcode': '1', 'pid': '11'}])
 
-        # Assert
+        self.assertEqual(res, (1, 0))
         row = ProductInfo.objects.all()
         self.assertEqual(len(row), 1)
         self.assertEqual(row[0].barcode, '1')
-        self.assertEqual(row[0].tesco, '11')
-    
-    def test_update_id_case_2(self):
+        self.assertEqual(row[0].listing('tesco').pid, '11')
+
+    def test_existing_product_listed(self):
         """ Existing products should be updated """
-        options = self.mock_options
-        options.update({'type': ['id']}) # manage.py scrape id
-        handler = ScrapeHandler(**options)
+        ProductInfo.objects.create(barcode='1')
+        index = IdIndex.load('tesco')
 
-        existing_product = {'barcode': '1', 'pid': '11'}
-        ProductInfo.objects.create(barcode=1)
-        
-        handler._update_ids(existing_product, 'tesco')
+        res = index.apply([{'barcode': '1', 'pid': '11'}])
 
+        self.assertEqual(res, (0, 1))
         row = ProductInfo.objects.all()
         self.assertEqual(len(row), 1)
         self.assertEqual(row[0].barcode, '1')
-        self.assertEqual(row[0].tesco, '11')
+        self.assertEqual(row[0].listing('tesco').pid, '11')
 
-    def test_update_id_case_3(self):
-        """ If id_dict has no pid value, no db actions should be taken """
-        options = self.mock_options
-        options.update({'type': ['id']}) # manage.py scrape id
-        handler = ScrapeHandler(**options)
+    def test_page_written_in_constant_number_of_queries(self):
+        ProductInfo.objects.create(barcode='0')
+        index = IdIndex.load('tesco')
+        page = [{'barcode': str(i), 'pid': str(i)} for i in range(50)]
+
+        with CaptureQueriesContext(connection) as ctx:
+            inserted, updated = index.apply(page)
+
+        self.assertEqual((inserted, updated), (49, 1))
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+        self.assertEqual(ProductInfo.objects.count(), 50)
+        self.assertEqual(get_product('tesco', '0').barcode, '0')
 
-        id_dict = {'barcode': '1', 'pid': None}
-        handler._update_ids(id_dict, 'tesco')
+    def test_duplicates_across_pages_inserted_once(self):
+        index = IdIndex.load('tesco')
+        index.apply([{'barcode': None, 'pid': '1'}])
+        index.apply([{'barcode': '11', 'pid': '1'},
+                     {'barcode': '11', 'pid': '1'}])
 
         row = ProductInfo.objects.all()
-        self.assertEqual(len(row), 0)
+        self.assertEqual(len(row), 1)
+        self.assertEqual(row[0].barcode, '11')
+
+    def test_conflicting_ids_are_skipped(self):
+        ProductInfo.objects.create(barcode='1')
+        create_product({'tesco': '11'})
+        index = IdIndex.load('tesco')
+
+        res = index.apply([{'barcode': '1', 'pid': '11'}])
+
+        self.assertEqual(res, (0, 0))
+        self.assertIsNone(ProductInfo.objects.get(barcode='1').listing('tesco'))
 
 
 class TestScrapeInfo(TestCase):
@@ -144,7 +271,7 @@ class TestScrapeInfo(TestCase):
     }
 
     mock_info_dict = {'description': 'b',
-                      'brand': Brands.objects.create(brand='brandB'),
+                      'brand': 'brandB',
                       'qty':{'qty': 2,
                              'num_of_units': 2,
                              'total_qty': 2,
@@ -162,72 +289,70 @@ class TestScrapeInfo(TestCase):
 
     @patch('commands.management.commands.scrape.fps.scrape_infos')
     def test_scrape_info_integrations(self, mock_scrape_infos):
-        # Arrange (1)
-        mock_product = ProductInfo.objects.create(tesco='1')
-        with patch.object(ProductInfo, 'objects') as mock_ProductInfo_objects:
-            mock_ProductInfo_objects.filter.return_value = [mock_product]
-
-            mock_info_dict = self.mock_info_dict
-            mock_info_dict['brand'] = 'brandB'
-            mock_scrape_infos.return_value = mock_info_dict
-            
-            # Act
-            call_command('scrape', 'info', '-s=tesco')
+        # Arrange
+        create_product({'tesco': '1'})
+        mock_scrape_infos.return_value = self.mock_info_dict
+
+        # Act
+        call_command('scrape', 'info', '-s=tesco')
 
         # Assert
-        res = ProductInfo.objects.get(tesco='1')
+        res = get_product('tesco', '1')
         self.assertEqual(res.description, 'b')
         self.assertIsInstance(res.brand, Brands)
         self.assertEqual(res.brand.brand, 'brandB')
 
     def test_update_info_description(self):
-        product = ProductInfo.objects.create(tesco='1')
+        product = create_product({'tesco': '1'})
 
         options = self.mock_options
         options['type'] = 'info'
         handler = ScrapeHandler(**options)
-        handler._update_infos({'description': 'x'}, product, 'tesco')
+        handler._write_results(
+            [ScrapeResult('tesco', product, {'description': 'x'}, None, 0)])
 
-        res = ProductInfo.objects.get(tesco=1)
+        res = get_product('tesco', '1')
         self.assertEqual(res.description, 'x')
 
     def test_update_info_brand(self):
-        product = ProductInfo.objects.create(tesco='1')
+        product = create_product({'tesco': '1'})
         brand = Brands.objects.create(brand='brandX')
 
         options = self.mock_options
         options['type'] = 'info'
         handler = ScrapeHandler(**options)
-        handler._update_infos({'brand': 'brandX'}, product, 'tesco')
+        handler._write_results(
+            [ScrapeResult('tesco', product, {'brand': 'brandX'}, None, 0)])
 
-        res = ProductInfo.objects.get(tesco=1)
+        res = get_product('tesco', '1')
         self.assertEqual(res.brand, brand)
 
     def test_update_info_qty(self):
-        product = ProductInfo.objects.create(tesco='1')
+        product = create_product({'tesco': '1'})
         qty = {'qty': self.mock_info_dict['qty']}
 
         options = self.mock_options
         options['type'] = 'info'
         handler = ScrapeHandler(**options)
-        handler._update_infos(qty, product, 'tesco')
+        handler._write_results([ScrapeResult('tesco', product, qty, None, 0)])
 
-        res = ProductInfo.objects.get(tesco=1)
+        res = get_product('tesco', '1')
         self.assertEqual(res.qty, 2)
         self.assertEqual(res.num_of_units, 2)
         self.assertEqual(res.total_qty, 2)
         self.assertEqual(res.unit_of_measurement, 'b')
 
     def test_update_info_nutrition(self):
-        product = ProductInfo.objects.create(tesco='1')
+        product = create_product({'tesco': '1'})
         nutrition = {'nutrition': self.mock_info_dict['nutrition']}
 
         options = self.mock_options
         options['type'] = 'info'
         handler = ScrapeHandler(**options)
-        handler._update_infos(nutrition, product, 'tesco')
+        handler._write_results(
+            [ScrapeResult('tesco', product, nutrition, None, 0)])
         
-        res = ProductInfo.objects.get(tesco=1)
+        res = get_product('tesco', '1')
         self.assertEqual(res.header, 'b')
         self.assertEqual(res.kcal, 2)
         self.assertEqual(res.fat, 2)
@@ -235,19 +360,20 @@ class TestScrapeInfo(TestCase):
         self.assertEqual(res.protein, 2)
 
     def test_update_info_price(self):
-        product = ProductInfo.objects.create(tesco='1')
+        product = create_product({'tesco': '1'})
         price = {'price': self.mock_info_dict['price']}
 
         options = self.mock_options
         options['type'] = 'info'
         handler = ScrapeHandler(**options)
-        handler._update_infos(price, product, 'tesco')
+        handler._write_results(
+            [ScrapeResult('tesco', product, price, None, 0)])
         
-        res = ProductInfo.objects.get(tesco=1)
-        self.assertEqual(res.tesco_base_price, 2)
-        self.assertEqual(res.tesco_sale_price, 2)
-        self.assertEqual(res.tesco_offer_price, 2)
-        self.assertEqual(res.tesco_offer_text, 'b')
+        res = get_listing('tesco', '1')
+        self.assertEqual(res.base, 2)
+        self.assertEqual(res.sale, 2)
+        self.assertEqual(res.offer, 2)
+        self.assertEqual(res.offer_text, 'b')
 
     def test_update_info_does_not_overwrite_existing(self):
         """ Existing info should not be overwritten """
@@ -262,18 +388,20 @@ class TestScrapeInfo(TestCase):
                      'kcal': 1,
                      'fat': 1,
                      'carb': 1,
-                     'protein': 1,
-                     'tesco_base_price': 1,
-                     'tesco_sale_price': 1,
-                     'tesco_offer_price': 1,
-                     'tesco_offer_text': 'a'}
+                     'protein': 1}
+        listing_1 = {'pid': '1',
+                     'base': 1,
+                     'sale': 1,
+                     'offer': 1,
+                     'offer_text': 'a'}
         
         # Act
-        row = ProductInfo.objects.create(**product_1)
+        row = create_product({'tesco': listing_1}, **product_1)
         options = self.mock_options
         options['type'] = 'info'
         handler = ScrapeHandler(**options)
-        handler._update_infos(self.mock_info_dict, row, 'tesco')
+        handler._write_results(
+            [ScrapeResult('tesco', row, self.mock_info_dict, None, 0)])
 
         # Assert
         res = ProductInfo.objects.all()
@@ -289,10 +417,878 @@ class TestScrapeInfo(TestCase):
         self.assertEqual(res[0].fat, 1)
         self.assertEqual(res[0].carb, 1)
         self.assertEqual(res[0].protein, 1)
-        self.assertEqual(res[0].tesco_base_price, 1)
-        self.assertEqual(res[0].tesco_sale_price, 1)
-        self.assertEqual(res[0].tesco_offer_price, 1)
-        self.assertEqual(res[0].tesco_offer_text, 'a')
+        listing = get_listing('tesco', '1')
+        self.assertEqual(listing.base, 1)
+        self.assertEqual(listing.sale, 1)
+        self.assertEqual(listing.offer, 1)
+        self.assertEqual(listing.offer_text, 'a')
+
+
+class TestInfoScrapeEngine(TestCase):
+    def test_results_returned_for_every_product(self):
+        engine = InfoScrapeEngine(lambda p, s, t: {'description': p},
+                                  workers=3)
+        jobs = {'tesco': ['a', 'b', 'c'], 'iceland': ['d', 'e']}
+
+        res = list(engine.run(jobs))
+
+        self.assertEqual(len(res), 5)
+        self.assertEqual({r.product for r in res if r.store == 'tesco'},
+                         {'a', 'b', 'c'})
+        self.assertTrue(all(r.info_dict == {'description': r.product}
+                            for r in res))
+
+    def test_in_flight_requests_capped_per_store(self):
+        lock = threading.Lock()
+        in_flight = {'tesco': 0}
+        peak = {'tesco': 0}
+
+        def fetch(product, store, timing):
+            with lock:
+                in_flight[store] += 1
+                peak[store] = max(peak[store], in_flight[store])
+            time.sleep(0.01)
+            with lock:
+                in_flight[store] -= 1
+            return {}
+
+        engine = InfoScrapeEngine(fetch, workers=2)
+        list(engine.run({'tesco': list(range(10))}))
+
+        self.assertLessEqual(peak['tesco'], 2)
+
+    def test_errors_are_returned_not_raised(self):
+        def fetch(product, store, timing):
+            raise ValueError('blocked')
+
+        engine = InfoScrapeEngine(fetch, workers=2)
+        res = list(engine.run({'tesco': ['a']}))
+
+        self.assertIsNone(res[0].info_dict)
+        self.assertIsInstance(res[0].error, ValueError)
+
+    def test_waits_not_counted_as_latency(self):
+        def fetch(product, store, timing):
+            timing.wait += 30
+            timing.latency = 0.25
+            return {}
+
+        res = list(InfoScrapeEngine(fetch).run({'tesco': ['a']}))
+
+        self.assertEqual((res[0].latency, res[0].wait), (0.25, 30))
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_concurrent_scrape_writes_all_products(self, mock_scrape_infos):
+        for i in range(5):
+            create_product({'tesco': str(i)})
+        mock_scrape_infos.side_effect = \
+            lambda pid, store, **kwargs: {'description': f'product {pid}'}
+
+        call_command('scrape', 'info', '-s=tesco', '-w=3')
+
+        for p in ProductInfo.objects.all():
+            self.assertEqual(p.description,
+                             f'product {p.listing("tesco").pid}')
+
+
+class TestIdScrapePipeline(TestCase):
+    def test_duplicate_pids_dropped_across_pages(self):
+        pages = [[{'barcode': '1', 'pid': '11'}, {'barcode': '1', 'pid': '11'}],
+                 [{'barcode': '1', 'pid': '11'}, {'barcode': '2', 'pid': '22'}]]
+        pipeline = IdScrapePipeline(lambda store: pages)
+
+        res = [d['pid'] for page in pipeline.run(['tesco', 'iceland'])
+               for d in page.id_dicts if page.store == 'tesco']
+
+        self.assertEqual(res, ['11', '22'])
+        self.assertEqual(pipeline.duplicates, {'tesco': 2, 'iceland': 2})
+
+    def test_repeat_with_new_barcode_kept(self):
+        pages = [[{'barcode': None, 'pid': '11'}],
+                 [{'barcode': '1', 'pid': '11'}, {'barcode': None, 'pid': '11'}],
+                 [{'barcode': '1', 'pid': '11'}]]
+        pipeline = IdScrapePipeline(lambda store: pages)
+
+        res = [d for page in pipeline.run(['tesco']) for d in page.id_dicts]
+
+        self.assertEqual(res, [{'barcode': None, 'pid': '11'},
+                               {'barcode': '1', 'pid': '11'}])
+        self.assertEqual(pipeline.duplicates, {'tesco': 2})
+
+    def test_next_page_fetched_while_page_written(self):
+        fetched = []
+        third_page = threading.Event()
+
+        def scrape_ids(store):
+            for i in range(3):
+                fetched.append(i)
+                if i == 2:
+                    third_page.set()
+                yield [{'barcode': None, 'pid': str(i)}]
+
+        pipeline = IdScrapePipeline(scrape_ids, max_pages=1)
+        pages = pipeline.run(['tesco'])
+        next(pages)
+        # The writer holds page 0 while the producer fetches ahead, but no
+        # further than the queue allows
+        self.assertTrue(third_page.wait(1))
+        self.assertEqual(fetched, [0, 1, 2])
+        self.assertEqual(len(list(pages)), 2)
+
+    def test_store_error_yielded_after_pages(self):
+        def scrape_ids(store):
+            yield [{'barcode': None, 'pid': '1'}]
+            raise ValueError('blocked')
+
+        res = list(IdScrapePipeline(scrape_ids).run(['tesco']))
+
+        self.assertEqual(len(res[0].id_dicts), 1)
+        self.assertIsInstance(res[1].error, ValueError)
+
+    @patch('commands.management.commands.scrape.fps.scrape_ids')
+    def test_failed_store_not_recorded_as_scraped(self, mock_scrape_ids):
+        def scrape_ids(store):
+            if store == 'iceland':
+                raise ValueError('blocked')
+            yield [{'barcode': '1', 'pid': '11'}]
+        mock_scrape_ids.side_effect = scrape_ids
+
+        call_command('scrape', 'id')
+
+        self.assertEqual(ProductInfo.objects.get().listing('tesco').pid, '11')
+        self.assertEqual(list(StoreScrape.objects.values_list('store',
+                                                              flat=True)),
+                         ['tesco'])
+
+
+class TestScrapePlanner(TestCase):
+    complete = {'description': 'a',
+                'qty': 1,
+                'protein': 1,
+                'img': '/product_images/1.jpg'}
+
+    def test_only_missing_fields_planned(self):
+        brand = Brands.objects.create(brand='brandA')
+        product = create_product({'tesco': '1'}, description='a',
+                                 brand=brand, qty=1)
+
+        res = ScrapePlanner().plan([product], 'tesco')
+
+        self.assertEqual(res[0].scrape_fields, 'image nutrition price')
+
+    def test_complete_products_skipped(self):
+        brand = Brands.objects.create(brand='brandA')
+        product = create_product({'tesco': {'pid': '1', 'base': 1}},
+                                 brand=brand, **self.complete)
+
+        res = ScrapePlanner().plan([product], 'tesco')
+
+        self.assertEqual(res, [])
+
+    def test_operator_fields_respected(self):
+        product = create_product({'tesco': '1'})
+        planner = ScrapePlanner(exclusive='price description', exclude='price')
+
+        res = planner.plan([product], 'tesco')
+
+        self.assertEqual(res[0].scrape_fields, 'description')
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_scrape_info_requests_missing_fields(self, mock_scrape_infos):
+        brand = Brands.objects.create(brand='brandA')
+        create_product({'tesco': {'pid': '1', 'base': 1}}, brand=brand,
+                       **self.complete)
+        create_product({'tesco': '2'}, brand=brand, **self.complete)
+        mock_scrape_infos.return_value = {}
+
+        call_command('scrape', 'info', '-s=tesco')
+
+        mock_scrape_infos.assert_called_once_with('2', 'tesco',
+                                                  exclusive='price',
+                                                  exclude='')
+
+
+class TestImageUploader(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_close_flushes_queued_uploads(self):
+        uploader = ImageUploader(LocalImageStorage(self.tmp.name), workers=2,
+                                 max_queued=2)
+        for i in range(5):
+            path = uploader.submit(Image.new('RGBA', (4, 4)), f'{i}.jpg')
+        uploader.close()
+
+        self.assertEqual(path, '/product_images/4.jpg')
+        self.assertEqual(uploader.uploaded, 5)
+        files = os.listdir(os.path.join(self.tmp.name, 'product_images'))
+        self.assertEqual(len(files), 5)
+        self.assertEqual(sorted(uploader.take_saved()),
+                         [f'{i}.jpg' for i in range(5)])
+        self.assertEqual(uploader.take_saved(), [])
+
+    def test_failed_uploads_are_recorded(self):
+        class BrokenStorage:
+            def save(self, name, fileobj):
+                raise IOError('no connection')
+
+        uploader = ImageUploader(BrokenStorage())
+        uploader.submit(Image.new('RGB', (4, 4)), '1.jpg')
+        uploader.close()
+
+        self.assertEqual(uploader.failed, ['1.jpg'])
+        self.assertEqual(uploader.take_saved(), [])
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_scrape_info_uploads_image(self, mock_scrape_infos):
+        product = create_product({'tesco': '1'})
+        mock_scrape_infos.return_value = {'img': Image.new('RGB', (4, 4))}
+
+        call_command('scrape', 'info', '-s=tesco', f'--image-dir={self.tmp.name}')
+
+        res = get_product('tesco', '1')
+        self.assertEqual(res.img.name, f'/product_images/{product.pid}.jpg')
+        path = os.path.join(self.tmp.name, 'product_images',
+                            f'{product.pid}.jpg')
+        self.assertTrue(os.path.isfile(path))
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_failed_upload_leaves_default_image(self, mock_scrape_infos):
+        create_product({'tesco': '1'})
+        mock_scrape_infos.return_value = {'img': Image.new('RGB', (4, 4))}
+
+        with patch.object(LocalImageStorage, 'save',
+                          side_effect=IOError('disk full')):
+            call_command('scrape', 'info', '-s=tesco',
+                         f'--image-dir={self.tmp.name}')
+
+        res = get_product('tesco', '1')
+        self.assertTrue(res.img.name.endswith('default.png'))
+
+
+class TestRefresh(TestCase):
+    mock_options = {
+        'type': ['info'],
+        'stores': None,
+        'live': False,
+        'exclusive': None,
+        'exclude': None,
+        'refresh': True
+    }
+    price = {'base_price': 2,
+             'sale_price': None,
+             'offer_price': None,
+             'offer_text': None}
+
+    def setUp(self):
+        self.handler = ScrapeHandler(**self.mock_options)
+        self.product = create_product({'tesco': {'pid': '1', 'base': 2}},
+                                      description='a')
+
+    def test_unchanged_row_not_written(self):
+        result = ScrapeResult('tesco', self.product, {'price': self.price},
+                              None, 0)
+        self.handler._write_results([result])
+        self.assertEqual(self.handler.write_counts['unchanged'], 1)
+        self.assertEqual(self.handler.write_counts['updated'], 0)
+
+    def test_batch_written_in_constant_statements(self):
+        def write(n):
+            products = [create_product({'tesco': str(n * 100 + i)})
+                        for i in range(n)]
+            results = [ScrapeResult('tesco', p, {'price': self.price,
+                                                 'description': 'b'}, None, 0)
+                       for p in products]
+            with CaptureQueriesContext(connection) as queries:
+                self.handler._write_results(results)
+            return len(queries)
+
+        self.assertEqual(write(1), write(50))
+        self.assertEqual(self.handler.write_counts['updated'], 51)
+        self.assertEqual(
+            ProductInfo.objects.filter(description='b', listings__store='tesco',
+                                       listings__base=2).count(), 51)
+
+    def test_changed_price_overwritten(self):
+        price = dict(self.price, offer_price=1, offer_text='half price')
+        result = ScrapeResult('tesco', self.product, {'price': price}, None, 0)
+
+        self.handler._write_results([result])
+
+        res = get_listing('tesco', '1')
+        self.assertEqual(res.offer, 1)
+        self.assertEqual(res.offer_text, 'half price')
+        self.assertEqual(self.handler.write_counts['updated'], 1)
+
+    def test_only_dirty_fields_written(self):
+        # Change a column behind the handler's back; it must not be reverted
+        ProductInfo.objects.filter(pid=self.product.pid).update(description='b')
+        price = dict(self.price, base_price=3)
+
+        result = ScrapeResult('tesco', self.product, {'price': price}, None, 0)
+
+        self.handler._write_results([result])
+
+        res = get_product('tesco', '1')
+        self.assertEqual(self.handler.write_counts['updated'], 1)
+        self.assertEqual(res.listing('tesco').base, 3)
+        self.assertEqual(res.description, 'b')
+
+    def test_prices_not_overwritten_without_refresh(self):
+        handler = ScrapeHandler(**dict(self.mock_options, refresh=False))
+        price = dict(self.price, base_price=3)
+
+        result = ScrapeResult('tesco', self.product, {'price': price}, None, 0)
+
+        handler._write_results([result])
+
+        self.assertEqual(handler.write_counts['unchanged'], 1)
+        self.assertEqual(get_listing('tesco', '1').base, 2)
+
+
+class TestInfoStage(TestCase):
+    def test_only_empty_fields_filled(self):
+        full = create_product({'tesco': '1'}, description='a', qty=1)
+        empty = create_product({'tesco': '2'})
+        info_dict = {'description': 'b',
+                     'qty': {'qty': 2,
+                             'num_of_units': 1,
+                             'total_qty': 2,
+                             'unit_of_measurement': 'kg'}}
+        stage = InfoStage()
+        stage.add('tesco', full.pid, info_dict)
+        stage.add('tesco', empty.pid, info_dict)
+
+        updated, errors = stage.merge()
+
+        self.assertEqual((updated, errors), (1, {}))
+        full.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual((full.description, full.qty), ('a', 1))
+        self.assertEqual((empty.description, empty.qty), ('b', 2))
+        self.assertEqual(empty.unit_of_measurement, 'kg')
+
+    def test_prices_merged_into_store_listing(self):
+        product = create_product({'tesco': {'pid': '1', 'base': 2},
+                                  'iceland': {'pid': '1', 'base': 3}})
+        price = {'base_price': 1, 'sale_price': None, 'offer_price': None,
+                 'offer_text': None}
+        stage = InfoStage(refresh=True)
+        stage.add('tesco', product.pid, {'price': price, 'description': 'a'})
+
+        updated, errors = stage.merge()
+
+        self.assertEqual((updated, errors), (1, {}))
+        self.assertEqual(get_listing('tesco', '1').base, 1)
+        self.assertEqual(get_listing('iceland', '1').base, 3)
+
+    def test_invalid_value_rejected_when_staged(self):
+        stage = InfoStage()
+        nutrition = {'header': 'per 100g', 'protein': 123456}
+
+        with self.assertRaises(ValidationError):
+            stage.add('tesco', 1, {'nutrition': nutrition})
+        self.assertEqual(len(stage), 0)
+
+    def test_copy_values_escaped(self):
+        res = [InfoStage._copy_value(v)
+               for v in (None, True, 'a\tb', 'a\tb\nc\\')]
+        self.assertEqual(res, ['\\N', 't', 'a\\tb', 'a\\tb\\nc\\\\'])
+
+
+class TestCheckpoint(TestCase):
+    def test_watermark_waits_for_smaller_pids(self):
+        mark = Watermark([1, 2, 3, 5])
+        mark.done(2)
+        mark.done(5)
+        self.assertEqual(mark.value, 0)
+        mark.done(1)
+        self.assertEqual(mark.value, 2)
+        mark.done(3)
+        self.assertEqual(mark.value, 5)
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_checkpoint_saved_with_counts(self, mock_scrape_infos):
+        products = [create_product({'tesco': str(i)}) for i in range(3)]
+        mock_scrape_infos.side_effect = [{}, ValueError('timeout'), {}]
+
+        call_command('scrape', 'info', '-s=tesco')
+
+        checkpoint = ScrapeCheckpoint.objects.get(store='tesco')
+        self.assertEqual(checkpoint.last_pid, products[-1].pid)
+        self.assertEqual(checkpoint.succeeded, 2)
+        self.assertEqual(checkpoint.failed, 1)
+        self.assertIsNotNone(checkpoint.run.finished)
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_resume_skips_processed_products(self, mock_scrape_infos):
+        products = [create_product({'tesco': str(i)}) for i in range(3)]
+        run = ScrapeRun.objects.create(database='default')
+        ScrapeCheckpoint.objects.create(run=run, store='tesco',
+                                        last_pid=products[1].pid, succeeded=2)
+        mock_scrape_infos.return_value = {}
+
+        call_command('scrape', 'info', '-s=tesco', '--resume')
+
+        mock_scrape_infos.assert_called_once()
+        self.assertEqual(mock_scrape_infos.call_args[0][0], '2')
+        checkpoint = ScrapeCheckpoint.objects.get(run=run)
+        self.assertEqual(checkpoint.succeeded, 3)
+        self.assertEqual(ScrapeRun.objects.count(), 1)
+
+    def test_finished_run_not_resumed(self):
+        ScrapeRun.objects.create(database='default', finished=timezone.now())
+
+        checkpoint = RunCheckpoint.start(['tesco'], 'default', resume=True)
+
+        self.assertEqual(ScrapeRun.objects.count(), 2)
+        self.assertEqual(checkpoint.last_pid('tesco'), 0)
+
+
+class TestScrapeMetrics(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_percentile(self):
+        values = [0.1 * i for i in range(1, 11)]
+        self.assertEqual(percentile(values, 50), 0.5)
+        self.assertEqual(percentile(values, 90), 0.9)
+        self.assertEqual(percentile(values, 100), 1.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summary_per_store(self):
+        metrics = ScrapeMetrics()
+        product = ProductInfo(pid=1)
+        metrics.record_result(ScrapeResult('tesco', product, {}, None, 0.2,
+                                           5))
+        metrics.record_result(ScrapeResult('tesco', product, None,
+                                           ValueError(), 0.4))
+        metrics.record_result(ScrapeResult('iceland', product, {}, None, 0.1))
+        metrics.record_write({'tesco': 2, 'iceland': 1}, 0.3)
+
+        res = metrics.summary()
+
+        self.assertEqual(res['products'], 3)
+        self.assertEqual(res['errors'], {'ValueError': 1})
+        self.assertEqual(res['stores']['tesco']['latency']['max'], 0.4)
+        self.assertAlmostEqual(res['stores']['tesco']['db_time'], 0.2)
+        self.assertAlmostEqual(res['stores']['tesco']['network_time'], 0.6)
+        self.assertEqual(res['stores']['tesco']['wait_time'], 5)
+        self.assertEqual(res['stores']['iceland']['wait_time'], 0)
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_scrape_info_writes_metrics(self, mock_scrape_infos):
+        for i in range(3):
+            create_product({'tesco': str(i)})
+        mock_scrape_infos.side_effect = [{}, KeyError('price'), {}]
+        summary_path = os.path.join(self.tmp.name, 'summary.json')
+        stream_path = os.path.join(self.tmp.name, 'stream.jsonl')
+
+        call_command('scrape', 'info', '-s=tesco', f'--metrics={summary_path}',
+                     f'--metrics-stream={stream_path}')
+
+        with open(summary_path) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['stores']['tesco']['products'], 3)
+        self.assertEqual(summary['errors'], {'KeyError': 1})
+        with open(stream_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(len([e for e in events if e['event'] == 'scrape']), 3)
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    @patch('commands.management.commands._cache.fps.scrape_infos')
+    def test_record_then_replay_infos(self, mock_scrape_infos):
+        mock_scrape_infos.return_value = {'description': 'a'}
+        ResponseCache(self.tmp.name, 'record').scrape_infos(
+            '1', 'tesco', exclusive='price description')
+
+        mock_scrape_infos.reset_mock()
+        res = ResponseCache(self.tmp.name, 'replay').scrape_infos(
+            '1', 'tesco', exclusive='description price')
+
+        self.assertEqual(res, {'description': 'a'})
+        mock_scrape_infos.assert_not_called()
+
+    @patch('commands.management.commands._cache.fps.scrape_infos')
+    def test_replay_picks_requested_fields(self, mock_scrape_infos):
+        mock_scrape_infos.return_value = {'description': 'a', 'img': 'i',
+                                          'price': {'base_price': 1}}
+        recorded = ResponseCache(self.tmp.name, 'record').scrape_infos(
+            '1', 'tesco', exclusive='description')
+        cache = ResponseCache(self.tmp.name, 'replay')
+
+        res = cache.scrape_infos('1', 'tesco', exclusive='price')
+
+        # Recorded in full, whatever the recording run asked for
+        mock_scrape_infos.assert_called_once_with('1', 'tesco')
+        self.assertEqual(recorded, {'description': 'a'})
+        self.assertEqual(res, {'price': {'base_price': 1}})
+        self.assertEqual(cache.scrape_infos('1', 'tesco', exclude='image'),
+                         {'description': 'a', 'price': {'base_price': 1}})
+
+    def test_replay_miss_raises(self):
+        cache = ResponseCache(self.tmp.name, 'replay')
+        with self.assertRaises(CacheMiss):
+            cache.scrape_infos('1', 'tesco', exclusive='price')
+
+    @patch('commands.management.commands._cache.fps.scrape_ids')
+    def test_record_then_replay_ids(self, mock_scrape_ids):
+        pages = [[{'barcode': '1', 'pid': '11'}], [{'barcode': '2', 'pid': '22'}]]
+        mock_scrape_ids.return_value = iter(pages)
+        recorded = list(ResponseCache(self.tmp.name, 'record').scrape_ids('tesco'))
+
+        replayed = list(ResponseCache(self.tmp.name, 'replay').scrape_ids('tesco'))
+
+        self.assertEqual(recorded, pages)
+        self.assertEqual(replayed, pages)
+
+    @patch('commands.management.commands._cache.fps.scrape_infos')
+    def test_expired_entries_evicted(self, mock_scrape_infos):
+        mock_scrape_infos.return_value = {}
+        ResponseCache(self.tmp.name, 'record').scrape_infos('1', 'tesco')
+        cache = ResponseCache(self.tmp.name, 'replay', ttl=3600)
+        with patch('commands.management.commands._cache.time.time',
+                   return_value=time.time() + 7200):
+            self.assertEqual(cache.evict(), 1)
+        with self.assertRaises(CacheMiss):
+            cache.scrape_infos('1', 'tesco')
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_scrape_info_replays_recorded_responses(self, mock_scrape_infos):
+        create_product({'tesco': '1'})
+        mock_scrape_infos.return_value = {'description': 'a'}
+        call_command('scrape', 'info', '-s=tesco', '--cache=record',
+                     f'--cache-dir={self.tmp.name}')
+        ProductInfo.objects.update(description='')
+        mock_scrape_infos.reset_mock()
+
+        call_command('scrape', 'info', '-s=tesco', '--cache=replay',
+                     f'--cache-dir={self.tmp.name}')
+
+        mock_scrape_infos.assert_not_called()
+        self.assertEqual(get_product('tesco', '1').description, 'a')
+
+
+class FakeClock:
+    """ Clock for throttle tests; sleeping advances time instantly """
+    def __init__(self):
+        self.now = 0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestThrottle(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_token_bucket_paces_requests(self):
+        bucket = TokenBucket(2, clock=self.clock, sleep=self.clock.sleep)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertEqual(self.clock.now, 2)  # 4 waits of 0.5s
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=10, clock=self.clock)
+        breaker.record(False)
+        self.assertEqual(breaker.wait_time(), 0)
+        breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.open)
+        self.assertEqual(breaker.wait_time(), 10)
+
+        self.clock.now = 10
+        self.assertEqual(breaker.wait_time(), 0)  # trial request
+        self.assertGreater(breaker.wait_time(), 0)  # others wait for trial
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.closed)
+        self.assertEqual(breaker.trips, 1)
+
+    def test_rate_adapts_to_latency_and_errors(self):
+        throttle = StoreThrottle(rate=4, step=1, target_latency=1,
+                                 clock=self.clock, sleep=self.clock.sleep)
+        throttle.record(0.5, succeeded=True)
+        self.assertEqual(throttle.rate, 5)
+        throttle.record(3, succeeded=True)
+        self.assertEqual(throttle.rate, 2.5)
+        throttle.record(0.5, succeeded=False)
+        self.assertEqual(throttle.rate, 1.25)
+
+    def test_paused_store_retried_after_cooldown(self):
+        throttle = StoreThrottle(rate=100, threshold=1, cooldown=30,
+                                 clock=self.clock, sleep=self.clock.sleep)
+        handler = ScrapeHandler(**dict(TestScrapeInfo.mock_options,
+                                       type=['info']))
+        handler.throttles = {'tesco': throttle}
+        product = create_product({'tesco': '1'})
+
+        with patch('commands.management.commands._cache.fps.scrape_infos',
+                   side_effect=[ConnectionError(), {'description': 'a'}]):
+            timing = FetchTiming()
+            res = handler._fetch_infos(product, 'tesco', timing)
+
+        self.assertEqual(res, {'description': 'a'})
+        self.assertIn(30, self.clock.slept)
+        # The cooldown is a wait, not request latency
+        self.assertGreaterEqual(timing.wait, 30)
+        self.assertLess(timing.latency, 30)
+        self.assertFalse(throttle.paused)
+
+
+class TestWorkQueue(TestCase):
+    def test_lease_skips_tasks_held_by_other_workers(self):
+        WorkQueue('default').enqueue('tesco', [1, 2, 3])
+        worker_a = WorkQueue('default', owner='a')
+        worker_b = WorkQueue('default', owner='b')
+
+        leased_a = worker_a.lease(2)
+        leased_b = worker_b.lease(2)
+
+        self.assertEqual([t.pid for t in leased_a], [1, 2])
+        self.assertEqual([t.pid for t in leased_b], [3])
+
+    def test_expired_lease_taken_over(self):
+        WorkQueue('default').enqueue('tesco', [1])
+        worker_a = WorkQueue('default', owner='a')
+        worker_b = WorkQueue('default', owner='b')
+        tasks = worker_a.lease(1)
+        ScrapeTask.objects.update(
+            lease_expires=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(len(worker_b.lease(1)), 1)
+        self.assertEqual(worker_a.renew(tasks), 0)
+        self.assertEqual(worker_a.complete(tasks), 0)
+        self.assertEqual(ScrapeTask.objects.get().lease_owner, 'b')
+
+    def test_failed_tasks_released_until_max_attempts(self):
+        queue = WorkQueue('default', owner='a')
+        queue.enqueue('tesco', [1])
+        for _ in range(queue.max_attempts):
+            self.assertEqual(ScrapeTask.objects.count(), 1)
+            queue.release(queue.lease(1))
+        self.assertEqual(ScrapeTask.objects.count(), 0)
+        self.assertEqual(queue.given_up, 1)
+
+    def test_enqueue_counts_only_new_tasks(self):
+        queue = WorkQueue('default')
+        self.assertEqual(queue.enqueue('tesco', [1, 2]), 2)
+        self.assertEqual(queue.enqueue('tesco', [2, 3]), 1)
+        self.assertEqual(queue.enqueue('iceland', [2]), 1)
+
+    def test_abandoned_task_given_up_after_max_attempts(self):
+        queue = WorkQueue('default', owner='a')
+        queue.enqueue('tesco', [1])
+        for _ in range(queue.max_attempts):
+            self.assertEqual(len(queue.lease(1)), 1)
+            # The worker dies, so its lease expires
+            ScrapeTask.objects.update(
+                lease_expires=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(queue.lease(1), [])
+        self.assertFalse(ScrapeTask.objects.exists())
+        self.assertEqual(queue.given_up, 1)
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_enqueue_then_worker(self, mock_scrape_infos):
+        for i in range(3):
+            create_product({'tesco': str(i)})
+        mock_scrape_infos.return_value = {'description': 'a'}
+
+        call_command('scrape', 'info', '-s=tesco', '--enqueue')
+        self.assertEqual(ScrapeTask.objects.count(), 3)
+        call_command('scrape', 'info', '-s=tesco', '--worker',
+                     '--lease-size=2')
+
+        self.assertEqual(ScrapeTask.objects.count(), 0)
+        self.assertEqual(mock_scrape_infos.call_count, 3)
+        self.assertFalse(ProductInfo.objects.exclude(description='a').exists())
+
+
+class TestScrapeScheduler(TestCase):
+    complete = {'description': 'a',
+                'qty': 1,
+                'total_qty': 0.1,  # kg
+                'protein': 10,
+                'img': '/product_images/1.jpg'}
+
+    def setUp(self):
+        self.brand = Brands.objects.create(brand='brandA')
+        self.history = ScrapeHistory('default')
+        self.scheduler = ScrapeScheduler(ScrapePlanner(refresh=True))
+
+    def create(self, tesco, base=1, **fields):
+        values = dict(self.complete, **fields)
+        return create_product({'tesco': {'pid': tesco, 'base': base}},
+                              brand=self.brand, **values)
+
+    def test_recently_scraped_products_not_due(self):
+        fresh = self.create('1')
+        stale = self.create('2')
+        self.history.record_products('tesco', [fresh.pid, stale.pid])
+        StoreListing.objects.filter(product=stale).update(
+            scraped_at=timezone.now() - timedelta(hours=25))
+
+        self.scheduler.push('tesco', ProductInfo.objects.all())
+
+        self.assertEqual(self.scheduler.pop(10), {'tesco': [stale]})
+
+    def test_incomplete_products_retried_sooner(self):
+        complete = self.create('1')
+        incomplete = self.create('2', description='')
+        self.history.record_products('tesco', [complete.pid, incomplete.pid])
+        StoreListing.objects.update(
+            scraped_at=timezone.now() - timedelta(hours=7))
+
+        self.scheduler.push('tesco', ProductInfo.objects.all())
+
+        self.assertEqual(self.scheduler.pop(10), {'tesco': [incomplete]})
+
+    def test_missing_values_and_good_value_first(self):
+        expensive = self.create('1', base=10)
+        cheap = self.create('2')
+        incomplete = self.create('3', base=10, description='')
+
+        self.scheduler.push('tesco', ProductInfo.objects.all())
+
+        res = [p.pid for p in self.scheduler.pop(10)['tesco']]
+        self.assertEqual(res, [incomplete.pid, cheap.pid, expensive.pid])
+
+    def test_record_products_stamps_store_listings(self):
+        product = create_product({'tesco': '1', 'iceland': '1'})
+
+        self.history.record_products('tesco', [product.pid])
+
+        self.assertIsNotNone(get_listing('tesco', '1').scraped_at)
+        self.assertIsNone(get_listing('iceland', '1').scraped_at)
+
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_failed_scrape_not_stamped(self, mock_scrape_infos):
+        create_product({'tesco': '1'})
+        create_product({'tesco': '2'})
+        def scrape_infos(pid, store, **kwargs):
+            if pid == '2':
+                raise KeyError('price')
+            return {}
+        mock_scrape_infos.side_effect = scrape_infos
+
+        call_command('scrape', 'info', '-s=tesco')
+
+        self.assertIsNotNone(get_listing('tesco', '1').scraped_at)
+        self.assertIsNone(get_listing('tesco', '2').scraped_at)
+
+    @patch('commands.management.commands.scrape.fps.scrape_ids')
+    @patch('commands.management.commands.scrape.fps.scrape_infos')
+    def test_daemon_spends_budget_on_due_products(self, mock_scrape_infos,
+                                                  mock_scrape_ids):
+        for i in range(3):
+            self.create(str(i))
+        mock_scrape_infos.return_value = {}
+        mock_scrape_ids.return_value = []
+
+        # 7200 requests an hour is 2 requests per one-second cycle
+        call_command('scrape', 'daemon', '-s=tesco', '--budget=7200',
+                     '--interval=1', '--cycles=1')
+
+        self.assertEqual(mock_scrape_infos.call_count, 2)
+        self.assertEqual(
+            StoreListing.objects.filter(scraped_at__isnull=False).count(), 2)
+        self.assertTrue(StoreScrape.objects.filter(store='tesco').exists())
+        self.assertEqual(mock_scrape_infos.call_args[1]['exclusive'],
+                         'nutrition price')
+        # bumped at the end of the cycle and of the run
+        self.assertEqual(CatalogVersion.current(), 2)
+
+
+class TestReconcile(TestCase):
+    def test_union_find_groups(self):
+        sets = UnionFind()
+        sets.union(1, 2)
+        sets.union(3, 4)
+        sets.union(4, 2)
+        sets.union(5, 6)
+
+        self.assertEqual(sorted(sets.groups()), [[1, 2, 3, 4], [5, 6]])
+
+    @patch('commands.management.commands.scrape.fps.scrape_ids')
+    def test_id_scrape_records_conflicts(self, mock_scrape_ids):
+        ProductInfo.objects.create(barcode='11')
+        create_product({'tesco': '22'})
+        mock_scrape_ids.return_value = [[{'barcode': '11', 'pid': '22'}]]
+
+        call_command('scrape', 'id', '-s=tesco')
+
+        res = IdConflict.objects.values_list('store', 'store_pid', 'barcode')
+        self.assertEqual(list(res), [('tesco', '22', '11')])
+
+    def test_duplicates_merged_into_lowest_pid(self):
+        a = ProductInfo.objects.create(barcode='11', description='a')
+        b = create_product({'tesco': {'pid': '22', 'base': 2}})
+        c = create_product({'iceland': '33'}, protein=10)
+        other = create_product({'tesco': '55'}, barcode='44')
+        IdConflict.objects.create(store='tesco', store_pid='22', barcode='11',
+                                  database='default')
+        IdConflict.objects.create(store='iceland', store_pid='33',
+                                  barcode='11', database='default')
+
+        call_command('reconcile')
+
+        res = ProductInfo.objects.get(pid=a.pid)
+        self.assertEqual((res.barcode, res.listing('tesco').pid,
+                          res.listing('iceland').pid), ('11', '22', '33'))
+        self.assertEqual((res.description, res.listing('tesco').base,
+                          res.protein), ('a', 2, 10))
+        self.assertEqual(ProductInfo.objects.count(), 2)
+        self.assertFalse(ProductInfo.objects.filter(
+            pid__in=[b.pid, c.pid]).exists())
+        self.assertTrue(ProductInfo.objects.filter(pid=other.pid).exists())
+        self.assertFalse(IdConflict.objects.exists())
+
+    def test_qty_and_nutrition_merged_as_groups(self):
+        a = create_product({'tesco': '22'}, barcode='11', num_of_units=2,
+                           kcal=100)
+        create_product({'iceland': '33'}, qty=1, num_of_units=4,
+                       total_qty=4, unit_of_measurement='g', kcal=200,
+                       protein=10)
+        IdConflict.objects.create(store='iceland', store_pid='33',
+                                  barcode='11', database='default')
+
+        call_command('reconcile')
+
+        res = ProductInfo.objects.get(pid=a.pid)
+        self.assertEqual((res.qty, res.num_of_units, res.total_qty,
+                          res.unit_of_measurement), (1, 4, 4, 'g'))
+        self.assertEqual((res.kcal, res.protein), (200, 10))
+
+    def test_listing_of_store_already_listed_dropped(self):
+        a = create_product({'tesco': '22'}, barcode='11')
+        b = create_product({'tesco': '33', 'iceland': '44'})
+        IdConflict.objects.create(store='tesco', store_pid='33', barcode='11',
+                                  database='default')
+
+        call_command('reconcile')
+
+        res = StoreListing.objects.values_list('product', 'store', 'pid')
+        self.assertEqual(sorted(res), [(a.pid, 'iceland', '44'),
+                                       (a.pid, 'tesco', '22')])
+        self.assertFalse(ProductInfo.objects.filter(pid=b.pid).exists())
+
+    def test_stale_conflicts_ignored(self):
+        create_product({'tesco': '22'}, barcode='11')
+        IdConflict.objects.create(store='tesco', store_pid='22', barcode='11',
+                                  database='default')
+
+        self.assertEqual(ProductReconciler('default').components(), [])
 
 
 class TestLiveOption(TestCase):
@@ -306,30 +1302,25 @@ class TestLiveOption(TestCase):
         'exclude': None
     }
 
-    def test_update_id_with_live_option(self):
+    @patch('commands.management.commands.scrape.fps.scrape_ids')
+    def test_update_id_with_live_option(self, mock_scrape_ids):
         """
         If --live option is used, all database actions should be directed to
         'live' db. Update function should update ID of existing product on 
         the live db instead of default db.
         """
         # Arrange: 
-        # Instantiate ScrapeHandler with command options
-        options = self.mock_options
-        options.update({'type': ['id'],
-                        'live': True}) # manage.py scrape id -l
-        handler = ScrapeHandler(**options)
-
         # Insert identical product into default and live db
-        product = ProductInfo(barcode=None, tesco='1')
-        product.save() # Insert into default db
-        product.save(using='live') # Insert into live db
+        create_product({'tesco': '1'}) # Insert into default db
+        create_product({'tesco': '1'}, using='live') # Insert into live db
+        mock_scrape_ids.return_value = [[{'barcode': '11', 'pid': '1'}]]
 
         # Act: update db, specifically, update barcode field on live db
-        handler._update_ids({'barcode': '11', 'pid': '1'}, 'tesco')
+        call_command('scrape', 'id', '-s=tesco', '-l') # manage.py scrape id -l
 
         # Assert that barcode field has been updated on live but not default db
-        res_default = ProductInfo.objects.get(tesco='1')
-        res_live = ProductInfo.objects.using('live').get(tesco='1')
+        res_default = get_product('tesco', '1')
+        res_live = get_product('tesco', '1', using='live')
         self.assertEqual(res_default.barcode, None)
         self.assertEqual(res_live.barcode, '11')
 
@@ -344,17 +1335,199 @@ class TestLiveOption(TestCase):
                         'live': True}) # manage.py scrape info -l
         handler = ScrapeHandler(**options)
 
-        product = ProductInfo(tesco='1', description='x')
-        product.save()
-        product.save(using='live')
+        create_product({'tesco': '1'}, description='x')
+        product = create_product({'tesco': '1'}, using='live', description='x')
 
-        handler._update_infos({'price':{'base_price': 11}}, product, 'tesco')
+        price = {'price': {'base_price': 11}}
+        handler._write_results([ScrapeResult('tesco', product, price, None, 0)])
 
-        res_default = ProductInfo.objects.get(tesco='1')
-        res_live = ProductInfo.objects.using('live').get(tesco='1')
-        self.assertEqual(res_default.tesco_base_price, None)
-        self.assertEqual(res_live.tesco_base_price, 11)
+        res_default = get_listing('tesco', '1')
+        res_live = get_listing('tesco', '1', using='live')
+        self.assertEqual(res_default.base, None)
+        self.assertEqual(res_live.base, 11)
         
 
     def test_a(self):
-        call_command('scrape', 'info', '-s=tesco', '-l')
\ No newline at end of file
+        call_command('scrape', 'info', '-s=tesco', '-l')
+
+class TestUpdateLiveDB(TestCase):
+    databases = ['default', 'live']
+
+    def create(self, n, brand=None, protein=20):
+        return create_product({'tesco': str(n)}, description=f'product {n}',
+                              qty=1, protein=protein, brand=brand)
+
+    def test_filtered_products_copied_with_brands_and_listings(self):
+        brand = Brands.objects.create(brand='brandA')
+        Brands.objects.create(brand='brandB')
+        kept = [self.create(i, brand=brand) for i in range(3)]
+        self.create(3, protein=5)
+
+        UpdateLiveDB().execute()
+
+        live = ProductInfo.objects.using('live')
+        self.assertEqual(sorted(live.values_list('pid', flat=True)),
+                         [p.pid for p in kept])
+        self.assertEqual(list(Brands.objects.using('live').values_list(
+            'brand', flat=True)), ['brandA'])
+        self.assertEqual(StoreListing.objects.using('live').count(), 3)
+        self.assertEqual(Store.names('live'), Store.names())
+        self.assertEqual(CatalogVersion.current('live'), 1)
+
+    def test_transfer_queries_independent_of_row_count(self):
+        def transfer(n):
+            for i in range(n):
+                self.create(1000 * n + i)
+            with CaptureQueriesContext(connections['live']) as queries:
+                UpdateLiveDB().execute()
+            return len([q for q in queries
+                        if q['sql'].startswith('INSERT')])
+
+        self.assertEqual(transfer(1), transfer(20))
+
+    def test_best_value_products_packed_into_row_budget(self):
+        brand = Brands.objects.create(brand='brandA')
+
+        def create(n, price, **fields):
+            return create_product({'tesco': {'pid': str(n), 'base': price}},
+                                  description=f'product {n}', qty=1,
+                                  total_qty=1, protein=20, **fields)
+
+        cheap = create(1, 1)
+        branded = create(2, 2, brand=brand)  # needs 3 rows
+        fair = create(3, 3)
+        other = create(4, 4)
+        unpriced = self.create(5)
+        live = ProductInfo.objects.using('live')
+
+        def sync(max_rows):
+            with patch.object(UpdateLiveDB, 'max_rows', max_rows):
+                UpdateLiveDB().execute()
+            return sorted(live.values_list('pid', flat=True))
+
+        # 2 stores + 2 rows each for cheap and fair; branded doesn't fit
+        self.assertEqual(sync(6), [cheap.pid, fair.pid])
+        self.assertEqual(Store.objects.using('live').count() + live.count() +
+                         StoreListing.objects.using('live').count(), 6)
+        self.assertFalse(Brands.objects.using('live').exists())
+
+        # 13 rows with the brand; the unpriced product comes last and is the
+        # one left out when the brand row uses up the last slot
+        self.assertEqual(sync(12),
+                         [cheap.pid, branded.pid, fair.pid, other.pid])
+        self.assertTrue(Brands.objects.using('live').filter(
+            pk=brand.pk).exists())
+
+        self.assertEqual(sync(13)[-1], unpriced.pid)
+        self.assertEqual(live.count(), 5)
+
+    def test_resync_writes_only_changed_rows(self):
+        products = [self.create(i) for i in range(5)]
+        UpdateLiveDB().execute()
+        StoreListing.objects.filter(product=products[0]).update(base=3)
+        ProductInfo.objects.filter(pid=products[1].pid).update(protein=5)
+        added = self.create(5)
+
+        with CaptureQueriesContext(connections['live']) as queries:
+            UpdateLiveDB().execute()
+
+        # executemany is logged as 'n times: UPDATE ...'
+        writes = [q['sql'] for q in queries
+                  if q['sql'].split(': ')[-1].startswith(('INSERT', 'UPDATE',
+                                                          'DELETE'))]
+        # delete listing and product, insert product and listing, update
+        # listing, bump the catalog version
+        self.assertEqual(len(writes), 6)
+        live = ProductInfo.objects.using('live')
+        self.assertFalse(live.filter(pid=products[1].pid).exists())
+        self.assertTrue(live.filter(pid=added.pid).exists())
+        self.assertEqual(get_listing('tesco', '0', using='live').base, 3)
+
+    @skipUnless(connections['live'].vendor == 'postgresql',
+                'catalog swaps need PostgreSQL')
+    def test_catalog_swapped_in_and_rolled_back(self):
+        first = self.create(1)
+        UpdateLiveDB().execute()
+        ProductInfo.objects.filter(pid=first.pid).update(protein=5)
+        second = self.create(2)
+        UpdateLiveDB().execute()
+
+        live = ProductInfo.objects.using('live')
+        self.assertEqual(list(live.values_list('pid', flat=True)),
+                         [second.pid])
+        UpdateLiveDB().rollback()
+        self.assertEqual(list(live.values_list('pid', flat=True)),
+                         [first.pid])
+        UpdateLiveDB().rollback()
+        self.assertEqual(list(live.values_list('pid', flat=True)),
+                         [second.pid])
+        self.assertEqual(StoreListing.objects.using('live').get().product_id,
+                         second.pid)
+
+    @skipUnless(connections['live'].vendor == 'postgresql',
+                'catalog swaps need PostgreSQL')
+    def test_rollback_catalog_not_pushed_to_heroku(self):
+        self.create(1)
+        UpdateLiveDB().execute()
+        UpdateLiveDB().execute()
+
+        UpdateHeroku().discard_rollback()
+
+        with self.assertRaises(CommandError):
+            UpdateLiveDB().rollback()
+        self.assertEqual(ProductInfo.objects.using('live').count(), 1)
+
+    @skipUnless(connections['live'].vendor == 'postgresql',
+                'catalog swaps need PostgreSQL')
+    def test_search_vector_trigger_kept_after_swap(self):
+        self.create(1)
+        UpdateLiveDB().execute()
+
+        with connections['live'].cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM pg_trigger WHERE tgname = %s AND '
+                "tgrelid = 'public.products_productinfo'::regclass",
+                ['products_productinfo_search_vector'])
+            self.assertIsNotNone(cursor.fetchone())
+        product = ProductInfo.objects.using('live').create(
+            description='turkey mince')
+        self.assertTrue(ProductInfo.objects.using('live').search(
+            'turkey').filter(pid=product.pid).exists())
+
+    @skipIf(connections['live'].vendor == 'postgresql',
+            'live db can swap catalogs')
+    def test_rollback_needs_postgresql(self):
+        self.assertIsNone(UpdateLiveDB().shadow_catalog())
+        with self.assertRaises(CommandError):
+            UpdateLiveDB().rollback()
+
+
+class TestLiveSync(TestCase):
+    databases = ['default', 'live']
+
+    def test_only_differing_chunks_compared(self):
+        for i in range(10):
+            ProductInfo.objects.create(pid=i + 1, description=str(i))
+            ProductInfo.objects.using('live').create(pid=i + 1,
+                                                     description=str(i))
+        ProductInfo.objects.filter(pid=7).update(description='x')
+        ProductInfo.objects.create(pid=11, description='new')
+        ProductInfo.objects.using('live').filter(pid=2).delete()
+        sync = LiveSync('live', chunk_size=3)
+
+        with patch.object(LiveSync, 'row_hashes',
+                          wraps=sync.row_hashes) as row_hashes:
+            diff = sync.diff(ProductInfo, ProductInfo.objects.all())
+
+        self.assertEqual(diff, TableDiff(ProductInfo, [2, 11], [7], []))
+        self.assertEqual(row_hashes.call_args[0][1], [0, 2, 3])
+
+    def test_identical_tables_not_written(self):
+        create_product({'tesco': '1'}, description='a')
+        create_product({'tesco': '1'}, using='live', description='a')
+        tables = [(ProductInfo, ProductInfo.objects.all()),
+                  (StoreListing, StoreListing.objects.all())]
+
+        diffs = LiveSync('live').run(tables)
+
+        self.assertEqual([LiveSync.delta(diff) for diff in diffs], [0, 0])
@@ -1,5 +1,6 @@
 from django import forms
-from .models import Brands, ProductInfo
+from .helper.search import brand_facets
+from .models import ProductInfo, Store
 
 class myWidget(forms.Select):
     """
@@ -44,31 +45,37 @@ class ProductSearchForm(forms.Form):
         })
     )
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, brand_facets=None, **kwargs):
         super().__init__(*args, **kwargs)
         # Goal: 
-        #   1) populate brand dropdown with brand name of products returned by 
-        #      search query
+        #   1) populate brand dropdown with brand name and product count of
+        #      products returned by search query (in the selected store)
         #   2) populate store dropdown with a list of all the stores 
         #      (independent of search query) 
 
         # The search query can be found in the 'initial' kwarg when the form is 
-        # instantiated
+        # instantiated. Views that already computed the brand facets of the
+        # query pass them in, see SearchView.
         search_query = kwargs['initial'].get('search')
-        if search_query is not None:
-            self.fields['brand'].choices = self.get_brand_choices(search_query)
+        if brand_facets is not None:
+            self.fields['brand'].choices = self.brand_choices(brand_facets)
+        elif search_query is not None:
+            self.fields['brand'].choices = self.get_brand_choices(
+                search_query, kwargs['initial'].get('store'))
         else: 
             self.fields['brand'].choices = [('', 'No Brands')]
 
         self.fields['store'].choices = self.get_store_choices()
 
-    def get_brand_choices(self, search_query):
+    def get_brand_choices(self, search_query, store=None):
         """ Returns brands associated with products returned by search query """
-        brands = Brands.objects.filter(
-            productinfo__description__search=search_query)
-        brands = brands.distinct().order_by('brand')
+        return self.brand_choices(brand_facets(search_query, store))
 
-        choice_tuples = [(b.brand_id, b.brand.title()) for b in brands]
+    @staticmethod
+    def brand_choices(facets):
+        """ Returns choices for (brand_id, brand, product count) facets """
+        choice_tuples = [(brand_id, f'{brand.title()} ({count})')
+                         for brand_id, brand, count in facets]
         if choice_tuples:
             brand_count_str = str(len(choice_tuples))
             # Assign value '0' for 'all brands'
@@ -80,9 +87,9 @@ class ProductSearchForm(forms.Form):
         return choice_tuples
 
     def get_store_choices(self):
-        """ Returns list of stores """
-        stores = ['tesco', 'iceland']
-        choice_tuples = [(store, store.title()) for store in stores]
+        """ Returns list of stores in the Store registry """
+        choice_tuples = list(
+            Store.objects.order_by('name').values_list('name', 'title'))
         choice_tuples.insert(0, ('all', 'All Stores'))
         return choice_tuples
 
@@ -100,8 +107,10 @@ class Barcode(forms.Form):
 
 
 class ProductBrowserForm(forms.Form):
+    # Optional: without a search, all of the store's products are listed
     search = forms.CharField(
         max_length = 255,
+        required = False,
         widget = forms.TextInput({
             'class': 'form_field',
             'placeholder': 'search',
@@ -109,10 +118,29 @@ class ProductBrowserForm(forms.Form):
     )
 
     store = forms.ChoiceField(
-        choices = [('tesco', 'Tesco'), ('iceland', 'Iceland')],
+        choices = [],
+        required = False,
+        widget = forms.Select({
+            'class': 'form_field',
+            'onchange': 'this.form.submit()',
+        })
+    )
+
+    # Values are the keys of ProductBrowser.orderings
+    sort = forms.ChoiceField(
+        choices = [
+            ('price', 'Cheapest £/10g protein'),
+            ('protein', 'Most protein'),
+            ('relevance', 'Best match'),
+        ],
         required = False,
         widget = forms.Select({
             'class': 'form_field',
             'onchange': 'this.form.submit()',
         })
-    )
\ No newline at end of file
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['store'].choices = list(
+            Store.objects.order_by('name').values_list('name', 'title'))
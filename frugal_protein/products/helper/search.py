@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import connections
+from django.db.models import Count
+
+from products.models import CatalogVersion, ProductInfo
+
+
+class _Flight:
+    """ A computation in progress, shared by every request for its key """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SearchCache:
+    """
+    In-process LRU cache of search results (pages of products, brand facets).
+    Entries belong to a version of the catalog (see CatalogVersion), which
+    is read on every lookup: once a scrape or update bumps it, every entry
+    is dropped at once. At most max_entries are held; the least recently
+    used entry is evicted first.
+
+    Computations are single-flight: concurrent lookups of a key that isn't
+    cached wait for the one computation in progress and share its result,
+    instead of all running the same query. Entries older than max_age are
+    expired but still served for up to stale_for seconds while a single
+    background thread recomputes them (stale-while-revalidate).
+
+    Attributes
+        max_entries (int): maximum number of cached results
+        max_age (float): seconds an entry is fresh
+        stale_for (float): seconds an expired entry is served while it is
+                           recomputed
+        using (str): db alias of the catalog searched
+        hits (int): lookups answered from the cache, fresh or stale
+        misses (int): lookups that computed their result
+        coalesced (int): lookups that waited on another's computation
+
+    Usage:
+        >>> key = search_key('search', 'Chicken ', store='tesco', page=1)
+        >>> page = search_cache.get_or_set(key, compute)
+    """
+
+    def __init__(self, max_entries=256, max_age=300, stale_for=60,
+                 using='default'):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.stale_for = stale_for
+        self.using = using
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()  # key -> (value, time stored)
+        self._flights = {}  # key -> _Flight
+        self._version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_set(self, key, compute):
+        """
+        Returns the cached result of key, or calls compute() and caches its
+        result. Results are shared between requests, so shouldn't be
+        mutated; exceptions raised by compute are not cached, but are raised
+        in every lookup that waited on it.
+        """
+        version = CatalogVersion.current(self.using)
+        now = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            if key in self._entries:
+                value, stored = self._entries[key]
+                age = now - stored
+                if age < self.max_age + self.stale_for:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    if age >= self.max_age and key not in self._flights:
+                        self._revalidate(key, compute, version)
+                    return value
+                del self._entries[key]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            self._compute(key, compute, version, flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _revalidate(self, key, compute, version):
+        """ Recomputes an expired entry in the background; holds the lock """
+        flight = self._flights[key] = _Flight()
+
+        def run():
+            try:
+                self._compute(key, compute, version, flight)
+                if flight.error is not None:
+                    logging.info(f'search cache({key}) -- {flight.error}')
+            finally:
+                # The thread's own db connections
+                connections.close_all()
+
+        threading.Thread(target=run, name='search-revalidate',
+                         daemon=True).start()
+
+    def _compute(self, key, compute, version, flight):
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                # Not cached if the catalog changed while it was computed
+                if flight.error is None and version == self._version:
+                    self._entries[key] = (flight.value, time.monotonic())
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+
+search_cache = SearchCache()
+
+
+def normalise_query(query):
+    """ Lowercase and collapse whitespace, e.g. ' Turkey  Mince' -> 'turkey mince' """
+    return ' '.join(query.split()).lower()
+
+
+def search_key(kind, query, brand=None, store=None, page=None, sort=None):
+    """
+    Returns the cache key of a search result, with 'all brands' and 'all
+    stores' given as None whichever way they were requested
+    """
+    brand = None if brand in ('', '0') else brand
+    store = None if store in ('', 'all') else store
+    return (kind, normalise_query(query), brand, store, page, sort)
+
+
+def search_products(query, store=None):
+    """
+    Returns the products matching a full-text query, annotated with rank,
+    listed at store unless store is None or 'all'
+    """
+    products = ProductInfo.objects.search(query)
+    if store and store != 'all':
+        products = products.filter(listings__store=store)
+    return products
+
+
+def brand_facets(query, store=None):
+    """
+    Returns (brand_id, brand, product count) for each brand of the products
+    returned by search_products, ordered by brand. The counts come from a
+    single GROUP BY over the search and are cached per normalised query and
+    store.
+    """
+    def facets():
+        return list(
+            search_products(normalise_query(query), store)
+            .filter(brand__isnull=False)
+            .values_list('brand_id', 'brand__brand')
+            .annotate(count=Count('pid')).order_by('brand__brand'))
+    return search_cache.get_or_set(search_key('facets', query, store=store),
+                                   facets)
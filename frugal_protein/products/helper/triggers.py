@@ -0,0 +1,17 @@
+"""
+SQL of the db triggers the products tables rely on. Shared by the migrations
+that add them and by ShadowCatalog, which recreates them on shadow tables.
+"""
+
+# Keeps search_vector in step with description on every insert and on updates
+# of description, however rows are written (save, bulk_create or raw SQL)
+SEARCH_VECTOR_TRIGGER = """
+CREATE TRIGGER products_productinfo_search_vector
+BEFORE INSERT OR UPDATE OF description ON products_productinfo
+FOR EACH ROW EXECUTE PROCEDURE
+tsvector_update_trigger(search_vector, 'pg_catalog.english', description);
+"""
+
+DROP_SEARCH_VECTOR_TRIGGER = """
+DROP TRIGGER products_productinfo_search_vector ON products_productinfo;
+"""
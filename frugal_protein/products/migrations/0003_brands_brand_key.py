@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:43
+
+from django.db import migrations, models
+
+
+def populate_brand_key(apps, schema_editor):
+    """
+    Fill brand_key for existing brands. Brands that normalise to the same key
+    are merged into the oldest one before the unique constraint is added.
+    """
+    Brands = apps.get_model('products', 'Brands')
+    ProductInfo = apps.get_model('products', 'ProductInfo')
+    db = schema_editor.connection.alias
+
+    kept = {}
+    for brand in Brands.objects.using(db).order_by('brand_id'):
+        key = ' '.join(brand.brand.split()).lower()
+        if key in kept:
+            ProductInfo.objects.using(db).filter(brand_id=brand.brand_id) \
+                .update(brand_id=kept[key])
+            brand.delete()
+        else:
+            kept[key] = brand.brand_id
+            brand.brand_key = key
+            brand.save(update_fields=['brand_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_productinfo_img'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brands',
+            name='brand_key',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.RunPython(populate_brand_key, migrations.RunPython.noop),
+    ]
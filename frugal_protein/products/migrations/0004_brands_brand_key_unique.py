@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Separate from 0003_brands_brand_key so that its data migration is
+    # committed first; PostgreSQL refuses to alter a table with pending
+    # trigger events
+
+    dependencies = [
+        ('products', '0003_brands_brand_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='brands',
+            name='brand_key',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
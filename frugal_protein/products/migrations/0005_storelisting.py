@@ -0,0 +1,94 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+STORES = [('tesco', 'Tesco'), ('iceland', 'Iceland')]
+# StoreListing field -> suffix of the store's ProductInfo column
+PRICES = {'base': 'base_price',
+          'sale': 'sale_price',
+          'offer': 'offer_price',
+          'offer_text': 'offer_text'}
+
+
+def register_stores(apps, schema_editor):
+    Store = apps.get_model('products', 'Store')
+    db = schema_editor.connection.alias
+    Store.objects.using(db).bulk_create(
+        [Store(name=name, title=title) for name, title in STORES])
+
+
+def columns_to_listings(apps, schema_editor):
+    """ Copies each store's pid and price columns into StoreListing rows """
+    ProductInfo = apps.get_model('products', 'ProductInfo')
+    StoreListing = apps.get_model('products', 'StoreListing')
+    db = schema_editor.connection.alias
+
+    for store, _ in STORES:
+        columns = [f'{store}_{suffix}' for suffix in PRICES.values()]
+        rows = ProductInfo.objects.using(db).filter(
+            **{f'{store}__isnull': False}
+        ).values_list('pid', store, *columns).iterator()
+        listings = [
+            StoreListing(product_id=pid, store_id=store, pid=store_pid,
+                         **dict(zip(PRICES, prices)))
+            for pid, store_pid, *prices in rows
+        ]
+        StoreListing.objects.using(db).bulk_create(listings, batch_size=1000)
+
+
+def listings_to_columns(apps, schema_editor):
+    ProductInfo = apps.get_model('products', 'ProductInfo')
+    StoreListing = apps.get_model('products', 'StoreListing')
+    db = schema_editor.connection.alias
+
+    for store, _ in STORES:
+        listings = StoreListing.objects.using(db).filter(store_id=store)
+        for listing in listings.iterator():
+            values = {f'{store}_{suffix}': getattr(listing, field)
+                      for field, suffix in PRICES.items()}
+            values[store] = listing.pid
+            ProductInfo.objects.using(db).filter(pid=listing.product_id) \
+                .update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_brands_brand_key_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Store',
+            fields=[
+                ('name', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.RunPython(register_stores, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='StoreListing',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pid', models.CharField(max_length=20)),
+                ('base', models.DecimalField(decimal_places=2, max_digits=6, null=True)),
+                ('sale', models.DecimalField(decimal_places=2, max_digits=6, null=True)),
+                ('offer', models.DecimalField(decimal_places=2, max_digits=6, null=True)),
+                ('offer_text', models.CharField(max_length=255, null=True)),
+                ('scraped_at', models.DateTimeField(null=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listings', to='products.ProductInfo')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='products.Store')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='storelisting',
+            index=models.Index(fields=['store', 'base'], name='products_st_store_i_32dbbb_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='storelisting',
+            unique_together={('product', 'store'), ('store', 'pid')},
+        ),
+        migrations.RunPython(columns_to_listings, listings_to_columns),
+    ]
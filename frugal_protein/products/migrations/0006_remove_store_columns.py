@@ -0,0 +1,55 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Separate from 0005 so that its data migration is committed first;
+    # PostgreSQL refuses to alter a table with pending trigger events
+
+    dependencies = [
+        ('products', '0005_storelisting'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='iceland',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='iceland_base_price',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='iceland_offer_price',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='iceland_offer_text',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='iceland_sale_price',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='tesco',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='tesco_base_price',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='tesco_offer_price',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='tesco_offer_text',
+        ),
+        migrations.RemoveField(
+            model_name='productinfo',
+            name='tesco_sale_price',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:14
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+from products.helper.triggers import (DROP_SEARCH_VECTOR_TRIGGER,
+                                      SEARCH_VECTOR_TRIGGER)
+
+
+BACKFILL = """
+UPDATE products_productinfo
+SET search_vector = to_tsvector('pg_catalog.english', description);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_remove_store_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productinfo',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='productinfo',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='products_pr_search__gin'),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_TRIGGER, DROP_SEARCH_VECTOR_TRIGGER),
+        migrations.RunSQL(BACKFILL, migrations.RunSQL.noop),
+    ]
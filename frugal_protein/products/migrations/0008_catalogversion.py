@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:21
+
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    CatalogVersion = apps.get_model('products', 'CatalogVersion')
+    CatalogVersion.objects.using(schema_editor.connection.alias).create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_productinfo_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,64 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVectorField)
 from django.db import models
+from django.db.models import (DecimalField, ExpressionWrapper, F, Min, Q,
+                              prefetch_related_objects)
+from django.db.models.functions import Coalesce, Least, NullIf
+from django.utils import timezone
 from .helper.price_calc import Calc
 
 class Brands(models.Model):
     brand_id = models.AutoField(primary_key=True)
     brand = models.CharField(max_length=255)
+    # Normalised brand name; unique so that scrapers can't insert duplicates
+    brand_key = models.CharField(max_length=255, unique=True)
+
+    @staticmethod
+    def normalise(brand):
+        """ Lowercase and collapse whitespace, e.g. ' Big  Brand' -> 'big brand' """
+        return ' '.join(brand.split()).lower()
+
+    def save(self, *args, **kwargs):
+        self.brand_key = self.normalise(self.brand)
+        super().save(*args, **kwargs)
+
+# Text search config of ProductInfo.search_vector (see migration 0007)
+SEARCH_CONFIG = 'english'
+
+
+class ProductInfoQuerySet(models.QuerySet):
+    def search(self, query):
+        """
+        Filters on a full-text query through the GIN-indexed search_vector
+        and annotates rank, the relevance of each match; order by '-rank'
+        for the best matches first
+        """
+        query = SearchQuery(query, config=SEARCH_CONFIG)
+        return self.filter(search_vector=query).annotate(
+            rank=SearchRank(F('search_vector'), query))
+
+    def with_protein_price(self, store=None):
+        """
+        Annotates protein_price, the cheapest £/10g protein at a store (or at
+        any store) computed in the db; see ProductInfo.cheapest_price. It is
+        None where the price, total_qty or protein is unknown.
+
+        £/10g protein = price / total_qty(kg) / (protein per 100g * 10) * 10
+                      = price / (total_qty * protein)
+        """
+        prices = ['listings__base', 'listings__sale', 'listings__offer']
+        # LEAST is NULL on SQLite if any argument is; each COALESCE starts
+        # from a different price so the least of them is the least price set
+        cheapest = Least(*(Coalesce(*prices[i:], *prices[:i])
+                           for i in range(len(prices))))
+        price = Min(cheapest,
+                    filter=Q(listings__store=store) if store else None)
+        per_protein = NullIf(F('total_qty') * F('protein'), 0)
+        return self.annotate(protein_price=ExpressionWrapper(
+            price / per_protein,
+            output_field=DecimalField(max_digits=12, decimal_places=4)))
+
 
 class ProductInfo(models.Model):
     pid = models.AutoField(primary_key=True)
@@ -23,54 +78,55 @@ class ProductInfo(models.Model):
     carb = models.DecimalField(max_digits=5, decimal_places=1, null=True)
     protein = models.DecimalField(max_digits=5, decimal_places=1, null=True)
 
-    # Store-specific pids
+    # Barcode; store pids and prices are kept in StoreListing (see listing)
     barcode = models.CharField(max_length=20, unique=True, null=True, blank=True)
-    tesco = models.CharField(max_length=9, unique=True, null=True, blank=True)
-    iceland = models.CharField(max_length=5, unique=True, null=True, blank=True)
-
-    # Price - Tesco
-    tesco_base_price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
-    tesco_sale_price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
-    tesco_offer_price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
-    tesco_offer_text = models.CharField(max_length=255, null=True)
-
-    # Price - Iceland
-    iceland_base_price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
-    iceland_sale_price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
-    iceland_offer_price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
-    iceland_offer_text = models.CharField(max_length=255, null=True)
 
     # Image
     img = models.ImageField(default='/product_images/default.png', upload_to='product_images')
 
+    # Full-text search vector of description, kept up to date by a db trigger
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductInfoQuerySet.as_manager()
+
+    class Meta:
+        indexes = [GinIndex(fields=['search_vector'],
+                            name='products_pr_search__gin')]
+
+    def listing(self, store):
+        """
+        Returns the product's StoreListing for a store, or None. Listings are
+        prefetched on first use unless they already were, e.g. by
+        prefetch_related on a page of products, so repeated calls return the
+        same object.
+        """
+        if 'listings' not in getattr(self, '_prefetched_objects_cache', {}):
+            prefetch_related_objects([self], 'listings')
+        for listing in self.listings.all():
+            if listing.store_id == store:
+                return listing
+        return None
+
     def price_table(self):
         """ Returns a nested dict of prices for price table in product page """
         # Check if value exists for qty and nutrition 
         if not self.total_qty or not self.protein:
             return None
-        
-        # Get list of stores within this model class
-        stores = [store.replace('_base_price', '') for store in dir(self) if store.endswith('_base_price')]
-
-        base_suffix = '_base_price'
-        sale_suffix = '_sale_price'
-        offer_suffix = '_offer_price'
-        offer_txt_suffix = '_offer_text'
 
         # For each store, wrap price data in a dict
         prices = {}
-        for store in stores:
+        for listing in sorted(self.listings.all(), key=lambda l: l.store_id):
             price_values = {
-                'base': getattr(self, store + base_suffix),
-                'sale': getattr(self, store + sale_suffix),
-                'offer': getattr(self, store + offer_suffix)
+                'base': listing.base,
+                'sale': listing.sale,
+                'offer': listing.offer
             }
             if price_values['base'] is None:
                 continue
 
             # Column 1: base and sale price values + offer text
             col1 = price_values.copy()
-            col1['offer'] = getattr(self, store + offer_txt_suffix)
+            col1['offer'] = listing.offer_text
 
             # Column 2: unit prices for base, sale, and offer values
             col2 = {}
@@ -95,19 +151,17 @@ class ProductInfo(models.Model):
             col1['class'] = 'col2'
             col2['class'] = 'col3'
             col3['class'] = 'col4'
-            prices[store] = [col1, col2, col3]
+            prices[listing.store_id] = [col1, col2, col3]
         return prices
 
     def cheapest_price(self, store):
-        base_suffix = '_base_price'
-        sale_suffix = '_sale_price'
-        offer_suffix = '_offer_price'
-
-        base = getattr(self, store + base_suffix)
-        sale = getattr(self, store + sale_suffix)
-        offer = getattr(self, store + offer_suffix)
+        """ Returns the cheapest £/10g protein at a store, or 0 if unknown """
+        listing = self.listing(store)
+        if listing is None:
+            return 0
 
-        prices = [p for p in (base, sale, offer) if p is not None]
+        prices = [p for p in (listing.base, listing.sale, listing.offer)
+                  if p is not None]
         if prices and self.protein and self.total_qty:
             cheapest = min(prices)
             ppu = Calc.unit_price(cheapest, self.total_qty)
@@ -115,3 +169,64 @@ class ProductInfo(models.Model):
             price_per_10g_protein = ppp * 10
             return price_per_10g_protein
         return 0
+
+
+class Store(models.Model):
+    """
+    Registry of the stores products are listed in. Adding a store is a new row
+    (and a scraper in frugal_protein_scrapers); no schema change is needed.
+    """
+    name = models.CharField(max_length=20, primary_key=True)  # e.g. 'tesco'
+    title = models.CharField(max_length=50)                   # e.g. 'Tesco'
+
+    @classmethod
+    def names(cls, using='default'):
+        """ Returns the names of all registered stores """
+        return frozenset(cls.objects.using(using).values_list('name',
+                                                              flat=True))
+
+    def __str__(self):
+        return self.title
+
+
+class StoreListing(models.Model):
+    """ A product as sold by one store: the store's pid and current prices """
+    product = models.ForeignKey(ProductInfo, on_delete=models.CASCADE,
+                                related_name='listings')
+    store = models.ForeignKey(Store, on_delete=models.PROTECT)
+    pid = models.CharField(max_length=20)  # the store's own product id
+    base = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+    sale = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+    offer = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+    offer_text = models.CharField(max_length=255, null=True)
+    scraped_at = models.DateTimeField(null=True)  # last info scrape
+
+    class Meta:
+        unique_together = (('store', 'pid'), ('product', 'store'))
+        indexes = [
+            # Priced listings of a store, e.g. for the product browser
+            models.Index(fields=['store', 'base']),
+        ]
+
+
+class CatalogVersion(models.Model):
+    """
+    Version of the product catalog in a db, a single row bumped at the end of
+    every scrape or update that changes it, so that caches of search results
+    know when to drop them (see helper.search.SearchCache)
+    """
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def current(cls, using='default'):
+        """ Returns the catalog's version, 0 if it was never bumped """
+        return cls.objects.using(using).values_list(
+            'version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, using='default'):
+        versions = cls.objects.using(using)
+        if not versions.filter(pk=1).update(version=F('version') + 1,
+                                            updated=timezone.now()):
+            versions.get_or_create(pk=1, defaults={'version': 1})
@@ -1,9 +1,16 @@
+import threading
+import time
+from decimal import Decimal
+from unittest.mock import patch
+
 from django.test import TestCase
 from django.urls import reverse
 
 from .forms import ProductSearchForm
 from .helper.price_calc import Calc
-from .models import ProductInfo, Brands
+from .helper.search import SearchCache, search_cache, search_key
+from .views import ProductBrowser
+from .models import CatalogVersion, ProductInfo, Brands, Store, StoreListing
 from .templatetags import products_filters as filters
 
 class TestCalculations(TestCase):
@@ -73,6 +80,127 @@ class TestCalculations(TestCase):
         self.assertIsNone(res_4)
 
 
+class TestProteinPrice(TestCase):
+    def create_product(self, listings, **kwargs):
+        product = ProductInfo.objects.create(description='a', total_qty=0.5,
+                                             protein=20, **kwargs)
+        for store, prices in listings.items():
+            StoreListing.objects.create(product=product, store_id=store,
+                                        pid='1', **prices)
+        return product
+
+    def test_annotation_matches_cheapest_price(self):
+        self.create_product({'tesco': {'base': 2, 'offer': 1.5},
+                             'iceland': {'sale': 1}})
+        product = ProductInfo.objects.get()
+
+        res = ProductInfo.objects.with_protein_price('tesco').get()
+        cheapest = ProductInfo.objects.with_protein_price().get()
+
+        self.assertAlmostEqual(float(res.protein_price),
+                               float(product.cheapest_price('tesco')))
+        self.assertAlmostEqual(float(cheapest.protein_price),
+                               float(product.cheapest_price('iceland')))
+
+    def test_unknown_values_annotated_as_none(self):
+        self.create_product({'tesco': {}})
+        ProductInfo.objects.create(description='b', protein=0, total_qty=1)
+
+        res = ProductInfo.objects.with_protein_price()
+
+        self.assertEqual([p.protein_price for p in res], [None, None])
+
+
+class TestSearch(TestCase):
+    # ProductInfo.search matches on the trigger-maintained search_vector
+
+    def test_search_vector_follows_description(self):
+        product = ProductInfo.objects.create(description='turkey mince')
+        self.assertTrue(ProductInfo.objects.search('turkey').exists())
+
+        ProductInfo.objects.filter(pid=product.pid).update(
+            description='chicken breast')
+        self.assertFalse(ProductInfo.objects.search('turkey').exists())
+        self.assertTrue(ProductInfo.objects.search('chickens').exists())
+
+    def test_results_ranked_by_relevance(self):
+        ProductInfo.objects.create(description='a chicken soup')
+        ProductInfo.objects.create(description='chicken chicken chicken')
+
+        res = ProductInfo.objects.search('chicken').order_by('-rank')
+
+        self.assertEqual([p.description for p in res],
+                         ['chicken chicken chicken', 'a chicken soup'])
+
+
+class TestSearchCache(TestCase):
+    def test_keys_normalised(self):
+        self.assertEqual(search_key('search', ' Chicken  Breast', '0', 'all'),
+                         search_key('search', 'chicken breast'))
+
+    def test_least_recently_used_evicted(self):
+        cache = SearchCache(max_entries=2)
+        cache.get_or_set('a', lambda: 1)
+        cache.get_or_set('b', lambda: 2)
+        cache.get_or_set('a', lambda: None)  # b is now least recently used
+        cache.get_or_set('c', lambda: 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_or_set('a', lambda: None), 1)
+        self.assertIsNone(cache.get_or_set('b', lambda: None))
+
+    def test_entries_dropped_when_catalog_version_bumped(self):
+        cache = SearchCache()
+        cache.get_or_set('a', lambda: 1)
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 1)
+
+        CatalogVersion.bump()
+
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_concurrent_lookups_share_one_computation(self):
+        cache = SearchCache()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(cache.get_or_set('a', compute)))
+        with patch.object(CatalogVersion, 'current', return_value=0):
+            leader.start()
+            started.wait()
+            followers = [threading.Thread(target=lambda: results.append(
+                cache.get_or_set('a', compute))) for _ in range(4)]
+            for thread in followers:
+                thread.start()
+            while cache.coalesced < 4:
+                time.sleep(0.001)
+            release.set()
+            for thread in [leader] + followers:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+
+    def test_expired_entry_served_while_revalidated(self):
+        cache = SearchCache(max_age=0, stale_for=60)
+        cache.get_or_set('a', lambda: 1)
+
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 1)
+        cache.max_age = 60
+        while cache._flights:  # background recompute
+            time.sleep(0.001)
+        self.assertEqual(cache.get_or_set('a', lambda: None), 2)
+        self.assertEqual(cache.misses, 1)
+
+
 class TestFilters(TestCase):
     def test_formatprice_case_1(self):
         res = filters.formatprice(10)
@@ -133,6 +261,10 @@ class TestForms(TestCase):
         cls.brandB = Brands.objects.create(brand='brand B')
         cls.brandC = Brands.objects.create(brand='brand C')
 
+    def setUp(self):
+        # Brand facets are cached per query
+        search_cache.clear()
+
     def test_brand_options_behaviour(self):
         """ 
         Brand choicefield should return a dynamic list of brands that is
@@ -152,13 +284,12 @@ class TestForms(TestCase):
         brand_choices = bound_form.fields['brand'].choices
 
         # Assert brands associated with search query is found in dropdown 
-        # options (ie. brand A & B, but not C)
-        e_1 = (self.brandA.brand_id, self.brandA.brand.title())
-        e_2 = (self.brandB.brand_id, self.brandB.brand.title())
-        e_3 = (self.brandC.brand_id, self.brandC.brand.title())
+        # options (ie. brand A & B, but not C), with their product counts
+        e_1 = (self.brandA.brand_id, f'{self.brandA.brand.title()} (1)')
+        e_2 = (self.brandB.brand_id, f'{self.brandB.brand.title()} (1)')
         self.assertIn(e_1, brand_choices)
         self.assertIn(e_2, brand_choices)
-        self.assertNotIn(e_3, brand_choices)
+        self.assertNotIn(self.brandC.brand_id, [c[0] for c in brand_choices])
 
     def test_brand_options_uses_full_txt_search(self):
         """         
@@ -174,18 +305,43 @@ class TestForms(TestCase):
         bound_form = ProductSearchForm(**mock_query)
         brand_choices = bound_form.fields['brand'].choices
         
-        e_1 = (self.brandA.brand_id, self.brandA.brand.title())
-        e_2 = (self.brandB.brand_id, self.brandB.brand.title())
-        self.assertIn(e_1, brand_choices)
-        self.assertNotIn(e_2, brand_choices)
+        brand_ids = [c[0] for c in brand_choices]
+        self.assertIn(self.brandA.brand_id, brand_ids)
+        self.assertNotIn(self.brandB.brand_id, brand_ids)
+
+    def test_brand_options_counted_in_selected_store(self):
+        for i, store in enumerate(['tesco', 'tesco', 'iceland']):
+            product = ProductInfo.objects.create(
+                description='turkey', brand_id=self.brandA.brand_id)
+            StoreListing.objects.create(product=product, store_id=store,
+                                        pid=str(i))
+        ProductInfo.objects.create(description='turkey',
+                                   brand_id=self.brandB.brand_id)
+
+        mock_query = {'initial': {'search': ' Turkey', 'store': 'tesco'}}
+        brand_choices = ProductSearchForm(**mock_query).fields['brand'].choices
+
+        self.assertIn((self.brandA.brand_id, 'Brand A (2)'), brand_choices)
+        self.assertNotIn(self.brandB.brand_id, [c[0] for c in brand_choices])
+
+    def test_brand_options_cached_per_normalised_query(self):
+        ProductInfo.objects.create(description='turkey',
+                                   brand_id=self.brandA.brand_id)
+        ProductSearchForm(initial={'search': 'turkey'})
+
+        with self.assertNumQueries(1):  # store choices only
+            form = ProductSearchForm(initial={'search': '  TURKEY '})
+        self.assertIn((self.brandA.brand_id, 'Brand A (1)'),
+                      form.fields['brand'].choices)
 
     def test_store_options_behaviour(self):
         """ 
         Store choicefield should return a list of all stores, independently of
         product query
         """
-        ProductInfo.objects.create(description='turkey', tesco='123',
-                                   iceland=None)
+        product = ProductInfo.objects.create(description='turkey')
+        StoreListing.objects.create(product=product, store_id='tesco',
+                                    pid='123')
         mock_query = {'initial': {'search': 'turkey'}}
         bound_form = ProductSearchForm(**mock_query)
         store_choices = bound_form.fields['store'].choices
@@ -193,11 +349,22 @@ class TestForms(TestCase):
         self.assertIn(('tesco', 'Tesco'), store_choices)
         self.assertIn(('iceland', 'Iceland'), store_choices)
 
+    def test_store_options_read_from_registry(self):
+        Store.objects.create(name='aldi', title='Aldi')
+        mock_query = {'initial': {'search': 'turkey'}}
+        bound_form = ProductSearchForm(**mock_query)
+
+        self.assertIn(('aldi', 'Aldi'), bound_form.fields['store'].choices)
+
 
 # class ProductBrowserFormTests(TestCase):
 
 
 class ProductBrowserTests(TestCase):
+    def setUp(self):
+        # Pages of results are cached per query
+        search_cache.clear()
+
     def generate_GET(self, **kwargs):
         url = reverse('product_browser')
         querystring_list = []
@@ -207,9 +374,13 @@ class ProductBrowserTests(TestCase):
         querystring = '&'.join(querystring_list)
         return url + '?' + querystring
 
-    def create_product(self, **kwargs):
+    def create_product(self, stores=None, **kwargs):
+        """ stores maps a store to a dict of StoreListing values """
         product = ProductInfo(**kwargs)
         product.save()
+        for store, listing in (stores or {}).items():
+            StoreListing.objects.create(product=product, store_id=store,
+                                        **listing)
         return product
 
     def test_has_search_query(self):
@@ -217,8 +388,8 @@ class ProductBrowserTests(TestCase):
         If GET request includes search query, return appropriately filtered
         queryset of products
         """
-        self.create_product(description='productA', tesco='1')
-        self.create_product(description='productB', tesco='2')
+        self.create_product({'tesco': {'pid': '1'}}, description='productA')
+        self.create_product({'tesco': {'pid': '2'}}, description='productB')
         url = self.generate_GET(search='productA', store='tesco')
         response = self.client.get(url)
 
@@ -234,7 +405,7 @@ class ProductBrowserTests(TestCase):
         # beef + mince should match 'beef 7% mince' if using full text search
         # but using queryset's in-built __icontains will not match 
         # 'beef 7% mince'
-        self.create_product(description='beef 7% mince', tesco='1')
+        self.create_product({'tesco': {'pid': '1'}}, description='beef 7% mince')
         url = self.generate_GET(search='beef mince', store='tesco')
         response = self.client.get(url)
 
@@ -247,10 +418,12 @@ class ProductBrowserTests(TestCase):
         """
         Queryset should be filtered by store
         """
-        self.create_product(description='tesco product', tesco='1')
-        self.create_product(description='iceland product', iceland='1')
-        self.create_product(description='common product', tesco='2', 
-                            iceland='2')
+        self.create_product({'tesco': {'pid': '1'}},
+                            description='tesco product')
+        self.create_product({'iceland': {'pid': '1'}},
+                            description='iceland product')
+        self.create_product({'tesco': {'pid': '2'}, 'iceland': {'pid': '2'}},
+                            description='common product')
         url = self.generate_GET(search='product', store='iceland')
         response = self.client.get(url)
 
@@ -266,11 +439,49 @@ class ProductBrowserTests(TestCase):
         New attribute, storing cheapest £/10g protein value, should be added to
         each item in queryset.
         """
-        self.create_product(description='productA', total_qty=0.1, 
-                            unit_of_measurement='kg', tesco_base_price=1,
-                            protein='10', tesco='1')
+        self.create_product({'tesco': {'pid': '1', 'base': 1}},
+                            description='productA', total_qty=0.1,
+                            unit_of_measurement='kg', protein='10')
         url = self.generate_GET(search='productA', store='tesco')
         response = self.client.get(url)
 
         res = response.context['products']
-        self.assertEqual(res[0].protein_price, 1)
\ No newline at end of file
+        self.assertEqual(res[0].protein_price, 1)
+
+    def test_store_sorted_by_protein_price_and_paginated(self):
+        """
+        Without a search, all of a store's priced products are listed by
+        £/10g protein, computed by the db, a page at a time
+        """
+        for i, price in enumerate([3, 1, 2]):
+            self.create_product({'tesco': {'pid': str(i), 'base': price}},
+                                description=f'product {i}', total_qty=0.5,
+                                kcal=100, protein=10)
+        self.create_product({'iceland': {'pid': '9', 'base': 0.5}},
+                            description='iceland product', total_qty=0.5,
+                            kcal=100, protein=10)
+
+        with patch.object(ProductBrowser, 'paginate_by', 2):
+            response = self.client.get(self.generate_GET(store='tesco'))
+
+        res = response.context['products']
+        self.assertEqual([p.description for p in res],
+                         ['product 1', 'product 2'])
+        self.assertEqual(res[0].protein_price, Decimal('0.2'))
+        self.assertEqual(response.context['paginator'].count, 3)
+        # Only the displayed columns are loaded
+        self.assertIn('img', res[0].get_deferred_fields())
+
+    def test_sort_choice(self):
+        self.create_product({'tesco': {'pid': '1', 'base': 1}},
+                            description='cheap', total_qty=1, kcal=100,
+                            protein=10)
+        self.create_product({'tesco': {'pid': '2', 'base': 5}},
+                            description='high protein', total_qty=1,
+                            kcal=100, protein=30)
+        url = self.generate_GET(store='tesco', sort='protein')
+        response = self.client.get(url)
+
+        res = response.context['products']
+        self.assertEqual([p.description for p in res],
+                         ['high protein', 'cheap'])
@@ -1,4 +1,5 @@
 from django.shortcuts import render
+from django.db.models import F
 from django.views.generic import TemplateView, DetailView, ListView
 from django.views.generic.edit import FormMixin
 from django.core.exceptions import ObjectDoesNotExist
@@ -7,6 +8,8 @@ from django.http import HttpResponseRedirect
 from . import models as m
 from . import forms
 from .helper.barcode import decode_barcode
+from .helper.search import (brand_facets, search_cache, search_key,
+                            search_products)
 
 
 class Index(FormMixin, TemplateView):
@@ -43,7 +46,32 @@ class ProductView(FormMixin, DetailView):
     # Form for navbar
     form_class = forms.ProductSearchForm
 
-class SearchView(FormMixin, ListView):
+class CachedPagesMixin:
+    """
+    Caches the pages of a ListView's results, with the paginator's count, in
+    search_cache (see SearchCache) under the key returned by cache_key()
+    """
+    def cache_key(self):
+        """ Returns the key of the requested page, or None to not cache it """
+        raise NotImplementedError
+
+    def paginate_queryset(self, queryset, page_size):
+        key = self.cache_key()
+        if key is None:
+            return super().paginate_queryset(queryset, page_size)
+
+        def paginate():
+            paginator, page, object_list, is_paginated = (
+                super(CachedPagesMixin, self).paginate_queryset(queryset,
+                                                                page_size))
+            page.object_list = list(object_list)
+            return paginator, page, page.object_list, is_paginated
+        return search_cache.get_or_set(key, paginate)
+
+    def get_page(self):
+        return self.request.GET.get(self.page_kwarg) or '1'
+
+class SearchView(CachedPagesMixin, FormMixin, ListView):
     # FormMixin Attributes
     form_class = forms.ProductSearchForm
     
@@ -61,6 +89,15 @@ class SearchView(FormMixin, ListView):
         }
         return super().get_initial()
 
+    def get_form_kwargs(self):
+        """ Passes the brand facets of the search on to the brand dropdown """
+        kwargs = super().get_form_kwargs()
+        search_query = self.request.GET.get('search')
+        if search_query:
+            kwargs['brand_facets'] = brand_facets(
+                search_query, self.request.GET.get('store'))
+        return kwargs
+
     # ListView Methods
     def get_queryset(self):
         """ Query model based on search query then filter by brand and store """
@@ -70,52 +107,92 @@ class SearchView(FormMixin, ListView):
 
         queryset = []
         if search_query: 
-            # the '__search' in filter() requires django.contrib.postgres
-            queryset = m.ProductInfo.objects.filter(
-                description__search=search_query).order_by('description')
+            # Full text search on the GIN-indexed search_vector, best first
+            queryset = search_products(search_query, store_query).order_by(
+                '-rank', 'description')
             if brand_query and brand_query != '0':
                 # brand_query value of '0' corresponds to 'all brands'
                 queryset = queryset.filter(brand_id=brand_query)
-            if store_query and store_query != 'all':
-                kwarg = {store_query + '__isnull': False}
-                queryset = queryset.filter(**kwarg)
         return queryset
+
+    def cache_key(self):
+        """ Pages are cached per normalised search, brand, store and page """
+        search_query = self.request.GET.get('search')
+        if not search_query:
+            return None
+        return search_key('search', search_query,
+                          brand=self.request.GET.get('brand'),
+                          store=self.request.GET.get('store'),
+                          page=self.get_page())
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['querystring'] = self.request.GET
         return context
 
-class ProductBrowser(FormMixin, ListView):
+class ProductBrowser(CachedPagesMixin, FormMixin, ListView):
     form_class = forms.ProductBrowserForm
     context_object_name = 'products'
     template_name = 'products/product_browser.html'
+    paginate_by = 50
+
+    # Columns displayed by the template; the rest are never loaded
+    columns = ('pid', 'description', 'kcal', 'fat', 'carb', 'protein')
+    # Sort options (see ProductBrowserForm) -> ordering of the products
+    orderings = {
+        'price': [F('protein_price').asc(nulls_last=True), 'description'],
+        'protein': [F('protein').desc(nulls_last=True), 'description'],
+        'relevance': ['-rank', 'description'],
+    }
 
     def get_initial(self):
         self.initial = {
             'search': self.request.GET.get('search'),
-            'store': self.request.GET.get('store')
+            'store': self.request.GET.get('store'),
+            'sort': self.get_sort(),
         }
         return super().get_initial()
 
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        if sort not in self.orderings or (
+                sort == 'relevance' and not self.request.GET.get('search')):
+            return 'price'
+        return sort
+
     def get_queryset(self):
+        """
+        Returns a store's products (matching the search, if any) annotated
+        with their cheapest £/10g protein at the store, computed, sorted and
+        paged by the db; see ProductInfoQuerySet.with_protein_price
+        """
         search_query = self.request.GET.get('search')
         store = self.request.GET.get('store')
 
-        queryset = []
+        if not store:
+            return []
+        products = m.ProductInfo.objects.all()
         if search_query:
-            store_filter = {f'{store}__isnull': False}
-            queryset = m.ProductInfo.objects.filter(**store_filter)
-            filters = {
-                'description__search': search_query,  # query
-                'total_qty__gt': 0,                   # exclude items w/o qty
-                'kcal__gt': 0,                        # exclude items w/o nutrition
-                f'{store}_base_price__isnull': False  # exclude items w/o price
-            }
-            queryset = queryset.filter(**filters).order_by('description')
-                
-
-        for product in queryset:
-            # Add cheapest £/10g protein value (from base, sale, or offer)
-            setattr(product, 'protein_price', product.cheapest_price(store))
-        return queryset
+            products = products.search(search_query)
+        filters = {
+            'total_qty__gt': 0,                   # exclude items w/o qty
+            'kcal__gt': 0,                        # exclude items w/o nutrition
+            'listings__store': store,
+            'listings__base__isnull': False       # exclude items w/o price
+        }
+        return products.filter(**filters).with_protein_price(store).only(
+            *self.columns).order_by(*self.orderings[self.get_sort()])
+
+    def cache_key(self):
+        """ Pages are cached per normalised search, store, sort and page """
+        store = self.request.GET.get('store')
+        if not store:
+            return None
+        return search_key('browse', self.request.GET.get('search') or '',
+                          store=store, page=self.get_page(),
+                          sort=self.get_sort())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['querystring'] = self.request.GET
+        return context